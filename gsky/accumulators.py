@@ -0,0 +1,232 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MapAccumulator(object):
+    def __init__(self, npix, nthreads=1, chunk_size=1048576,
+                 max_bytes=2**30):
+        """
+        Accumulates per-pixel sums of a set of weights (e.g. number
+        counts, sums and sums of squares). Each set of weights is
+        reduced with a single `np.bincount` call over all objects.
+        Products of weight arrays are evaluated in chunks of
+        `chunk_size` objects, so that only one object-sized array is
+        allocated per weight. If `nthreads` > 1, the objects are split
+        between threads, each accumulating its own partial maps, which
+        are added up at the end.
+        :param npix: number of pixels in the output maps.
+        :param nthreads: number of threads. If `None`, the number of
+            available CPUs will be used.
+        :param chunk_size: number of objects processed at once when
+            evaluating weight products.
+        :param max_bytes: maximum memory used by the partial maps of
+            the additional threads. The number of threads is reduced
+            if needed.
+        """
+        self.npix = npix
+        if nthreads is None:
+            nthreads = os.cpu_count() or 1
+        self.nthreads = max(int(nthreads), 1)
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+
+    def _get_weight(self, weight, i_start, i_end, good, ngood):
+        if weight is None:
+            return None
+        if (not isinstance(weight, tuple)) and (good is None):
+            return np.asarray(weight[i_start:i_end], dtype=np.float64)
+
+        w = np.empty(ngood)
+        j0 = 0
+        for i0 in range(i_start, i_end, self.chunk_size):
+            sl = slice(i0, min(i0+self.chunk_size, i_end))
+            if isinstance(weight, tuple):
+                wc = np.asarray(weight[0][sl], dtype=np.float64)
+                for ww in weight[1:]:
+                    wc = wc*ww[sl]
+            else:
+                wc = np.asarray(weight[sl], dtype=np.float64)
+            if good is not None:
+                wc = wc[good[i0-i_start:sl.stop-i_start]]
+            w[j0:j0+len(wc)] = wc
+            j0 += len(wc)
+        return w
+
+    def _accumulate(self, ipix, weights, i_start, i_end):
+        ip = ipix[i_start:i_end]
+        good = ip >= 0
+        if np.all(good):
+            good = None
+        else:
+            ip = ip[good]
+        sums = np.zeros([len(weights), self.npix])
+        for i, weight in enumerate(weights):
+            # No minlength, to avoid allocating a full map per call
+            b = np.bincount(ip, weights=self._get_weight(weight, i_start,
+                                                          i_end, good,
+                                                          len(ip)))
+            sums[i, :len(b)] += b
+        return sums
+
+    def __call__(self, ipix, weights, out=None):
+        """
+        Computes the per-pixel sums of a set of weights.
+        :param ipix: pixel index of each object (objects with negative
+            indices are ignored).
+        :param weights: list of weights. Each element can be `None`
+            (number counts), an array with one value per object, or
+            a tuple of such arrays, in which case their product
+            (evaluated chunk by chunk) is used.
+        :param out: array of shape [len(weights), npix] to which the
+            sums are added in place (optional). Only the pixels
+            containing objects are updated, so the cost scales with
+            the number of objects rather than the size of the map.
+        :return: array of shape [len(weights), npix].
+        """
+        ipix = np.asarray(ipix)
+        nobj = len(ipix)
+        if out is not None:
+            # Accumulate on the compact set of occupied pixels
+            good = ipix >= 0
+            upix, inv = np.unique(ipix[good], return_inverse=True)
+            ip = np.full(nobj, -1, dtype=np.int64)
+            ip[good] = inv
+            acc = MapAccumulator(len(upix), nthreads=self.nthreads,
+                                 chunk_size=self.chunk_size,
+                                 max_bytes=self.max_bytes)
+            out[:, upix] += acc(ip, weights).astype(out.dtype, copy=False)
+            return out
+
+        nchunks = (nobj+self.chunk_size-1)//self.chunk_size
+        map_bytes = max(len(weights)*self.npix*8, 1)
+        nthreads = min(self.nthreads, nchunks,
+                       1+int(self.max_bytes//map_bytes))
+        if nthreads <= 1:
+            return self._accumulate(ipix, weights, 0, nobj)
+
+        # Split in contiguous blocks of chunks, one per thread
+        edges = (np.linspace(0, nchunks, nthreads+1).astype(int) *
+                 self.chunk_size)
+        edges[-1] = nobj
+        with ThreadPoolExecutor(max_workers=nthreads) as ex:
+            partial = list(ex.map(lambda i: self._accumulate(ipix, weights,
+                                                              edges[i],
+                                                              edges[i+1]),
+                                  range(nthreads)))
+        sums = partial[0]
+        for p in partial[1:]:
+            sums += p
+        return sums
+
+
+class MeanVarAccumulator(object):
+    def __init__(self, npix, nquantities=1, nthreads=1):
+        """
+        Streaming per-pixel mean and variance of one or more quantities,
+        optionally weighted. Each batch of objects is reduced with a
+        two-pass algorithm, and batches (or accumulators filled by
+        different workers) are combined with Chan et al.'s parallel
+        update, so the result does not depend on how the data was
+        split, and there is no catastrophic cancellation for quantities
+        with a large mean. Accumulators can be merged with `+=`.
+        :param npix: number of pixels.
+        :param nquantities: number of quantities.
+        :param nthreads: number of threads used by `MapAccumulator`.
+        """
+        self.npix = npix
+        self.nquantities = nquantities
+        self.nthreads = nthreads
+        # Number counts
+        self.n = np.zeros(npix)
+        # Sum of weights
+        self.w = np.zeros(npix)
+        # Weighted means and sums of squared deviations
+        self.mean = np.zeros([nquantities, npix])
+        self.m2 = np.zeros([nquantities, npix])
+
+    def _merge(self, pix, n, w, mean, m2):
+        # Merges the statistics of a set of pixels (a slice or an
+        # array of unique pixel indices).
+        w0 = self.w[pix]
+        wt = w0+w
+        good = wt > 0
+        f = np.zeros(len(wt))
+        f[good] = w[good]/wt[good]
+        mean0 = self.mean[:, pix]
+        delta = mean-mean0
+        self.m2[:, pix] += m2+delta**2*w0*f
+        self.mean[:, pix] = mean0+delta*f
+        self.n[pix] += n
+        self.w[pix] = wt
+
+    def add(self, ipix, quantities, weights=None):
+        """
+        Adds a batch of objects.
+        :param ipix: pixel index of each object (objects with negative
+            indices are ignored).
+        :param quantities: array of values for each object, or list
+            of `nquantities` such arrays.
+        :param weights: per-object weights (or `None`).
+        """
+        ipix = np.asarray(ipix)
+        if self.nquantities == 1 and not isinstance(quantities, list):
+            quantities = [quantities]
+        if len(quantities) != self.nquantities:
+            raise ValueError("Expected %d quantities" % self.nquantities)
+        quantities = [np.asarray(q) for q in quantities]
+        # Work on the compact set of occupied pixels, so that the cost
+        # of each batch doesn't scale with the size of the map.
+        good = ipix >= 0
+        upix, inv = np.unique(ipix[good], return_inverse=True)
+        ipix = np.full(len(ipix), -1, dtype=np.int64)
+        ipix[good] = inv
+        npix = len(upix)
+        acc = MapAccumulator(npix, nthreads=self.nthreads)
+
+        # First pass: counts, weights and means
+        if weights is None:
+            sums = acc(ipix, [None]+quantities)
+            n = sums[0]
+            w = n
+        else:
+            weights = np.asarray(weights)
+            sums = acc(ipix, [None, weights] +
+                       [(weights, q) for q in quantities])
+            n = sums[0]
+            w = sums[1]
+        sums = sums[-self.nquantities:]
+        good = w > 0
+        mean = np.zeros([self.nquantities, npix])
+        mean[:, good] = sums[:, good]/w[good]
+
+        # Second pass: squared deviations from the batch means
+        ip_good = np.where(ipix >= 0, ipix, 0)
+        devs = []
+        for i, q in enumerate(quantities):
+            d = q-mean[i][ip_good]
+            if weights is None:
+                devs.append((d, d))
+            else:
+                devs.append((weights, d, d))
+        m2 = acc(ipix, devs)
+
+        self._merge(upix, n, w, mean, m2)
+        return self
+
+    def __iadd__(self, other):
+        if ((other.npix != self.npix) or
+                (other.nquantities != self.nquantities)):
+            raise ValueError("Can't merge incompatible accumulators")
+        self._merge(slice(None), other.n, other.w, other.mean, other.m2)
+        return self
+
+    def get_variance(self):
+        """
+        Returns the (weighted) variance in each pixel (zero in empty
+        pixels).
+        """
+        var = np.zeros([self.nquantities, self.npix])
+        good = self.w > 0
+        var[:, good] = self.m2[:, good]/self.w[good]
+        return var
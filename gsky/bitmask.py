@@ -0,0 +1,133 @@
+import numpy as np
+
+# Number of set bits in each possible byte
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None],
+                          axis=1).sum(axis=1).astype(np.uint8)
+
+
+class BitMask(object):
+    def __init__(self, bits, npix):
+        """
+        Binary mask stored with one bit per pixel. Masks can be
+        combined with `&`, `|`, `^` and `~`, which operate on the packed
+        bytes directly, and should only be converted to floating-point
+        weights when needed (e.g. when creating NaMaster fields).
+        :param bits: packed bits (as returned by `np.packbits`).
+        :param npix: number of pixels.
+        """
+        self.bits = np.asarray(bits, dtype=np.uint8)
+        self.npix = npix
+        if len(self.bits) != (npix+7)//8:
+            raise ValueError("Packed bits don't match number of pixels")
+
+    @classmethod
+    def from_array(cls, mp, threshold=0.):
+        """
+        Creates a mask from a map.
+        :param mp: boolean or numerical map.
+        :param threshold: pixels with values larger than this are set.
+        """
+        mp = np.asarray(mp).flatten()
+        if mp.dtype != bool:
+            mp = mp > threshold
+        return cls(np.packbits(mp), len(mp))
+
+    @classmethod
+    def zeros(cls, npix):
+        """
+        Creates a mask with no pixels set.
+        """
+        return cls(np.zeros((npix+7)//8, dtype=np.uint8), npix)
+
+    @classmethod
+    def ones(cls, npix):
+        """
+        Creates a mask with all pixels set.
+        """
+        return ~cls.zeros(npix)
+
+    def __len__(self):
+        return self.npix
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def copy(self):
+        return BitMask(self.bits.copy(), self.npix)
+
+    def _check(self, other):
+        if not isinstance(other, BitMask):
+            other = BitMask.from_array(other)
+        if other.npix != self.npix:
+            raise ValueError("Masks have different sizes")
+        return other
+
+    def _clear_padding(self):
+        # Unused bits at the end of the last byte are kept unset
+        nextra = 8*len(self.bits)-self.npix
+        if nextra > 0:
+            self.bits[-1] &= np.uint8((0xff << nextra) & 0xff)
+        return self
+
+    def __and__(self, other):
+        return BitMask(self.bits & self._check(other).bits, self.npix)
+
+    def __or__(self, other):
+        return BitMask(self.bits | self._check(other).bits, self.npix)
+
+    def __xor__(self, other):
+        return BitMask(self.bits ^ self._check(other).bits, self.npix)
+
+    def __iand__(self, other):
+        self.bits &= self._check(other).bits
+        return self
+
+    def __ior__(self, other):
+        self.bits |= self._check(other).bits
+        return self
+
+    def __invert__(self):
+        return BitMask(~self.bits, self.npix)._clear_padding()
+
+    def count(self):
+        """
+        Returns the number of pixels set.
+        """
+        return int(np.sum(_POPCOUNT[self.bits], dtype=np.int64))
+
+    def get_area(self, fsk):
+        """
+        Returns the area covered by the mask in square degrees.
+        :param fsk: FlatMapInfo describing the pixelization.
+        """
+        return self.count()*np.fabs(fsk.dx*fsk.dy)
+
+    def to_bool(self):
+        """
+        Returns the mask as a boolean array.
+        """
+        return np.unpackbits(self.bits, count=self.npix).view(bool)
+
+    def to_float(self):
+        """
+        Returns the mask as an array of 0s and 1s (e.g. for NaMaster).
+        """
+        return np.unpackbits(self.bits, count=self.npix).astype(float)
+
+    def get_pixels(self):
+        """
+        Returns the indices of the pixels set.
+        """
+        return np.flatnonzero(self.to_bool())
+
+    def apply(self, mp):
+        """
+        Returns a copy of `mp` set to zero outside the mask (i.e. the
+        product of the mask and `mp`).
+        :param mp: map with one value per pixel.
+        """
+        mp = np.asarray(mp)
+        if len(mp) != self.npix:
+            raise ValueError("Map doesn't conform to this mask")
+        return np.where(self.to_bool(), mp, 0)
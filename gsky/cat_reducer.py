@@ -0,0 +1,400 @@
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from .map_utils import (createCountsMap,
+                        createMeanStdSums,
+                        createSpin2Sums,
+                        createFlagsMap)
+from .estDepth import get_depth_sums
+from .pixel_index import PixelIndex
+from .selection import Selection, default_cuts, star_cuts, galaxy_cuts
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def merge_sums(sums, new_sums):
+    """
+    Adds a set of partial map sums to another one. Sums can be
+    arrays or any object supporting `+=` (e.g.
+    accumulators.MeanVarAccumulator).
+    :param sums: dictionary of per-pixel sums to update.
+    :param new_sums: dictionary of per-pixel sums to add.
+    """
+    for key, value in new_sums.items():
+        if key in sums:
+            sums[key] += value
+        else:
+            sums[key] = value
+    return sums
+
+
+class CatalogReducer(object):
+    def __init__(self, config, bands, chunk_size=0):
+        """
+        Applies the ReduceCat cleanup and sample cuts to a raw catalog
+        and accumulates the systematics maps built from it. Catalogs
+        are processed in chunks, and all maps are stored as additive
+        per-pixel sums, so that the result of processing different
+        chunks (or files) can be merged by simply adding them up.
+        Instances can be pickled, so files can be farmed out to a
+        multiprocessing pool.
+        :param config: ReduceCat configuration dictionary.
+        :param bands: list of bands.
+        :param chunk_size: number of rows to read at once from each
+            file. If <= 0, whole files will be read.
+        """
+        self.config = config
+        self.bands = bands
+        self.chunk_size = chunk_size
+        self.fsk = None
+        self.fsg = None
+        sample_cuts = config['sample_cuts']
+        if sample_cuts is None:
+            sample_cuts = default_cuts(band=config['band'],
+                                       depth_cut=config['depth_cut'])
+        self.sample_selection = Selection(sample_cuts)
+        self.star_selection = Selection(star_cuts)
+        self.galaxy_selection = Selection(galaxy_cuts)
+
+    def set_geometry(self, fsk, fsg):
+        """
+        Sets the pixelizations of the output maps.
+        :param fsk: FlatMapInfo of the systematics maps.
+        :param fsg: FlatMapInfo of the bright-object mask.
+        """
+        self.fsk = fsk
+        self.fsg = fsg
+
+    def get_columns(self, names):
+        """
+        Selects the columns of a raw catalog that are needed by this
+        and later pipeline stages. These are the coordinates, the
+        magnitudes, fluxes and extinctions in all bands, the columns
+        used by the sample cuts and the bright-object mask, all shape
+        (`ishape_*`) and photo-z (`pz_*`) columns, and any columns
+        listed in `extra_columns`.
+        :param names: names of all the columns in the raw catalog.
+        :return: list of columns to read and list of null-flag
+            columns used to discard rows.
+        """
+        required = [self.config['ra'], self.config['dec'],
+                    'wl_fulldepth_fullcolor']
+        for b in self.bands:
+            required += ['a_'+b, b+'cmodel_mag',
+                         b+'cmodel_flux', b+'cmodel_flux_err']
+        if self.config['mask_type'] == 'arcturus':
+            required.append('mask_Arcturus')
+        elif self.config['mask_type'] == 'sirius':
+            required += ['iflags_pixel_bright_object_center',
+                         'iflags_pixel_bright_object_any']
+        for sel in [self.sample_selection, self.star_selection,
+                    self.galaxy_selection]:
+            required += sel.get_columns()
+        required += self.config['extra_columns']
+        missing = [c for c in required if c not in names]
+        if len(missing) > 0:
+            raise KeyError("Columns "+', '.join(missing) +
+                           " not found in raw catalog")
+        # Kept if present, since later stages may use them
+        optional = ['object_id', 'mask_Arcturus',
+                    'iflags_pixel_bright_object_center',
+                    'iflags_pixel_bright_object_any']
+
+        columns = []
+        nulls = []
+        for n in names:
+            if n.__contains__('isnull'):
+                # Null flags for shapes don't discard rows
+                if not n.startswith('ishape'):
+                    nulls.append(n)
+            elif ((n in required) or (n in optional) or
+                  n.startswith('pz_') or n.startswith('ishape')):
+                columns.append(n)
+        return columns, nulls
+
+    def read_chunks(self, fname):
+        """
+        Iterates over a raw catalog file in chunks of `chunk_size` rows.
+        If `project_columns` is True, only the columns selected by
+        `get_columns` are read, and all null-flag columns are collapsed
+        into a packed bitmask as they are read.
+        :param fname: path to the FITS file.
+        :return: catalog chunk and packed null bitmask (or `None` if
+            the null-flag columns are kept in the catalog).
+        """
+        project = self.config['project_columns']
+        if (self.chunk_size <= 0) and (not project):
+            yield Table.read(fname), None
+            return
+
+        with fits.open(fname, memmap=True) as hdul:
+            data = hdul[1].data
+            nrows = len(data)
+            chunk_size = self.chunk_size
+            if chunk_size <= 0:
+                chunk_size = max(nrows, 1)
+            if project:
+                columns, nulls = self.get_columns(data.columns.names)
+            else:
+                columns, nulls = data.columns.names, []
+            # Columns are taken from the file once and sliced for each
+            # chunk, since slicing the FITS table itself is slow.
+            fields = {n: data.field(n) for n in columns+nulls}
+            for i0 in range(0, nrows, chunk_size):
+                i1 = min(i0+chunk_size, nrows)
+                chunk = Table([fields[c][i0:i1] for c in columns],
+                              names=columns)
+                if not project:
+                    yield chunk, None
+                    continue
+                null_mask = np.zeros((i1-i0+7)//8, dtype=np.uint8)
+                for name in nulls:
+                    null_mask |= np.packbits(fields[name][i0:i1])
+                yield chunk, null_mask
+
+    def clean(self, cat, null_mask=None):
+        """
+        Removes rows with nulls and NaNs, as well as all the null-flag
+        columns.
+        :param cat: input catalog.
+        :param null_mask: packed bitmask of rows with null flags
+            (see `read_chunks`). If `None`, the null flags will be
+            taken from the `isnull` columns of the catalog.
+        """
+        sel = np.ones(len(cat), dtype=bool)
+        if null_mask is not None:
+            sel[np.unpackbits(null_mask, count=len(cat)).astype(bool)] = 0
+        isnull_names = []
+        for key in cat.keys():
+            if key.__contains__('isnull'):
+                if not key.startswith('ishape'):
+                    sel[cat[key]] = 0
+                isnull_names.append(key)
+            else:
+                # Keep photo-zs and shapes even if they're NaNs
+                if (not key.startswith("pz_")) and (not key.startswith('ishape')):
+                    sel[np.isnan(cat[key])] = 0
+        cat.remove_columns(isnull_names)
+        cat.remove_rows(~sel)
+        return cat
+
+    def get_cuts(self, cat):
+        """
+        Collects all sample cuts.
+        :param cat: input (clean) catalog.
+        :return: dictionary of boolean selections: objects in the
+            survey area ('area'), star-like objects ('stars'), stars
+            passing the sample cuts ('star_sample') and galaxies passing
+            the sample cuts ('sample').
+        """
+        nrows = len(cat)
+        sample = self.sample_selection(cat)
+        stars = self.star_selection(cat)
+        gals = self.galaxy_selection(cat)
+        cuts = {}
+        cuts['area'] = np.array(cat['wl_fulldepth_fullcolor'], dtype=bool)
+        cuts['stars'] = Selection.unpack(stars, nrows)
+        cuts['star_sample'] = Selection.unpack(sample & stars, nrows)
+        cuts['sample'] = Selection.unpack(sample & gals, nrows)
+        return cuts
+
+    def get_coords(self, fname):
+        """
+        Returns the coordinates of all clean objects in the survey
+        area, used to define the map geometry.
+        :param fname: path to the FITS file.
+        """
+        ra = [np.zeros(0)]
+        dec = [np.zeros(0)]
+        for cat, null_mask in self.read_chunks(fname):
+            cat = self.clean(cat, null_mask)
+            sel_area = np.array(cat['wl_fulldepth_fullcolor'], dtype=bool)
+            ra.append(np.array(cat[self.config['ra']][sel_area]))
+            dec.append(np.array(cat[self.config['dec']][sel_area]))
+        return np.concatenate(ra), np.concatenate(dec)
+
+    def get_bo_flags(self, cat, mask_fulldepth=False):
+        """
+        Returns the flags defining the bright-object mask.
+        :param cat: input catalog
+        """
+        if self.config['mask_type'] == 'arcturus':
+            flags_mask = [~cat['mask_Arcturus'].astype(bool)]
+        elif self.config['mask_type'] == 'sirius':
+            flags_mask = [cat['iflags_pixel_bright_object_center'],
+                          cat['iflags_pixel_bright_object_any']]
+        else:
+            raise ValueError('Mask type '+self.config['mask_type'] +
+                             ' not supported')
+        if mask_fulldepth:
+            flags_mask.append(~cat['wl_fulldepth_fullcolor'].astype(bool))
+        return flags_mask
+
+    def get_unmasked(self, cat, mask_fulldepth=False):
+        """
+        Returns 1 for objects outside of the bright-object mask
+        and 0 otherwise.
+        :param cat: input catalog
+        """
+        masked = np.ones(len(cat))
+        if mask_fulldepth:
+            masked *= cat['wl_fulldepth_fullcolor']
+        if self.config['mask_type'] == 'arcturus':
+            masked *= cat['mask_Arcturus']
+        elif self.config['mask_type'] == 'sirius':
+            masked *= np.logical_not(cat['iflags_pixel_bright_object_center'])
+            masked *= np.logical_not(cat['iflags_pixel_bright_object_any'])
+        else:
+            raise ValueError('Mask type '+self.config['mask_type'] +
+                             ' not supported')
+        return masked
+
+    def get_psf_ellipticities(self, cat, residual=False):
+        """
+        Get e_PSF, 1, e_PSF, 2 (or their residuals) from a catalog.
+        Here we go from weighted moments to ellipticities following
+        Hirata & Seljak, 2003, arXiv:0301054
+        :param cat: input (star) catalog.
+        :param residual: if True, return the difference between the
+            PSF and the star ellipticities.
+        """
+        Mxx = cat['ishape_hsm_psfmoments_11']
+        Myy = cat['ishape_hsm_psfmoments_22']
+        Mxy = cat['ishape_hsm_psfmoments_12']
+        T_I = Mxx + Myy
+        e_plus = (Mxx - Myy)/T_I
+        e_cross = 2*Mxy/T_I
+
+        if residual:
+            Mxx = cat['ishape_hsm_moments_11']
+            Myy = cat['ishape_hsm_moments_22']
+            Mxy = cat['ishape_hsm_moments_12']
+            T_I = Mxx + Myy
+            e_plus = e_plus - (Mxx - Myy)/T_I
+            e_cross = e_cross - 2*Mxy/T_I
+
+        return e_plus, e_cross
+
+    def add_sums(self, sums, cat, cuts):
+        """
+        Adds the contribution of a catalog chunk to the map sums.
+        The sums are updated in place, only on the pixels containing
+        objects, so the cost of each chunk doesn't scale with the
+        size of the maps.
+        :param sums: dictionary of per-pixel sums to update.
+        :param cat: input (clean) catalog chunk.
+        :param cuts: sample cuts for this chunk (see `get_cuts`).
+        """
+        def _out(key, shape, dtype=float):
+            # Persistent array for a given map, created on first use
+            if key not in sums:
+                sums[key] = np.zeros(shape, dtype=dtype)
+            return sums[key]
+
+        fsk = self.fsk
+        npix = fsk.get_size()
+        ra = np.array(cat[self.config['ra']])
+        dec = np.array(cat[self.config['dec']])
+        # Project all objects once
+        pix = PixelIndex(fsk, ra, dec)
+
+        # 1- Dust
+        for b in self.bands:
+            sums['dust_'+b] = createMeanStdSums(ra, dec, cat['a_'+b], fsk,
+                                                pixidx=pix,
+                                                sums=sums.get('dust_'+b))
+
+        # 2- Nstar
+        #    This needs to be done for stars passing the same cuts as the
+        #    sample (except for the s/g separator)
+        sel = cuts['star_sample']
+        pix_sel = pix.select(sel)
+        createCountsMap(ra[sel], dec[sel], fsk, pixidx=pix_sel,
+                        out=_out('star', npix))
+
+        # 3- e_PSF and 4- delta_e_PSF
+        star_cat = cat[sel]
+        w = star_cat['ishape_hsm_regauss_derived_shape_weight']
+        for key, residual in [('psf', False), ('psfres', True)]:
+            e1, e2 = self.get_psf_ellipticities(star_cat, residual=residual)
+            createSpin2Sums(ra[sel], dec[sel], e1, e2, fsk,
+                            weights=w, pixidx=pix_sel,
+                            out=_out(key, [4, npix]))
+
+        # 5- Binary BO mask
+        area = cuts['area']
+        createCountsMap(ra[area], dec[area], fsk, pixidx=pix.select(area),
+                        out=_out('bo_counts', npix, dtype=int))
+        createFlagsMap(ra[area], dec[area],
+                       self.get_bo_flags(cat[area], mask_fulldepth=True),
+                       self.fsg,
+                       out=_out('bo_flags', self.fsg.get_size(), dtype=int))
+
+        # 6- Masked fraction
+        unmasked = self.get_unmasked(cat, mask_fulldepth=True)
+        sums['masked'] = createMeanStdSums(ra, dec, unmasked, fsk,
+                                           pixidx=pix,
+                                           sums=sums.get('masked'))
+
+        # 7- Depth
+        band = self.config['band']
+        method = self.config['depth_method']
+        stars = cuts['stars']
+        scat = cat[stars]
+        if method == 'fluxerr':
+            arr1 = scat['%scmodel_flux_err' % band]
+            arr2 = None
+        else:
+            arr1 = scat['%scmodel_mag' % band]
+            arr2 = (scat['%scmodel_flux' % band] /
+                    scat['%scmodel_flux_err' % band])
+        sums['depth'] = get_depth_sums(method, ra[stars], dec[stars],
+                                       arr1=np.array(arr1), arr2=arr2,
+                                       fsk=fsk,
+                                       snrthreshold=self.config['min_snr'],
+                                       pixidx=pix.select(stars),
+                                       sums=sums.get('depth'))
+
+    def reduce_chunk(self, cat, cuts, sums):
+        """
+        Accumulates the systematics maps for a clean catalog chunk
+        and applies the final sample cuts to it.
+        - Mag. limit
+        - S/N cut
+        - Star-galaxy separator
+        - Blending
+        :param cat: input (clean) catalog chunk.
+        :param cuts: sample cuts for this chunk (see `get_cuts`).
+        :param sums: dictionary of per-pixel sums to update.
+        :return: catalog of galaxies passing all cuts.
+        """
+        self.add_sums(sums, cat, cuts)
+        cat.remove_rows(~cuts['sample'])
+        return cat
+
+    def __call__(self, fname):
+        """
+        Reduces a full raw catalog file chunk by chunk.
+        :param fname: path to the FITS file.
+        :return: dictionary of map sums and list of catalog chunks
+            passing all cuts.
+        """
+        if self.fsk is None:
+            raise ValueError("Map geometry must be set first")
+
+        sums = {}
+        cats = []
+        n_read = 0
+        n_kept = 0
+        for cat, null_mask in self.read_chunks(fname):
+            n_read += len(cat)
+            cat = self.clean(cat, null_mask)
+            cuts = self.get_cuts(cat)
+            cat = self.reduce_chunk(cat, cuts, sums)
+            n_kept += len(cat)
+            cats.append(cat)
+        logger.info("%s: kept %d objects out of %d" %
+                    (fname, n_kept, n_read))
+        return sums, cats
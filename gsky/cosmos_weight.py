@@ -3,12 +3,11 @@ from .types import FitsFile
 from astropy.table import Table, hstack
 import numpy as np
 from .plot_utils import plot_histo
-from astropy.coordinates import SkyCoord
-import astropy.units as u
+from .selection import Selection, default_cuts, galaxy_cuts
+from .cross_match import CrossMatcher
 from astropy.io import fits
 import os
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
 import scipy.spatial as spatial
 
 import logging
@@ -16,6 +15,41 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def get_color_weights(train_sample, photoz_sample, n_neighbors, nprocs=1):
+    """
+    Computes colour-space weights for a training sample, as the ratio
+    of the number of photo-z objects to the number of training objects
+    within the distance to the `n_neighbors`-th nearest training
+    neighbour of each training object (normalized by the sizes of both
+    samples).
+    :param train_sample: training sample colours, with shape
+        [ntrain, ncolors].
+    :param photoz_sample: photo-z sample colours, with shape
+        [nphotoz, ncolors].
+    :param n_neighbors: number of training neighbours.
+    :param nprocs: number of threads used by the tree queries (all
+        available cores if <= 0).
+    """
+    workers = nprocs if nprocs > 0 else -1
+    # Distance to the n-th nearest neighbor in color space (the
+    # object itself is the first one)
+    tree_train = spatial.cKDTree(train_sample)
+    distances, _ = tree_train.query(train_sample, k=n_neighbors,
+                                    workers=workers)
+    distances = np.amax(distances.reshape([len(train_sample), -1]), axis=1)
+    # Count all photo-z objects within this maximum distance
+    # for each COSMOS object, in a single batched query
+    tree_NN_lookup = spatial.cKDTree(photoz_sample, leafsize=40)
+    num_photoz = tree_NN_lookup.query_ball_point(train_sample,
+                                                 distances+1E-6,
+                                                 return_length=True,
+                                                 workers=workers)
+    # Weights are ratio of number of photo-z neighbors to
+    # COSMOS neighbors (normalized by the number of photo-z objects)
+    return np.true_divide(num_photoz*len(train_sample),
+                          n_neighbors*len(photoz_sample))
+
+
 class COSMOSWeight(PipelineStage):
     name = "COSMOSWeight"
     inputs = [('cosmos_data', FitsFile),
@@ -24,7 +58,8 @@ class COSMOSWeight(PipelineStage):
     config_options = {'depth_cut': 24.5,
                       'band': 'i',
                       'mask_type': 'sirius',
-                      'n_neighbors': 10}
+                      'n_neighbors': 10,
+                      'nprocs': 1}
 
     def run(self):
         """
@@ -52,48 +87,17 @@ class COSMOSWeight(PipelineStage):
                     sel[np.isnan(cat[key])] = 0
         cat.remove_columns(isnull_names)
         cat.remove_rows(~sel)
-        # Collect sample cuts
-        sel_maglim = np.ones(len(cat), dtype=bool)
-        sel_maglim[cat['%scmodel_mag' % band] -
-                   cat['a_%s' % band] > self.config['depth_cut']] = 0
-        # Blending
-        sel_blended = np.ones(len(cat), dtype=bool)
-        # abs_flux<10^-0.375
-        sel_blended[cat['iblendedness_abs_flux'] >= 0.42169650342] = 0
-        # S/N in i
-        sel_fluxcut_i = np.ones(len(cat), dtype=bool)
-        sel_fluxcut_i[cat['icmodel_flux'] < 10*cat['icmodel_flux_err']] = 0
-        # S/N in g
-        sel_fluxcut_g = np.ones(len(cat), dtype=int)
-        sel_fluxcut_g[cat['gcmodel_flux'] < 5*cat['gcmodel_flux_err']] = 0
-        # S/N in r
-        sel_fluxcut_r = np.ones(len(cat), dtype=int)
-        sel_fluxcut_r[cat['rcmodel_flux'] < 5*cat['rcmodel_flux_err']] = 0
-        # S/N in z
-        sel_fluxcut_z = np.ones(len(cat), dtype=int)
-        sel_fluxcut_z[cat['zcmodel_flux'] < 5*cat['zcmodel_flux_err']] = 0
-        # S/N in y
-        sel_fluxcut_y = np.ones(len(cat), dtype=int)
-        sel_fluxcut_y[cat['ycmodel_flux'] < 5*cat['ycmodel_flux_err']] = 0
-        # S/N in grzy (at least 2 pass)
-        sel_fluxcut_grzy = (sel_fluxcut_g + sel_fluxcut_r +
-                            sel_fluxcut_z + sel_fluxcut_y >= 2)
-        # Overall S/N
-        sel_fluxcut = sel_fluxcut_i*sel_fluxcut_grzy
-        # Stars
-        sel_stars = np.ones(len(cat), dtype=bool)
-        sel_stars[cat['iclassification_extendedness'] > 0.99] = 0
-        # Galaxies
-        sel_gals = np.ones(len(cat), dtype=bool)
-        sel_gals[cat['iclassification_extendedness'] < 0.99] = 0
-        ####
-        # Implement final cuts
+        # Implement sample cuts
         # - Mag. limit
         # - S/N cut
         # - Star-galaxy separator
         # - Blending
-        sel = ~(sel_maglim * sel_gals * sel_fluxcut * sel_blended)
-        cat.remove_rows(sel)
+        selection = Selection(default_cuts(band=band,
+                                           depth_cut=self.config['depth_cut'],
+                                           area=False) +
+                              galaxy_cuts)
+        sel = Selection.unpack(selection(cat), len(cat))
+        cat.remove_rows(~sel)
 
         ####
         # Read COSMOS-30band
@@ -114,14 +118,14 @@ class COSMOSWeight(PipelineStage):
         ####
         # Match coordinates
         logger.info("Matching coordinates")
-        cosmos_crd = SkyCoord(ra=np.array(cat30['ALPHA_J2000'])*u.deg,
-                              dec=np.array(cat30['DELTA_J2000'])*u.deg)
-        hsc_crd = SkyCoord(ra=np.array(cat['ra'])*u.deg,
-                           dec=np.array(cat['dec'])*u.deg)
-        # Nearest neighbors
-        cosmos_index, dist_2d, dist_3d = hsc_crd.match_to_catalog_sky(cosmos_crd)
+        matcher = CrossMatcher(cat30['ALPHA_J2000'], cat30['DELTA_J2000'])
+        # Nearest neighbors (within 1 arcsec)
+        cosmos_index, dist_2d = matcher.match(np.array(cat['ra']),
+                                              np.array(cat['dec']),
+                                              max_sep=1./3600,
+                                              nprocs=self.config['nprocs'])
         # Cut everything further than 1 arcsec
-        mask = dist_2d.degree*60*60 < 1
+        mask = dist_2d*60*60 < 1
         cat_good = cat[mask]
         cat30_good = cat30[cosmos_index[mask]]
         cosmos_index_matched = cosmos_index[mask]
@@ -145,23 +149,9 @@ class COSMOSWeight(PipelineStage):
         photoz_sample = np.transpose(np.array([np.array(cat['%scmodel_mag' % m])
                                                for m in bands]))
 
-        # Find nearest neighbors in color space
-        n_nbrs = NearestNeighbors(n_neighbors=self.config['n_neighbors'],
-                                  algorithm='kd_tree',
-                                  metric='euclidean').fit(train_sample)
-        distances, _ = n_nbrs.kneighbors(train_sample)
-        # Get maximum distance
-        distances = np.amax(distances, axis=1)
-        # Find all photo-z objects within this maximum distance
-        # for each COSMOS object
-        tree_NN_lookup = spatial.cKDTree(photoz_sample, leafsize=40)
-        num_photoz = np.array([len(tree_NN_lookup.query_ball_point(t, d+1E-6))
-                               for t, d in zip(train_sample, distances)])
-        # Weights are ratio of number of photo-z neighbors to
-        # COSMOS neighbors (normalized by the number of photo-z objects)
-        weights = np.true_divide(num_photoz*len(train_sample),
-                                 self.config['n_neighbors'] *
-                                 len(photoz_sample))
+        weights = get_color_weights(train_sample, photoz_sample,
+                                    self.config['n_neighbors'],
+                                    nprocs=self.config['nprocs'])
         logger.info(np.sum(weights))
 
         ####
@@ -207,8 +207,8 @@ class CovGauss(PowerSpecter) :
         # Setup
         nsims = 10 * self.ncross * self.nell
         print("Computing covariance from %d Gaussian simulations" % nsims)
-        msk_binary = self.msk_bi.reshape([self.fsk.ny, self.fsk.nx])
-        weights = (self.msk_bi * self.mskfrac).reshape([self.fsk.ny, self.fsk.nx])
+        msk_binary = self.msk_bi.to_float().reshape([self.fsk.ny, self.fsk.nx])
+        weights = self.msk_bi.apply(self.mskfrac).reshape([self.fsk.ny, self.fsk.nx])
         if temps is not None:
             conts = [[t.reshape([self.fsk.ny, self.fsk.nx])] for t in temps]
             cl_dpj = [[c] for c in cl_dpj_all]
@@ -537,7 +537,7 @@ class CovGauss(PowerSpecter) :
 
         logger.info("Computing area.")
         self.area_pix=np.radians(self.fsk.dx)*np.radians(self.fsk.dy)
-        self.area_patch=np.sum(self.msk_bi*self.mskfrac)*self.area_pix
+        self.area_patch=np.sum(self.msk_bi.apply(self.mskfrac))*self.area_pix
         self.lmax=int(180.*np.sqrt(1./self.fsk.dx**2+1./self.fsk.dy**2))
 
         logger.info("Reading contaminants.")
@@ -0,0 +1,134 @@
+import numpy as np
+import multiprocessing
+from scipy.spatial import cKDTree
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def radec_to_xyz(ra, dec):
+    """
+    Returns the unit vectors pointing to a set of sky positions.
+    :param ra, dec: coordinates in degrees.
+    :return: array with shape [npoints, 3].
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cd = np.cos(dec)
+    return np.array([cd*np.cos(ra), cd*np.sin(ra), np.sin(dec)]).T
+
+
+def chord_to_sep(chord):
+    """
+    Converts chord lengths between unit vectors to angular separations
+    in degrees.
+    """
+    return np.degrees(2*np.arcsin(np.clip(0.5*np.asarray(chord), 0, 1)))
+
+
+def sep_to_chord(sep):
+    """
+    Converts angular separations in degrees to chord lengths between
+    unit vectors.
+    """
+    return 2*np.sin(0.5*np.radians(np.clip(sep, 0, 180.)))
+
+
+# Catalog tree used by the worker processes (see `_init_worker`)
+_worker_tree = None
+
+
+def _init_worker(tree):
+    global _worker_tree
+    _worker_tree = tree
+
+
+def _query_tree(tree, xyz, max_chord):
+    chord, idx = tree.query(xyz, k=1, distance_upper_bound=max_chord)
+    return idx, chord
+
+
+def _query_worker(task):
+    xyz, max_chord = task
+    return _query_tree(_worker_tree, xyz, max_chord)
+
+
+class CrossMatcher(object):
+    def __init__(self, ra, dec, leafsize=16):
+        """
+        Nearest-neighbour matching against a catalog of sky positions.
+        The catalog is stored in a KD-tree of 3D unit vectors, so that
+        distances are chord lengths, which are monotonic in the angular
+        separation.
+        :param ra, dec: catalog coordinates in degrees.
+        :param leafsize: leaf size of the KD-tree.
+        """
+        self.tree = cKDTree(radec_to_xyz(ra, dec), leafsize=leafsize)
+
+    def __len__(self):
+        return self.tree.n
+
+    def match(self, ra, dec, max_sep=None, chunk=100000, nprocs=1):
+        """
+        Finds the nearest catalog object to each of a set of positions
+        (as astropy's `SkyCoord.match_to_catalog_sky`).
+        :param ra, dec: coordinates in degrees.
+        :param max_sep: maximum separation in degrees. Positions with no
+            catalog object within it are given an index equal to the
+            catalog size and an infinite separation.
+        :param chunk: number of positions queried at once.
+        :param nprocs: number of processes. The tree is sent once to
+            each of them.
+        :return: index of the nearest catalog object and angular
+            separation (in degrees) for each position.
+        """
+        if max_sep is None:
+            max_chord = np.inf
+        else:
+            # Small tolerance, so that the cut can be applied exactly
+            # on the returned separations.
+            max_chord = sep_to_chord(max_sep)*(1+1E-8)
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        tasks = ((radec_to_xyz(ra[i0:i0+chunk], dec[i0:i0+chunk]),
+                  max_chord)
+                 for i0 in range(0, len(ra), chunk))
+
+        if nprocs > 1:
+            logger.info("Cross-matching on %d processes" % nprocs)
+            with multiprocessing.Pool(processes=nprocs,
+                                      initializer=_init_worker,
+                                      initargs=(self.tree,)) as pool:
+                results = list(pool.imap(_query_worker, tasks))
+        else:
+            results = [_query_tree(self.tree, xyz, mc)
+                       for xyz, mc in tasks]
+
+        if len(results) > 0:
+            idx = np.concatenate([r[0] for r in results])
+            chord = np.concatenate([r[1] for r in results])
+        else:
+            idx = np.zeros(0, dtype=int)
+            chord = np.zeros(0)
+        sep = np.full(len(chord), np.inf)
+        found = np.isfinite(chord)
+        sep[found] = chord_to_sep(chord[found])
+        return idx, sep
+
+
+def match_catalogs(ra1, dec1, ra2, dec2, max_sep, nprocs=1):
+    """
+    Matches each object in a first catalog to its nearest neighbour in
+    a second catalog, keeping only pairs closer than `max_sep`.
+    :param ra1, dec1: coordinates of the first catalog (degrees).
+    :param ra2, dec2: coordinates of the second catalog (degrees).
+    :param max_sep: maximum separation in degrees.
+    :param nprocs: number of processes.
+    :return: indices of the matched objects in the first and second
+        catalogs, and their separations in degrees.
+    """
+    idx, sep = CrossMatcher(ra2, dec2).match(ra1, dec1, max_sep=max_sep,
+                                             nprocs=nprocs)
+    i1 = np.where(sep < max_sep)[0]
+    return i1, idx[i1], sep[i1]
@@ -56,7 +56,7 @@ class CwspCalc(CovGauss) :
 
         logger.info("Computing area.")
         self.area_pix=np.radians(self.fsk.dx)*np.radians(self.fsk.dy)
-        self.area_patch=np.sum(self.msk_bi*self.mskfrac)*self.area_pix
+        self.area_patch=np.sum(self.msk_bi.apply(self.mskfrac))*self.area_pix
         self.lmax=int(180.*np.sqrt(1./self.fsk.dx**2+1./self.fsk.dy**2))
 
         logger.info("Reading contaminants.")
@@ -1,86 +1,157 @@
 import numpy as np
-from .map_utils import createMeanStdMaps, createCountsMap
+from .map_utils import createMeanStdSums, meanStdFromSums
+from .accumulators import MeanVarAccumulator
 
 
-def fluxerr_method(ra, dec, flux_err, fsk, snrthreshold=5,
-                   interpolate=False, count_threshold=4):
+def _interpolate_depth(depth, depth_std, counts, fsk, count_threshold):
+    from scipy.interpolate import griddata
+    idgood = np.where(counts > count_threshold)[0]
+    coords_all = np.array(fsk.pix2pos(np.arange(fsk.npix))).T
+    depth = griddata(coords_all[idgood],
+                     depth[idgood], coords_all,
+                     method='nearest', fill_value=0)
+    depth_std = griddata(coords_all[idgood],
+                         depth_std[idgood], coords_all,
+                         method='nearest', fill_value=0)
+    return depth, depth_std
+
+
+def fluxerr_sums(ra, dec, flux_err, fsk, snrthreshold=5, pixidx=None,
+                 sums=None):
     # 5sigma Magnitude limit= average of 5*flux_err for all
     # objs in each pixel (and then transformed to magnitude)
     # snrthreshold= 5 => 5sigma depth.
     #
     # Since want mags (mean, std) at the end, need to first
-    # run the createMeanStdMaps with 5flux_error to get the
-    # mean flux map which can be converted to fluxes.
-    # To get std mags, need to run createMeanStdMaps with
-    # 5*flux_error converted to mags and keep only the std.
+    # accumulate 5flux_error to get the mean flux map which
+    # can be converted to fluxes.
+    # To get std mags, need to accumulate 5*flux_error
+    # converted to mags and keep only the std.
+    quantity = 10.**(23+6)*snrthreshold*flux_err
+    quantity = -2.5*np.log10(quantity)+23.9
+    return createMeanStdSums(ra, dec,
+                             quantity=[snrthreshold*flux_err, quantity],
+                             fsk=fsk, pixidx=pixidx, sums=sums)
 
-    depth, _ = createMeanStdMaps(ra, dec,
-                                 quantity=snrthreshold*flux_err,
-                                 fsk=fsk)
+
+def fluxerr_from_sums(sums, fsk, interpolate=False, count_threshold=4):
+    depth, _ = meanStdFromSums(sums, iq=0)
 
     # convert from fluxes to mags
     depth = 10.**(23+6)*depth
     depth[~np.isnan(depth)] = -2.5*np.log10(depth[~np.isnan(depth)])+23.9
 
     # find the std.
-    quantity = 10.**(23+6)*snrthreshold*flux_err
-    quantity = -2.5*np.log10(quantity)+23.9
-    dontcare, depth_std = createMeanStdMaps(ra, dec,
-                                            quantity=quantity,
-                                            fsk=fsk)
+    dontcare, depth_std = meanStdFromSums(sums, iq=1)
 
     # Zeros in empty pixels
-    nc = createCountsMap(ra, dec, fsk)
+    nc = sums.n
     depth[nc < 1] = 0
     depth_std[nc < 1] = 0
 
     if interpolate:
-        from scipy.interpolate import griddata
-        idgood = np.where(nc > count_threshold)[0]
-        coords_all = np.array(fsk.pix2pos(np.arange(fsk.npix))).T
-        depth = griddata(coords_all[idgood],
-                         depth[idgood], coords_all,
-                         method='nearest', fill_value=0)
-        depth_std = griddata(coords_all[idgood],
-                             depth_std[idgood], coords_all,
-                             method='nearest', fill_value=0)
+        depth, depth_std = _interpolate_depth(depth, depth_std, nc,
+                                              fsk, count_threshold)
     return depth, depth_std
 
 
-def dr1_method(ra, dec, mags, snr, fsk, snrthreshold,
-               interpolate=False, count_threshold=4):
-    pix_nums = np.array(fsk.pos2pix(ra, dec))
+def fluxerr_method(ra, dec, flux_err, fsk, snrthreshold=5,
+                   interpolate=False, count_threshold=4):
+    sums = fluxerr_sums(ra, dec, flux_err, fsk, snrthreshold=snrthreshold)
+    return fluxerr_from_sums(sums, fsk, interpolate=interpolate,
+                             count_threshold=count_threshold)
+
+
+def dr1_sums(ra, dec, mags, snr, fsk, snrthreshold, pixidx=None, sums=None):
+    if pixidx is None:
+        pix_nums = np.array(fsk.pos2pix(ra, dec))
+    else:
+        pix_nums = np.array(pixidx.get_pixels(fsk))
 
     mask = ((snr >= snrthreshold-1) &
             (snr <= snrthreshold+1) &
             (pix_nums >= 0))
-    mags_use = mags[mask]
-    pix_nums = pix_nums[mask]
-
-    n_map = np.bincount(pix_nums, minlength=fsk.npix)
-    m_map = np.bincount(pix_nums, weights=mags_use,
-                        minlength=fsk.npix)
-    m2_map = np.bincount(pix_nums, weights=mags_use**2,
-                         minlength=fsk.npix)
+    pix_nums[~mask] = -1
+
+    if sums is None:
+        sums = MeanVarAccumulator(fsk.npix)
+    return sums.add(pix_nums, np.asarray(mags))
+
+
+def dr1_from_sums(sums, fsk, interpolate=False, count_threshold=4):
+    n_map = sums.n
     depth = np.zeros(fsk.npix)
     depth_std = np.zeros(fsk.npix)
     pix_good = np.where(n_map > 0)[0]
-    depth[pix_good] = m_map[pix_good] / n_map[pix_good]
-    depth_std[pix_good] = np.sqrt(m2_map[pix_good]/n_map[pix_good] -
-                                  (m_map[pix_good]/n_map[pix_good])**2)
+    depth[pix_good] = sums.mean[0][pix_good]
+    depth_std[pix_good] = np.sqrt(sums.get_variance()[0][pix_good])
     if interpolate:
-        from scipy.interpolate import griddata
-        idgood = np.where(n_map > count_threshold)[0]
-        coords_all = np.array(fsk.pix2pos(np.arange(fsk.npix))).T
-        depth = griddata(coords_all[idgood],
-                         depth[idgood], coords_all,
-                         method='nearest', fill_value=0)
-        depth_std = griddata(coords_all[idgood],
-                             depth_std[idgood], coords_all,
-                             method='nearest', fill_value=0)
+        depth, depth_std = _interpolate_depth(depth, depth_std, n_map,
+                                              fsk, count_threshold)
     return depth, depth_std
 
 
+def dr1_method(ra, dec, mags, snr, fsk, snrthreshold,
+               interpolate=False, count_threshold=4):
+    sums = dr1_sums(ra, dec, mags, snr, fsk, snrthreshold)
+    return dr1_from_sums(sums, fsk, interpolate=interpolate,
+                         count_threshold=count_threshold)
+
+
+def get_depth_sums(method, ra, dec, arr1, arr2, fsk, snrthreshold=5,
+                   pixidx=None, sums=None):
+    """
+    Computes the per-pixel statistics needed to build a depth map
+    (see `get_depth_from_sums`). Statistics computed for different
+    subsets of a catalog can be merged with `+=`.
+    :param method: method used to compute the depth map.
+    Allowed values: 'dr1' and 'fluxerr'.
+    :param ra: right ascension for each object.
+    :param dec: declination for each object.
+    :param arr1: measurement of the flux (if using 'fluxerr') or magnitude
+    (otherwise) for each object.
+    :param arr2: measurement of the S/N for each object (or `None` if using
+    'fluxerr').
+    :param fsk: flatmaps.FlatMapInfo object describing the geometry of the
+    output map.
+    :param snrthreshold: S/N cut to use.
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+    If provided, `ra` and `dec` are not used.
+    :param sums: accumulators.MeanVarAccumulator to update (optional).
+    If `None`, a new one is created.
+    """
+    snrthreshold = int(snrthreshold)
+    if method == 'dr1':
+        return dr1_sums(ra, dec, mags=arr1, snr=arr2, fsk=fsk,
+                        snrthreshold=snrthreshold, pixidx=pixidx,
+                        sums=sums)
+    elif method == 'fluxerr':
+        return fluxerr_sums(ra, dec, flux_err=arr1, fsk=fsk,
+                            snrthreshold=snrthreshold, pixidx=pixidx,
+                            sums=sums)
+    else:
+        raise KeyError("Unknown method "+method)
+
+
+def get_depth_from_sums(method, sums, fsk, interpolate=False,
+                        count_threshold=4):
+    """
+    Creates a depth map from the sums computed by `get_depth_sums`.
+    :param method: method used to compute the depth map.
+    :param sums: per-pixel statistics.
+    :param fsk: flatmaps.FlatMapInfo object describing the geometry of the
+    output map.
+    """
+    if method == 'dr1':
+        return dr1_from_sums(sums, fsk, interpolate=interpolate,
+                             count_threshold=count_threshold)
+    elif method == 'fluxerr':
+        return fluxerr_from_sums(sums, fsk, interpolate=interpolate,
+                                 count_threshold=count_threshold)
+    else:
+        raise KeyError("Unknown method "+method)
+
+
 def get_depth(method, ra, dec, arr1, arr2, fsk,
               snrthreshold=5, interpolate=False, count_threshold=4):
     """
@@ -5,6 +5,7 @@ from matplotlib import cm
 import pymaster as nmt
 from astropy.io import fits
 from astropy.wcs import WCS
+from .resampling import upgrade, downgrade
 
 
 def _wrap_ra(ra):
@@ -16,6 +17,12 @@ def _wrap_ra(ra):
         return ra
 
 
+# Projections for which pixel coordinates are computed in closed form
+_FAST_PROJECTIONS = ['CAR', 'TAN']
+# Number of objects projected at once by the closed-form transforms
+_PROJ_CHUNK = 1048576
+
+
 class FlatMapInfo(object):
     def __init__(self, wcs, nx=None, ny=None,
                  lx=None, ly=None):
@@ -53,6 +60,150 @@ class FlatMapInfo(object):
         self.dy = self.ly/self.ny
 
         self.npix = self.nx*self.ny
+        self._fast_proj = None
+
+    def __getstate__(self):
+        # WCS objects are pickled through their FITS header, which
+        # rounds the floating-point parameters. Store them exactly, so
+        # that pixel assignments don't change in other processes.
+        state = self.__dict__.copy()
+        w = state.pop('wcs')
+        state['_wcs_header'] = w.to_header_string(relax=True)
+        params = {'crpix': w.wcs.crpix, 'crval': w.wcs.crval}
+        if w.wcs.has_cd():
+            params['cd'] = w.wcs.cd
+        else:
+            params['cdelt'] = w.wcs.cdelt
+            if w.wcs.has_pc():
+                params['pc'] = w.wcs.pc
+        state['_wcs_params'] = {k: np.array(v) for k, v in params.items()}
+        return state
+
+    def __setstate__(self, state):
+        state = state.copy()
+        w = WCS(fits.Header.fromstring(state.pop('_wcs_header')))
+        for k, v in state.pop('_wcs_params').items():
+            setattr(w.wcs, k, v)
+        w.wcs.set()
+        self.__dict__.update(state)
+        self.wcs = w
+
+    def _get_fast_projection(self):
+        """
+        Returns the name of the projection if pixel coordinates can be
+        computed in closed form (plate carree with the reference point
+        on the equator, or gnomonic, with no rotation), and `None`
+        otherwise. The closed-form transforms are validated against
+        the WCS on a set of points the first time this is called.
+        """
+        if self._fast_proj is not None:
+            return self._fast_proj or None
+
+        self._fast_proj = ''
+        w = self.wcs.wcs
+        proj = w.ctype[0][-3:]
+        if ((proj not in _FAST_PROJECTIONS) or
+                (w.ctype[1][-3:] != proj) or
+                (not w.ctype[0].startswith('RA')) or
+                w.has_cd() or
+                np.any(w.get_pc() != np.identity(2)) or
+                ((proj == 'CAR') and (w.crval[1] != 0))):
+            return None
+
+        # Check against WCS on a grid of points covering the map
+        # (and beyond).
+        ix, iy = np.meshgrid(np.linspace(-0.5*self.nx, 1.5*self.nx, 16),
+                             np.linspace(-0.5*self.ny, 1.5*self.ny, 16))
+        pix = np.array([ix.flatten(), iy.flatten()]).T
+        ra, dec = self.wcs.wcs_pix2world(pix, 0).T
+        good = ~(np.isnan(ra) | np.isnan(dec))
+        self._fast_proj = proj
+        ix_f, iy_f = self._world2pix(ra[good], dec[good])
+        ra_f, dec_f = self._pix2world(pix[good, 0], pix[good, 1])
+        dra = np.fabs(np.mod(ra_f-ra[good]+180., 360.)-180.)
+        if not (np.allclose(ix_f, pix[good, 0], rtol=0, atol=1E-6) and
+                np.allclose(iy_f, pix[good, 1], rtol=0, atol=1E-6) and
+                np.all(dra < 1E-8) and
+                np.allclose(dec_f, dec[good], rtol=0, atol=1E-8)):
+            self._fast_proj = ''
+            return None
+        return proj
+
+    def _world2pix(self, ra, dec):
+        """
+        Returns the (float) pixel coordinates of a set of points
+        (0-based, as for `wcs_world2pix` with origin 0).
+        """
+        proj = self._get_fast_projection()
+        if proj is None:
+            return self.wcs.wcs_world2pix(ra, dec, 0)
+
+        w = self.wcs.wcs
+        ra0, dec0 = w.crval
+        cx, cy = w.crpix - 1
+        dx, dy = w.cdelt
+        ix = np.empty(len(ra))
+        iy = np.empty(len(ra))
+        for i0 in range(0, len(ra), _PROJ_CHUNK):
+            i1 = i0+_PROJ_CHUNK
+            dra = np.asarray(ra[i0:i1], dtype=np.float64)-ra0
+            d = np.asarray(dec[i0:i1], dtype=np.float64)
+            if proj == 'CAR':
+                # Native longitude in [-180, 180]
+                x = np.mod(dra+180., 360.)-180.
+                x[x == -180.] = 180.
+                y = d
+            else:
+                d = np.radians(d)
+                dra = np.radians(dra)
+                sd0 = np.sin(np.radians(dec0))
+                cd0 = np.cos(np.radians(dec0))
+                cdec = np.cos(d)
+                sdec = np.sin(d)
+                cdra = np.cos(dra)
+                cosc = sd0*sdec+cd0*cdec*cdra
+                cosc[cosc <= 0] = np.nan
+                cosc = np.degrees(1./cosc)
+                x = cdec*np.sin(dra)*cosc
+                y = (cd0*sdec-sd0*cdec*cdra)*cosc
+            ix[i0:i1] = cx+x/dx
+            iy[i0:i1] = cy+y/dy
+        return ix, iy
+
+    def _pix2world(self, ix, iy):
+        """
+        Returns the sky coordinates of a set of (float, 0-based) pixel
+        coordinates.
+        """
+        proj = self._get_fast_projection()
+        if proj is None:
+            return self.wcs.wcs_pix2world(ix, iy, 0)
+
+        w = self.wcs.wcs
+        ra0, dec0 = w.crval
+        cx, cy = w.crpix - 1
+        dx, dy = w.cdelt
+        ra = np.empty(len(ix))
+        dec = np.empty(len(ix))
+        for i0 in range(0, len(ix), _PROJ_CHUNK):
+            i1 = i0+_PROJ_CHUNK
+            x = (np.asarray(ix[i0:i1], dtype=np.float64)-cx)*dx
+            y = (np.asarray(iy[i0:i1], dtype=np.float64)-cy)*dy
+            if proj == 'CAR':
+                r = ra0+x
+                d = y
+            else:
+                x = np.radians(x)
+                y = np.radians(y)
+                sd0 = np.sin(np.radians(dec0))
+                cd0 = np.cos(np.radians(dec0))
+                den = cd0-y*sd0
+                r = ra0+np.degrees(np.arctan2(x, den))
+                d = np.degrees(np.arctan2(sd0+y*cd0,
+                                          np.sqrt(x**2+den**2)))
+            ra[i0:i1] = np.mod(r, 360.)
+            dec[i0:i1] = d
+        return ra, dec
 
     def is_map_compatible(self, mp):
         return self.npix == len(mp)
@@ -87,7 +238,7 @@ class FlatMapInfo(object):
         if len(ra) != len(dec):
             raise ValueError("ra and dec must have the same size!")
 
-        ix, iy = self.wcs.wcs_world2pix(np.array([ra, dec]).T, 0).T
+        ix, iy = self._world2pix(ra, dec)
         ix = ix.astype(int)
         iy = iy.astype(int)
         ix_out = np.where(np.logical_or(ix < 0,
@@ -120,7 +271,7 @@ class FlatMapInfo(object):
         if len(ra) != len(dec):
             raise ValueError("ra and dec must have the same size!")
 
-        ix, iy = self.wcs.wcs_world2pix(np.array([ra, dec]).T, 0).T
+        ix, iy = self._world2pix(ra, dec)
         ix_out = np.where(np.logical_or(ix < -self.nx,
                                         ix >= 2*self.nx))[0]
         iy_out = np.where(np.logical_or(iy < -self.ny,
@@ -159,12 +310,35 @@ class FlatMapInfo(object):
         ix = ix.astype(np.float_)
         iy = iy.astype(np.float_)
 
-        ra, dec = self.wcs.wcs_pix2world(np.array([ix, iy]).T, 0).T
+        ra, dec = self._pix2world(ix, iy)
 
         if scalar_input:
             return np.squeeze(ra), np.squeeze(dec)
         return ra, dec
 
+    def get_sky_bounds(self, margin=0., nsamp=64):
+        """
+        Returns the range of sky coordinates spanned by the map edges.
+        :param margin: extend the map by this fraction of its size on
+            each side (e.g. 1 covers the region accepted by `pos2pix2d`).
+        :param nsamp: number of points sampled along each edge.
+        :return: RA of the map centre, minimum and maximum RA offset
+            with respect to it (in [-180, 180)), and minimum and
+            maximum declination, all in degrees.
+        """
+        ra_c, _ = self._pix2world(np.array([0.5*(self.nx-1)]),
+                                  np.array([0.5*(self.ny-1)]))
+        tx = np.linspace(-margin, 1+margin, nsamp)*self.nx-0.5
+        ty = np.linspace(-margin, 1+margin, nsamp)*self.ny-0.5
+        ix = np.concatenate([tx, tx,
+                             np.full(nsamp, tx[0]), np.full(nsamp, tx[-1])])
+        iy = np.concatenate([np.full(nsamp, ty[0]), np.full(nsamp, ty[-1]),
+                             ty, ty])
+        ra, dec = self._pix2world(ix, iy)
+        dra = np.mod(ra-ra_c[0]+180., 360.)-180.
+        return (ra_c[0], np.nanmin(dra), np.nanmax(dra),
+                np.nanmin(dec), np.nanmax(dec))
+
     def get_empty_map(self):
         """
         Returns a map full of zeros
@@ -198,10 +372,23 @@ class FlatMapInfo(object):
         if fnameOut is not None:
             plt.savefig(fnameOut, bbox_inches='tight')
 
-    def write_flat_map(self, filename, maps, descript=None):
+    def write_flat_map(self, filename, maps, descript=None, sparse=False):
         """
         Saves a set of maps in FITS format wit WCS.
+        :param maps: map or set of maps (dense arrays or a
+            SparseFlatMap).
+        :param descript: description of each map.
+        :param sparse: if True (or if `maps` is a SparseFlatMap), only
+            the pixels in the map footprint will be stored (see
+            `SparseFlatMap.write`).
         """
+        if isinstance(maps, SparseFlatMap):
+            maps.write(filename, descript=descript)
+            return
+        if sparse:
+            SparseFlatMap.from_dense(self, maps).write(filename,
+                                                       descript=descript)
+            return
 
         if maps.ndim < 1:
             raise ValueError("Must supply at least one map")
@@ -257,6 +444,11 @@ class FlatMapInfo(object):
         temp1 : if not None, set of contaminants to remove from map1
         temp2 : if not None, set of contaminants to remove from map2
         """
+        # Fields need dense maps
+        map1, mask1, map2, mask2 = [m.to_dense()
+                                    if isinstance(m, SparseFlatMap) else m
+                                    for m in [map1, mask1, map2, mask2]]
+
         same_map = False
         if map2 is None:
             map2 = map1
@@ -337,7 +529,7 @@ class FlatMapInfo(object):
             else:
                 return cl_uncoupled
 
-    def u_grade(self, mp, x_fac, y_fac=None):
+    def u_grade(self, mp, x_fac, y_fac=None, view=False):
         """
         Up-grades the resolution of a map and returns the associated
         FlatSkyInfo object.
@@ -346,71 +538,74 @@ class FlatMapInfo(object):
             pixels in the x direction
         :param y_fac: the new map will be sub-divided into y_fac*ny
             pixels in the y direction if y_fac=None, then y_fac=x_fac
+        :param view: if True, return a read-only
+            [ny, y_fac, nx, x_fac] view of the input map instead of
+            a copy (see `resampling.upgrade`).
         """
         if y_fac is None:
             y_fac = x_fac
+        x_fac = int(x_fac)
+        y_fac = int(y_fac)
         if len(mp) != self.npix:
             raise ValueError("Input map has a wrong size")
 
         w = WCS(naxis=2)
-        w.wcs.cdelt = [self.wcs.wcs.cdelt[0]/int(x_fac),
-                       self.wcs.wcs.cdelt[1]/int(y_fac)]
+        w.wcs.cdelt = [self.wcs.wcs.cdelt[0]/x_fac,
+                       self.wcs.wcs.cdelt[1]/y_fac]
         w.wcs.crval = self.wcs.wcs.crval
         w.wcs.ctype = self.wcs.wcs.ctype
-        w.wcs.crpix = [self.wcs.wcs.crpix[0]*int(x_fac),
-                       self.wcs.wcs.crpix[1]*int(y_fac)]
-
-        fm_ug = FlatMapInfo(w, nx=self.nx*int(x_fac),
-                            ny=self.ny*int(y_fac))
-        mp_ug = np.repeat(np.repeat(mp.reshape([self.ny, self.nx]),
-                                    int(y_fac), axis=0),
-                          int(x_fac), axis=1).flatten()
+        w.wcs.crpix = [self.wcs.wcs.crpix[0]*x_fac,
+                       self.wcs.wcs.crpix[1]*y_fac]
+
+        fm_ug = FlatMapInfo(w, nx=self.nx*x_fac,
+                            ny=self.ny*y_fac)
+        mp_ug = upgrade(np.asarray(mp).reshape([self.ny, self.nx]),
+                        y_fac, x_fac, copy=not view)
+        if not view:
+            mp_ug = mp_ug.reshape(-1)
         return fm_ug, mp_ug
 
-    def d_grade(self, mp, x_fac, y_fac=None):
+    def d_grade(self, mp, x_fac, y_fac=None, reducer='mean', weights=None):
         """
         Down-grades the resolution of a map and returns the
         associated FlatSkyInfo object.
         mp : input map
         :param x_fac: the new map will be sub-divided into
-            floor(nx/x_fac) pixels in the x direction
+            ceil(nx/x_fac) pixels in the x direction
         :param y_fac: the new map will be sub-divided into
-            floor(ny/y_fac) pixels in the y direction
+            ceil(ny/y_fac) pixels in the y direction
             if y_fac=None, then y_fac=x_fac.
+        :param reducer: how pixels are combined ('mean', 'sum', 'min'
+            or 'max').
+        :param weights: per-pixel weights (e.g. a mask) used by the
+            reducer (see `resampling.downgrade`).
         Note that if nx/ny is not a multiple of x_fac/y_fac,
-        the remainder pixels will be lost.
+        the last row/column of pixels is computed from the remainder
+        pixels.
         """
         if y_fac is None:
             y_fac = x_fac
+        x_fac = int(x_fac)
+        y_fac = int(y_fac)
         if len(mp) != self.npix:
             raise ValueError("Input map has a wrong size")
-        print(x_fac, y_fac)
-        print(int(x_fac), int(y_fac))
 
         w = WCS(naxis=2)
-        w.wcs.cdelt = [self.wcs.wcs.cdelt[0]*int(x_fac),
-                       self.wcs.wcs.cdelt[1]*int(y_fac)]
+        w.wcs.cdelt = [self.wcs.wcs.cdelt[0]*x_fac,
+                       self.wcs.wcs.cdelt[1]*y_fac]
         w.wcs.crval = self.wcs.wcs.crval
         w.wcs.ctype = self.wcs.wcs.ctype
-        w.wcs.crpix = [self.wcs.wcs.crpix[0]/int(x_fac),
-                       self.wcs.wcs.crpix[1]/int(y_fac)]
-
-        nx_new = self.nx/int(x_fac)
-        ix_max = nx_new*int(x_fac)
-        ny_new = self.ny/int(y_fac)
-        iy_max = ny_new*int(y_fac)
-
-        mp2d = mp.reshape([self.ny, self.nx])[:iy_max, :][:, :ix_max]
+        w.wcs.crpix = [self.wcs.wcs.crpix[0]/x_fac,
+                       self.wcs.wcs.crpix[1]/y_fac]
+
+        if weights is not None:
+            weights = np.asarray(weights).reshape([self.ny, self.nx])
+        mp_dg = downgrade(np.asarray(mp).reshape([self.ny, self.nx]),
+                          y_fac, x_fac, reducer=reducer, weights=weights)
+        ny_new, nx_new = mp_dg.shape
         fm_dg = FlatMapInfo(w, nx=nx_new, ny=ny_new)
-        mp_dg = np.mean(np.mean(np.reshape(mp2d.flatten(),
-                                           [ny_new,
-                                            int(y_fac),
-                                            nx_new,
-                                            int(x_fac)]),
-                                axis=-1),
-                        axis=-2).flatten()
 
-        return fm_dg, mp_dg
+        return fm_dg, mp_dg.flatten()
 
     @classmethod
     def from_coords(FlatMapInfo, ra_arr, dec_arr, mpdict):
@@ -476,14 +671,27 @@ class FlatMapInfo(object):
         return FlatMapInfo(w, nx=nsidex, ny=nsidey)
 
 
-def read_flat_map(filename, i_map=0, hdu=None):
+def read_flat_map(filename, i_map=0, hdu=None, sparse=False, lazy=False):
     """
     Reads a flat-sky map and the details of its pixelization scheme.
     The latter are returned as a FlatMapInfo object.
     :param i_map: map to read. If -1, all maps will be read.
+    :param sparse: if True, return the map(s) as a SparseFlatMap.
+        Otherwise, maps stored in sparse format are densified.
+    :param lazy: if True (and `i_map` is -1), return a MapStack,
+        which only reads maps when they are accessed.
     """
+    if lazy and (hdu is None) and (i_map == -1):
+        stack = MapStack(filename)
+        return stack.fsk, stack
+
     if hdu is None:
         hdul = fits.open(filename)
+        if hdul[0].header.get('SPARSE', False):
+            fmi, maps = SparseFlatMap.read(hdul, i_map=i_map)
+            if not sparse:
+                maps = maps.to_dense()
+            return fmi, maps
         w = WCS(hdul[0].header)
 
         if i_map == -1:
@@ -507,10 +715,248 @@ def read_flat_map(filename, i_map=0, hdu=None):
             maps = maps.flatten()
 
     fmi = FlatMapInfo(w, nx=nx, ny=ny)
+    if sparse:
+        maps = SparseFlatMap.from_dense(fmi, maps)
 
     return fmi, maps
 
 
+class SparseFlatMap(object):
+    def __init__(self, fsk, ipix, maps, fill_value=0.):
+        """
+        Map (or set of maps) stored only on a footprint of pixels.
+        :param fsk: FlatMapInfo describing the full pixelization.
+        :param ipix: sorted indices of the pixels in the footprint.
+        :param maps: values of the map in the footprint pixels, with
+            shape [npix_footprint] or [nmaps, npix_footprint].
+        :param fill_value: value of the map outside the footprint.
+        """
+        self.fsk = fsk
+        self.ipix = np.asarray(ipix, dtype=np.int64)
+        self.maps = np.asarray(maps)
+        if self.maps.shape[-1] != len(self.ipix):
+            raise ValueError("Maps don't match the footprint")
+        self.fill_value = fill_value
+
+    @classmethod
+    def from_dense(cls, fsk, maps, footprint=None, fill_value=0.):
+        """
+        Creates a SparseFlatMap from a dense map or set of maps.
+        :param fsk: FlatMapInfo of the maps.
+        :param maps: map or set of maps.
+        :param footprint: boolean array or list of pixel indices
+            defining the footprint. If `None`, all pixels where any of
+            the maps is different from `fill_value` are used.
+        :param fill_value: value of the maps outside the footprint.
+        """
+        maps = np.asarray(maps)
+        if maps.shape[-1] != fsk.npix:
+            raise ValueError("Map doesn't conform to this pixelization")
+        if footprint is None:
+            m2d = np.atleast_2d(maps)
+            ipix = np.where(np.any(m2d != fill_value, axis=0))[0]
+        else:
+            footprint = np.asarray(footprint)
+            if footprint.dtype == bool:
+                ipix = np.where(footprint)[0]
+            else:
+                ipix = np.unique(footprint)
+        return cls(fsk, ipix, maps[..., ipix], fill_value=fill_value)
+
+    def is_stack(self):
+        """
+        Returns True if this object contains more than one map.
+        """
+        return self.maps.ndim == 2
+
+    def get_map(self, i_map):
+        """
+        Returns one of the maps of a stack as a SparseFlatMap.
+        """
+        if not self.is_stack():
+            raise ValueError("Not a stack of maps")
+        return SparseFlatMap(self.fsk, self.ipix, self.maps[i_map],
+                             fill_value=self.fill_value)
+
+    def to_dense(self):
+        """
+        Returns the dense version of the map(s).
+        """
+        shape = self.maps.shape[:-1]+(self.fsk.npix,)
+        dense = np.full(shape, self.fill_value, dtype=self.maps.dtype)
+        dense[..., self.ipix] = self.maps
+        return dense
+
+    def write(self, filename, descript=None):
+        """
+        Saves the map(s) in FITS format. The primary HDU contains
+        only the WCS header of the full pixelization (with the
+        keyword SPARSE=True), and the first extension is a table
+        with the footprint pixel indices (column PIXEL) and one
+        column per map (MAP_0, MAP_1...).
+        :param filename: output file.
+        :param descript: description of each map.
+        """
+        maps = np.atleast_2d(self.maps)
+        if descript is not None:
+            if not self.is_stack():
+                descript = [descript]
+            if len(maps) != len(descript):
+                raise ValueError("Need one description per map")
+
+        header = self.fsk.wcs.to_header()
+        header['SPARSE'] = (True, 'Maps stored on a footprint')
+        header['NX'] = (self.fsk.nx, 'Number of pixels in x')
+        header['NY'] = (self.fsk.ny, 'Number of pixels in y')
+        header['NMAPS'] = (len(maps), 'Number of maps')
+        header['FILLVAL'] = (self.fill_value, 'Value outside footprint')
+        cols = [fits.Column(name='PIXEL', format='K', array=self.ipix)]
+        if np.issubdtype(maps.dtype, np.integer):
+            fmt = 'K'
+        elif maps.dtype == np.float32:
+            fmt = 'E'
+        else:
+            fmt = 'D'
+        for im, m in enumerate(maps):
+            if descript is not None:
+                header['DESCR%d' % im] = (descript[im], 'Description')
+            cols.append(fits.Column(name='MAP_%d' % im, format=fmt,
+                                    array=m))
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=header),
+                                fits.BinTableHDU.from_columns(cols)])
+        hdulist.writeto(filename, overwrite=True)
+
+    @staticmethod
+    def get_info(header):
+        """
+        Returns the FlatMapInfo stored in the header of a sparse
+        map file.
+        """
+        # The primary HDU has no data
+        header = header.copy()
+        del header['NAXIS']
+        return FlatMapInfo(WCS(header), nx=header['NX'], ny=header['NY'])
+
+    @staticmethod
+    def read(hdul, i_map=-1):
+        """
+        Reads maps stored in sparse format (see `write`).
+        :param hdul: FITS HDUList.
+        :param i_map: map to read. If -1, all maps will be read.
+        :return: FlatMapInfo and SparseFlatMap.
+        """
+        header = hdul[0].header
+        fmi = SparseFlatMap.get_info(header)
+        data = hdul[1].data
+        if i_map == -1:
+            maps = np.array([data['MAP_%d' % im]
+                             for im in range(header['NMAPS'])])
+        else:
+            maps = np.array(data['MAP_%d' % i_map])
+        return fmi, SparseFlatMap(fmi, data['PIXEL'], maps,
+                                  fill_value=header['FILLVAL'])
+
+
+class MapStack(object):
+    def __init__(self, filename):
+        """
+        Lazy stack of maps stored in a FITS file (in dense or sparse
+        format, see `FlatMapInfo.write_flat_map`). The file is memory
+        mapped, and each map is only read when first accessed. Maps
+        in dense files are returned as read-only views of the
+        memory-mapped data, without copies.
+        :param filename: path to the FITS file.
+        """
+        self.filename = filename
+        self.hdul = fits.open(filename, memmap=True)
+        header = self.hdul[0].header
+        self.sparse = header.get('SPARSE', False)
+        if self.sparse:
+            self.fsk = SparseFlatMap.get_info(header)
+            self.nmaps = header['NMAPS']
+        else:
+            self.fsk = FlatMapInfo(WCS(header), nx=header['NAXIS1'],
+                                   ny=header['NAXIS2'])
+            self.nmaps = len(self.hdul)
+        self._maps = {}
+
+    def __len__(self):
+        return self.nmaps
+
+    def __getitem__(self, i_map):
+        """
+        Returns one of the maps as a flattened array.
+        """
+        if i_map < 0:
+            i_map += self.nmaps
+        if (i_map < 0) or (i_map >= self.nmaps):
+            raise IndexError("Map %d not in stack" % i_map)
+        if i_map not in self._maps:
+            if self.sparse:
+                data = self.hdul[1].data
+                mp = SparseFlatMap(self.fsk, data['PIXEL'],
+                                   data['MAP_%d' % i_map],
+                                   fill_value=self.hdul[0].header['FILLVAL'])
+                mp = mp.to_dense()
+            else:
+                mp = self.hdul[i_map].data.reshape(-1)
+            mp.flags.writeable = False
+            self._maps[i_map] = mp
+        return self._maps[i_map]
+
+    def __iter__(self):
+        for i_map in range(self.nmaps):
+            yield self[i_map]
+
+    def get_map_2d(self, i_map):
+        """
+        Returns one of the maps as a 2D [ny, nx] array.
+        """
+        return self[i_map].reshape([self.fsk.ny, self.fsk.nx])
+
+    def get_descriptions(self):
+        """
+        Returns the description of each map.
+        """
+        if self.sparse:
+            header = self.hdul[0].header
+            return [header.get('DESCR%d' % im, '')
+                    for im in range(self.nmaps)]
+        return [h.header.get('DESCR', '') for h in self.hdul]
+
+    def find(self, band=None, stat=None, name=None):
+        """
+        Returns the indices of the maps whose descriptions match a set
+        of keywords.
+        :param band: band (matches descriptions such as 'mean seeing-i'
+            or 'Dust, i-band').
+        :param stat: statistic (the description without its last word,
+            e.g. 'mean', 'std' or 'weighted median').
+        :param name: any other substring of the description.
+        """
+        indices = []
+        for im, d in enumerate(self.get_descriptions()):
+            if (stat is not None) and (d.rsplit(' ', 1)[0] != stat):
+                continue
+            if ((band is not None) and (not d.endswith('-'+band)) and
+                    (' '+band+'-band' not in d)):
+                continue
+            if (name is not None) and (name not in d):
+                continue
+            indices.append(im)
+        return indices
+
+    def close(self):
+        self._maps = {}
+        self.hdul.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def compare_infos(fsk1, fsk2):
     """Checks whether two FlatMapInfo objects are compatible"""
     if ((fsk1.nx != fsk2.nx) or
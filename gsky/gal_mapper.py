@@ -3,6 +3,7 @@ from .types import FitsFile, ASCIIFile
 import numpy as np
 from .flatmaps import read_flat_map
 from .map_utils import createCountsMap
+from .nz_stack import get_tomo_stacker
 from astropy.io import fits
 import os
 from .plot_utils import plot_map, plot_curves
@@ -79,38 +80,20 @@ class GalMapper(PipelineStage):
             pzs.append([bz[:-1], bz[1:], (hz+0.)/np.sum(hz+0.), ehz])
         return np.array(pzs)
 
-    def get_nz_stack(self, cat, codename):
+    def get_nz_stacks(self, cat):
         """
-        Get N(z) from pdf stacks.
+        Get N(z)s from pdf stacks for all photoz codes. The stacks
+        needed by the GalMapper and ShearMapper stages are computed in
+        a single pass over each pdf store and cached beside it (see
+        nz_stack.NzStacker).
         :param cat: object catalog
-        :param codename: photoz code name (demp, ephor,
-            ephor_ab, frankenz or nnpz).
+        :return: dictionary of N(z) arrays for each photoz code.
         """
-        from scipy.interpolate import interp1d
-
-        f = fits.open(self.pdf_files[codename])
-        p = f[1].data['pdf'][self.msk]
-        z = f[2].data['bins']
-        sumpdf = np.sum(p, axis=1)
-        pdfgood = sumpdf > 0
-
-        z_all = np.linspace(0., self.config['nz_bin_max'],
-                            self.config['nz_bin_num']+1)
-        z0 = z_all[:-1]
-        z1 = z_all[1:]
-        zm = 0.5*(z0+z1)
-        pzs = []
-        for i in range(self.nbins):
-            msk_good = (cat['tomo_bin'] == i) & pdfgood
-            hz_orig = np.sum(p[msk_good], axis=0)
-            hz_orig /= np.sum(hz_orig)
-            hzf = interp1d(z, hz_orig, bounds_error=False,
-                           fill_value=0.)
-            hzm = hzf(zm)
-
-            pzs.append([z0, z1, hzm/np.sum(hzm)])
-        f.close()
-        return np.array(pzs)
+        z_edges = np.linspace(0., self.config['nz_bin_max'],
+                              self.config['nz_bin_num']+1)
+        stacker = get_tomo_stacker(cat, self.msk, self.nbins, z_edges)
+        return {n: stacker.get_stacks(fn)['galaxies']
+                for n, fn in self.pdf_files.items()}
 
     def run(self):
         """
@@ -151,9 +134,7 @@ class GalMapper(PipelineStage):
         pzs_cosmos = self.get_nz_cosmos()
 
         logger.info("Getting pdf stacks")
-        pzs_stack = {}
-        for n in self.pdf_files.keys():
-            pzs_stack[n] = self.get_nz_stack(cat, n)
+        pzs_stack = self.get_nz_stacks(cat)
 
         logger.info("Getting number count maps")
         n_maps = self.get_nmaps(cat)
@@ -4,9 +4,10 @@ import logging
 import os
 import copy
 import scipy.interpolate
-from astropy.io import fits
 import pymaster as nmt
 from .flatmaps import read_flat_map
+from .map_cache import read_flat_map_cached, open_fits_cached
+from .bitmask import BitMask
 from .types import FitsFile, DummyFile
 import sacc
 from theory.predict_theory import GSKYPrediction
@@ -60,32 +61,32 @@ class GuessSpecter(PipelineStage) :
             trc_ind = int(trc_ind)
 
             if trc_id == 'gc':
-                fsk, mp_depth = read_flat_map(self.get_input("depth_map"),i_map=0)
+                fsk, mp_depth = read_flat_map_cached(self.get_input("depth_map"),i_map=0)
+                mp_depth = mp_depth.copy()
                 mp_depth[np.isnan(mp_depth)] = 0
                 mp_depth[mp_depth > 40] = 0
-                msk_depth = np.zeros_like(mp_depth)
-                msk_depth[mp_depth >= self.config['depth_cut']] = 1
-                fskb, mskfrac = read_flat_map(self.get_input("masked_fraction"), i_map=0)
+                msk_depth = BitMask.from_array(mp_depth >=
+                                               self.config['depth_cut'])
+                fskb, mskfrac = read_flat_map_cached(self.get_input("masked_fraction"), i_map=0)
                 # Create binary mask (fraction>threshold and depth req.)
-                msk_bo = np.zeros_like(mskfrac)
-                msk_bo[mskfrac > self.config['mask_thr']] = 1
-                msk_bi = msk_bo * msk_depth
-                mask = mskfrac * msk_bi
+                msk_bo = BitMask.from_array(mskfrac > self.config['mask_thr'])
+                msk_bi = msk_bo & msk_depth
+                mask = msk_bi.apply(mskfrac)
             elif trc_id == 'wl':
-                hdul = fits.open(self.get_input('gamma_maps'))
+                hdul = open_fits_cached(self.get_input('gamma_maps'))
                 _, mask = read_flat_map(None, hdu=[hdul[6 * trc_ind + 2]])
             elif trc_id == 'kappa':
-                hdul = fits.open(self.get_input('act_maps'))
+                hdul = open_fits_cached(self.get_input('act_maps'))
                 _, mask = read_flat_map(None, hdu=hdul[3])
             elif trc_id == 'y':
-                hdul = fits.open(self.get_input('act_maps'))
+                hdul = open_fits_cached(self.get_input('act_maps'))
                 _, mask = read_flat_map(None, hdu=hdul[1])
             else:
                 raise NotImplementedError()
 
             masks.append(mask)
 
-        fsk, _ = read_flat_map(self.get_input("masked_fraction"), i_map=0)
+        fsk, _ = read_flat_map_cached(self.get_input("masked_fraction"), i_map=0)
 
         return masks, fsk
 
@@ -0,0 +1,105 @@
+import numpy as np
+import os
+from astropy.io import fits
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def index_filename(filename):
+    """
+    Returns the path of the object_id index stored beside a catalog.
+    :param filename: path to the catalog.
+    """
+    root, _ = os.path.splitext(filename)
+    return root + '_id_index.npz'
+
+
+class IdIndex(object):
+    def __init__(self, ids, order=None):
+        """
+        Sorted index of the object ids of a catalog, used to match
+        other sets of objects to it with binary searches.
+        :param ids: object ids in catalog order.
+        :param order: permutation sorting `ids` (computed if `None`).
+        """
+        ids = np.asarray(ids)
+        if order is None:
+            order = np.argsort(ids, kind='stable')
+        self.order = order
+        self.sorted_ids = ids[order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_ids(self):
+        """
+        Returns the object ids in catalog order.
+        """
+        ids = np.empty_like(self.sorted_ids)
+        ids[self.order] = self.sorted_ids
+        return ids
+
+    def match(self, ids):
+        """
+        Finds a set of objects in the catalog.
+        :param ids: object ids to look for.
+        :return: indices in the catalog and in `ids` of the objects
+            found.
+        """
+        ids = np.asarray(ids)
+        pos = np.searchsorted(self.sorted_ids, ids)
+        pos[pos == len(self.sorted_ids)] = 0
+        found = self.sorted_ids[pos] == ids
+        return self.order[pos[found]], np.where(found)[0]
+
+    def write(self, filename, stamp=''):
+        """
+        Saves the index to a .npz file, tagged with `stamp`.
+        """
+        tmp = filename+'.tmp.npz'
+        np.savez(tmp, stamp=stamp, order=self.order,
+                 sorted_ids=self.sorted_ids)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def read(cls, filename, stamp=None):
+        """
+        Reads an index saved with `write`. Returns `None` if `stamp`
+        is not `None` and doesn't match the saved one.
+        """
+        with np.load(filename) as d:
+            if (stamp is not None) and (str(d['stamp']) != stamp):
+                return None
+            idx = cls.__new__(cls)
+            idx.order = d['order']
+            idx.sorted_ids = d['sorted_ids']
+        return idx
+
+    @classmethod
+    def from_catalog(cls, filename, column='object_id', hdu=1):
+        """
+        Returns the index of a FITS catalog, reading it from the file
+        stored beside the catalog (see `index_filename`) if it is up
+        to date, or building and saving it otherwise.
+        :param filename: path to the catalog.
+        :param column: name of the id column.
+        :param hdu: HDU containing the catalog.
+        """
+        st = os.stat(filename)
+        stamp = '%s %d %d' % (column, st.st_size, st.st_mtime_ns)
+        fname = index_filename(filename)
+        if os.path.isfile(fname):
+            idx = cls.read(fname, stamp=stamp)
+            if idx is not None:
+                return idx
+
+        logger.info("Building object_id index for " + filename)
+        with fits.open(filename, memmap=True) as hdul:
+            idx = cls(np.array(hdul[hdu].data[column]))
+        try:
+            idx.write(fname, stamp=stamp)
+        except OSError:
+            logger.warning("Couldn't save object_id index to " + fname)
+        return idx
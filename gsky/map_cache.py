@@ -0,0 +1,148 @@
+import os
+from collections import OrderedDict
+from astropy.io import fits
+from .flatmaps import read_flat_map
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MapCache(object):
+    def __init__(self, max_bytes):
+        """
+        Least-recently-used cache of objects read from files. Entries
+        are keyed by the file path and modification time (plus any
+        extra arguments), so they are invalidated if the file changes.
+        :param max_bytes: memory budget. The least recently used
+            entries are evicted once the total size of the cached
+            objects exceeds it.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get_key(self, filename, *args):
+        path = os.path.abspath(filename)
+        return (path, os.path.getmtime(path)) + args
+
+    def set_budget(self, max_bytes):
+        """
+        Changes the memory budget, evicting entries if needed.
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        for obj, _ in self.entries.values():
+            self._close(obj)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def _close(self, obj):
+        # Open files (HDULists) are closed when they leave the cache
+        if isinstance(obj, fits.HDUList):
+            obj.close()
+
+    def _evict(self):
+        while (self.nbytes > self.max_bytes) and (len(self.entries) > 0):
+            key, (obj, size) = self.entries.popitem(last=False)
+            logger.debug("Evicting %s from map cache" % str(key))
+            self._close(obj)
+            self.nbytes -= size
+
+    def get(self, key, loader):
+        """
+        Returns the cached object for `key`, or loads it.
+        :param key: cache key (see `get_key`).
+        :param loader: function returning the object to cache and
+            its size in bytes.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        obj, size = loader()
+        # Objects larger than the budget are not cached
+        if size <= self.max_bytes:
+            self.entries[key] = (obj, size)
+            self.nbytes += size
+            self._evict()
+        return obj
+
+
+# Process-wide cache. The default budget (in MB) can be set through
+# the GSKY_MAP_CACHE_MB environment variable.
+_map_cache = MapCache(int(os.environ.get('GSKY_MAP_CACHE_MB', 2048))*2**20)
+
+# Process-wide pool of open (memory-mapped) FITS files. These take
+# little memory until their data are accessed, so they are not charged
+# against the map cache budget. Instead, each of them counts as one
+# unit, and the pool is bounded by the number of open files, which can
+# be set through the GSKY_FITS_CACHE_FILES environment variable.
+_fits_cache = MapCache(max(1, int(os.environ.get('GSKY_FITS_CACHE_FILES',
+                                                 16))))
+
+
+def set_cache_budget(max_bytes):
+    """
+    Sets the memory budget of the process-wide map cache.
+    :param max_bytes: budget in bytes.
+    """
+    _map_cache.set_budget(max_bytes)
+
+
+def set_fits_cache_size(nfiles):
+    """
+    Sets the maximum number of FITS files kept open by
+    `open_fits_cached` (at least one).
+    :param nfiles: number of files.
+    """
+    _fits_cache.set_budget(max(1, int(nfiles)))
+
+
+def clear_cache():
+    """
+    Empties the process-wide map cache, closing all cached FITS files.
+    """
+    _map_cache.clear()
+    _fits_cache.clear()
+
+
+def read_flat_map_cached(filename, i_map=0):
+    """
+    Cached version of `flatmaps.read_flat_map`. The maps returned are
+    shared between callers and are therefore read-only: copy them
+    before modifying them.
+    :param filename: path to the map file.
+    :param i_map: map to read. If -1, all maps will be read.
+    :return: FlatMapInfo and map(s).
+    """
+    def loader():
+        fsk, mp = read_flat_map(filename, i_map=i_map)
+        mp.flags.writeable = False
+        return (fsk, mp), mp.nbytes
+
+    return _map_cache.get(_map_cache.get_key(filename, 'map', i_map),
+                          loader)
+
+
+def open_fits_cached(filename):
+    """
+    Cached version of `fits.open` (with memory mapping). The HDUList
+    is shared between callers, so it should not be closed, and the
+    data of its HDUs are read-only: copy them before modifying them.
+    HDULists are always kept in a pool of open files (see
+    `set_fits_cache_size`), and are closed when they are evicted from
+    it, so callers should not hold on to them while opening other
+    files (data arrays already taken from them remain valid).
+    :param filename: path to the FITS file.
+    """
+    def loader():
+        hdul = fits.open(filename, memmap=True)
+        for hdu in hdul:
+            if hdu.data is not None:
+                hdu.data.flags.writeable = False
+        return hdul, 1
+
+    return _fits_cache.get(_fits_cache.get_key(filename), loader)
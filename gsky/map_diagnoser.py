@@ -2,6 +2,7 @@ from ceci import PipelineStage
 from .types import FitsFile, DirFile
 import numpy as np
 from .flatmaps import read_flat_map, compare_infos
+from .bitmask import BitMask
 from scipy.stats import binned_statistic
 from astropy.io import fits
 import matplotlib.pyplot as plt
@@ -27,7 +28,7 @@ class MapDiagnoser(PipelineStage):
     config_options = {'nbins_syst': 10, 'n_jk': 50}
 
     def compute_stats(self, ng_map, sys_map):
-        mask = self.mskfrac*self.msk_bi
+        mask = self.msk_bi.apply(self.mskfrac)
         binmask = mask > 0
 
         # N_g/<N_g>
@@ -92,16 +93,14 @@ class MapDiagnoser(PipelineStage):
                                            i_map=0)
         mp_depth[np.isnan(mp_depth)] = 0
         mp_depth[mp_depth > 40] = 0
-        msk_depth = np.zeros_like(mp_depth)
-        msk_depth[mp_depth >= self.config['depth_cut']] = 1
+        msk_depth = BitMask.from_array(mp_depth >= self.config['depth_cut'])
 
         fskb, self.mskfrac = read_flat_map(self.get_input("masked_fraction"),
                                            i_map=0)
         compare_infos(self.fsk, fskb)
 
-        msk_bo = np.zeros_like(self.mskfrac)
-        msk_bo[self.mskfrac > self.config['mask_thr']] = 1
-        self.msk_bi = msk_bo*msk_depth
+        msk_bo = BitMask.from_array(self.mskfrac > self.config['mask_thr'])
+        self.msk_bi = msk_bo & msk_depth
 
     def get_sysmaps(self):
         print("Reading systematic maps")
@@ -119,10 +118,12 @@ class MapDiagnoser(PipelineStage):
                                                i_map=0)
         for oc in ['ccdtemp', 'airmass', 'exptime', 'skylevel',
                    'sigma_sky', 'seeing', 'ellipt', 'nvisit']:
+            # Only the maps used are read
+            _, stack = read_flat_map(self.get_input(oc+"_maps"), i_map=-1,
+                                     lazy=True)
             for i_b, b in enumerate(self.bands):
                 name = oc+'_'+b
-                _, self.temps[name] = read_flat_map(self.get_input(oc+"_maps"),
-                                                    i_map=i_b+5*self.sys_map_offset)
+                self.temps[name] = stack[i_b+5*self.sys_map_offset]
 
     def get_nmaps(self):
         hdul = fits.open(self.get_input('ngal_maps'))
@@ -1,63 +1,106 @@
 import numpy as np
 import copy
 import logging
+from .accumulators import MapAccumulator, MeanVarAccumulator
+from .mask_cleanup import clean_mask
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def createCountsMap(ra, dec, fsk):
+def _get_pixels(ra, dec, fsk, pixidx=None):
+    """
+    Returns the pixel indices of a set of objects, either projecting
+    their coordinates or from a precomputed `pixel_index.PixelIndex`.
+    """
+    if pixidx is None:
+        return fsk.pos2pix(ra, dec)
+    return pixidx.get_pixels(fsk)
+
+
+def _accumulate(ipix, weights, fsk, out=None):
+    """
+    Computes the per-pixel sums of a list of weights, or adds them to
+    `out` (see `accumulators.MapAccumulator`).
+    """
+    return MapAccumulator(fsk.get_size())(ipix, weights, out=out)
+
+
+def createCountsMap(ra, dec, fsk, pixidx=None, out=None):
     """
     Creates a map containing the number of objects in each pixel.
     :param ra: right ascension for each object.
     :param dec: declination for each object.
     :param fsk: a flatmaps.FlatMapInfo object describing the
         geometry of the output map.
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+        If provided, `ra` and `dec` are not used.
+    :param out: map to which the counts are added in place (optional).
     """
-    flatmap = fsk.pos2pix(ra, dec)
-    mp = np.bincount(flatmap[flatmap >= 0],
-                     weights=None, minlength=fsk.get_size())
+    flatmap = _get_pixels(ra, dec, fsk, pixidx)
+    if out is not None:
+        _accumulate(flatmap, [None], fsk, out=out[None, :])
+        return out
+    mp = _accumulate(flatmap, [None], fsk)[0].astype(int)
     return mp
 
 
-def createSpin2Map(ra, dec, q, u, fsk, weights=None, shearrot=None):
+def createSpin2Sums(ra, dec, q, u, fsk, weights=None, pixidx=None,
+                    out=None):
     """
-    Creates two maps containing the averages (optionally weighted)
-    of the Q, U components of a spin-2 field.
-    :param ra:
-    :param dec:
-    :param q:
-    :param u:
-    :param fsk:
-    :param weights:
-    :param shearrot:
-    :return:
+    Creates the per-pixel sums needed to build the averages of the
+    Q, U components of a spin-2 field (see `spin2FromSums`). These
+    sums are additive, so they can be computed for subsets of a
+    catalog and added together.
+    :param ra: right ascension for each object.
+    :param dec: declination for each object.
+    :param q: Q component for each object.
+    :param u: U component for each object.
+    :param fsk: a flatmaps.FlatMapInfo object describing the
+        geometry of the output map.
+    :param weights: per-object weights (or `None`).
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+        If provided, `ra` and `dec` are not used.
+    :param out: array of shape [4, npix] to which the sums are added
+        in place (optional).
+    :return: array of shape [4, npix] containing the sums of
+        w*q, w*u and w, and the number counts.
     """
-
-    flatmap = fsk.pos2pix(ra, dec)
-    id_good = flatmap >= 0
+    flatmap = _get_pixels(ra, dec, fsk, pixidx)
+    q = np.asarray(q)
+    u = np.asarray(u)
 
     if weights is not None:
-        q = weights*copy.deepcopy(q)
-        u = weights*copy.deepcopy(u)
-
-    qmap = np.bincount(flatmap[id_good],
-                       weights=q[id_good],
-                       minlength=fsk.get_size())
-    umap = np.bincount(flatmap[id_good],
-                       weights=u[id_good],
-                       minlength=fsk.get_size())
-    weightsmap = np.bincount(flatmap[id_good],
-                             weights=weights,
-                             minlength=fsk.get_size())
-    nmap = np.bincount(flatmap[id_good],
-                       weights=None,
-                       minlength=fsk.get_size())
+        w = np.asarray(weights)
+        sums = _accumulate(flatmap, [(w, q), (w, u), w, None], fsk, out=out)
+    elif out is not None:
+        sums = _accumulate(flatmap, [q, u, None, None], fsk, out=out)
+    else:
+        sums = _accumulate(flatmap, [q, u, None], fsk)
+        sums = np.vstack([sums, sums[2]])
+    return sums
+
+
+def spin2FromSums(sums, weighted=True, shearrot=None):
+    """
+    Turns the per-pixel sums produced by `createSpin2Sums` into
+    maps of the averages of the Q, U components of a spin-2 field.
+    :param sums: [4, npix] array of sums.
+    :param weighted: whether the sums were computed with weights.
+    :param shearrot: shear transformation to apply (noflip, flipq,
+        flipu or flipqu).
+    :return: maps of Q and U and masks (weight mask, binary mask
+        and number counts).
+    """
+    qmap = sums[0].copy()
+    umap = sums[1].copy()
+    weightsmap = sums[2].copy()
+    nmap = sums[3].copy()
 
     qmap[weightsmap != 0] /= weightsmap[weightsmap != 0]
     umap[weightsmap != 0] /= weightsmap[weightsmap != 0]
 
-    if weights is not None:
+    if weighted:
         logger.info('Weights provided.')
         logger.info('Computing weightmask.')
         weightmask = weightsmap
@@ -100,7 +143,9 @@ def createSpin2Map(ra, dec, q, u, fsk, weights=None, shearrot=None):
 
     return mp, ms
 
-def createW2QU2Map(ra, dec, q, u, fsk, weights=None):
+
+def createSpin2Map(ra, dec, q, u, fsk, weights=None, shearrot=None,
+                   pixidx=None):
     """
     Creates two maps containing the averages (optionally weighted)
     of the Q, U components of a spin-2 field.
@@ -111,25 +156,43 @@ def createW2QU2Map(ra, dec, q, u, fsk, weights=None):
     :param fsk:
     :param weights:
     :param shearrot:
+    :param pixidx:
     :return:
     """
+    sums = createSpin2Sums(ra, dec, q, u, fsk, weights=weights,
+                           pixidx=pixidx)
+    return spin2FromSums(sums, weighted=weights is not None,
+                         shearrot=shearrot)
 
-    flatmap = fsk.pos2pix(ra, dec)
-    id_good = flatmap >= 0
+def createW2QU2Map(ra, dec, q, u, fsk, weights=None, pixidx=None):
+    """
+    Creates two maps containing the averages (optionally weighted)
+    of the Q, U components of a spin-2 field.
+    :param ra:
+    :param dec:
+    :param q:
+    :param u:
+    :param fsk:
+    :param weights:
+    :param shearrot:
+    :param pixidx:
+    :return:
+    """
+
+    flatmap = _get_pixels(ra, dec, fsk, pixidx)
+    q = np.asarray(q)
+    u = np.asarray(u)
+    w = np.asarray(weights)
 
-    w2q2map = np.bincount(flatmap[id_good],
-                       weights=q[id_good]**2*weights[id_good]**2,
-                       minlength=fsk.get_size())
-    w2u2map = np.bincount(flatmap[id_good],
-                       weights=u[id_good]**2*weights[id_good]**2,
-                       minlength=fsk.get_size())
+    w2q2map, w2u2map = _accumulate(flatmap, [(q, q, w, w), (u, u, w, w)],
+                                   fsk)
 
     mp = [w2q2map, w2u2map]
 
     return mp
 
 
-def createW2QU2Map(ra, dec, q, u, fsk, weights=None):
+def createW2QU2Map(ra, dec, q, u, fsk, weights=None, pixidx=None):
     """
     Creates two maps containing the averages (optionally weighted)
     of the Q, U components of a spin-2 field.
@@ -140,79 +203,146 @@ def createW2QU2Map(ra, dec, q, u, fsk, weights=None):
     :param fsk:
     :param weights:
     :param shearrot:
+    :param pixidx:
     :return:
     """
 
-    flatmap = fsk.pos2pix(ra, dec)
-    id_good = flatmap >= 0
+    flatmap = _get_pixels(ra, dec, fsk, pixidx)
+    q = np.asarray(q)
+    u = np.asarray(u)
+    w = np.asarray(weights)
 
-    w2q2map = np.bincount(flatmap[id_good],
-                       weights=q[id_good]**2*weights[id_good]**2,
-                       minlength=fsk.get_size())
-    w2u2map = np.bincount(flatmap[id_good],
-                       weights=u[id_good]**2*weights[id_good]**2,
-                       minlength=fsk.get_size())
+    w2q2map, w2u2map = _accumulate(flatmap, [(q, q, w, w), (u, u, w, w)],
+                                   fsk)
 
     mp = [w2q2map, w2u2map]
 
     return mp
 
 
-def createMeanStdMaps(ra, dec, quantity, fsk):
+def createMeanStdSums(ra, dec, quantity, fsk, pixidx=None, weights=None,
+                      sums=None):
     """
-    Creates maps of the mean and standard deviation of a given quantity
-    measured at the position of a number of objects.
+    Accumulates the per-pixel statistics needed to compute the mean and
+    standard deviation of a given quantity (see `meanStdFromSums`).
+    Statistics computed for subsets of a catalog can be merged with
+    `+=`, giving the same result as a single pass over all objects.
     :param ra: right ascension for each object.
     :param dec: declination for each object.
-    :param quantity: measurements of the quantity to map for each object.
+    :param quantity: measurements of the quantity to map for each object
+        (or list of arrays, for several quantities).
     :param fsk: a flatmaps.FlatMapInfo object describing the geometry of
         the output map.
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+        If provided, `ra` and `dec` are not used.
+    :param weights: per-object weights (or `None`).
+    :param sums: accumulators.MeanVarAccumulator to update (optional).
+        If `None`, a new one is created.
+    :return: an accumulators.MeanVarAccumulator.
     """
-    pix_ids = fsk.pos2pix(ra, dec)
-    id_good = pix_ids >= 0
-    mp = np.bincount(pix_ids[id_good],
-                     weights=None,
-                     minlength=fsk.get_size())
-    mpW = np.bincount(pix_ids[id_good],
-                      weights=quantity[id_good],
-                      minlength=fsk.get_size())
-    mpWSq = np.bincount(pix_ids[id_good],
-                        weights=quantity[id_good]**2,
-                        minlength=fsk.get_size())
+    pix_ids = _get_pixels(ra, dec, fsk, pixidx)
+    if sums is None:
+        nq = len(quantity) if isinstance(quantity, list) else 1
+        sums = MeanVarAccumulator(fsk.get_size(), nquantities=nq)
+    return sums.add(pix_ids, quantity, weights=weights)
+
+
+def meanStdFromSums(sums, iq=0):
+    """
+    Turns the per-pixel statistics produced by `createMeanStdSums` into
+    maps of the mean and standard deviation (of the mean, i.e. the
+    standard deviation of the quantity divided by sqrt(N)).
+    :param sums: accumulators.MeanVarAccumulator.
+    :param iq: index of the quantity to map.
+    """
+    mp = sums.n
     idgood = np.where(mp > 0)[0]
     mean = np.zeros(len(mp))
     std = np.zeros(len(mp))
-    mean[idgood] = mpW[idgood]/mp[idgood]
-    std[idgood] = np.sqrt(np.fabs(((mpWSq[idgood]/mp[idgood]) -
-                                   mean[idgood]**2)/(mp[idgood]+0.)))
-    idbad = np.where(mp <= 0)[0]
-    mean[idbad] = 0
-    std[idbad] = 0
+    mean[idgood] = sums.mean[iq][idgood]
+    std[idgood] = np.sqrt(sums.get_variance()[iq][idgood] /
+                          (mp[idgood]+0.))
 
     return mean, std
 
 
-def createMask(ra, dec, flags, flatsky_base, reso_mask):
+def createMeanStdMaps(ra, dec, quantity, fsk, pixidx=None, weights=None):
     """
-    Creates a mask based on the position of random objects and a set
-    of flags.
+    Creates maps of the mean and standard deviation of a given quantity
+    measured at the position of a number of objects.
     :param ra: right ascension for each object.
     :param dec: declination for each object.
-    :param flags: list of arrays containing the flags used to mask
-        areas of the sky. pixels containing objects with any
-        flags=True will be masked. Pass [] if you just want to
-        define a mask based on object positions.
-    :param flatsky_base: FlatMapInfo for the base mask, defined by
-        the presence of not of object in pixels defined by this
-        FlatMapInfo
+    :param quantity: measurements of the quantity to map for each object.
+    :param fsk: a flatmaps.FlatMapInfo object describing the geometry of
+        the output map.
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+        If provided, `ra` and `dec` are not used.
+    :param weights: per-object weights (or `None`).
+    """
+    return meanStdFromSums(createMeanStdSums(ra, dec, quantity, fsk,
+                                             pixidx=pixidx,
+                                             weights=weights))
+
+
+def getMaskInfo(flatsky_base, reso_mask):
+    """
+    Returns the FlatMapInfo of a mask with resolution `reso_mask`
+    built on top of the base pixelization `flatsky_base`.
+    :param flatsky_base: FlatMapInfo for the base mask.
     :param reso_mask: resolution of the final mask (dx or dy)
-    :return: mask and associated FlatMapInfo
     """
-    from scipy.ndimage import label
+    if np.fabs(reso_mask) > np.fabs(flatsky_base.dx):
+        fsg, _ = flatsky_base.d_grade(flatsky_base.get_empty_map(),
+                                      int(np.fabs(reso_mask /
+                                                  flatsky_base.dx)+0.5))
+    else:
+        fsg, _ = flatsky_base.u_grade(flatsky_base.get_empty_map(),
+                                      int(np.fabs(flatsky_base.dx /
+                                                  reso_mask)+0.5),
+                                      view=True)
+    return fsg
+
+
+def createFlagsMap(ra, dec, flags, fsk, pixidx=None, out=None):
+    """
+    Creates a map containing the number of flagged objects in each
+    pixel. Objects are flagged if any of the input flags is True.
+    :param ra: right ascension for each object.
+    :param dec: declination for each object.
+    :param flags: list of arrays containing the flags.
+    :param fsk: a flatmaps.FlatMapInfo object describing the
+        geometry of the output map.
+    :param pixidx: pixel_index.PixelIndex for these objects (optional).
+        If provided, `ra` and `dec` are not used.
+    :param out: map to which the counts are added in place (optional).
+    """
+    if pixidx is None:
+        flagged = np.zeros(len(ra), dtype=bool)
+    else:
+        flagged = np.zeros(len(pixidx), dtype=bool)
+    for flag in flags:
+        flagged |= np.asarray(flag, dtype=bool)
+    if pixidx is None:
+        return createCountsMap(np.asarray(ra)[flagged],
+                               np.asarray(dec)[flagged], fsk, out=out)
+    return createCountsMap(None, None, fsk, pixidx=pixidx.select(flagged),
+                           out=out)
+
+
+def maskFromCounts(mpr, mpflag, flatsky_base, fsg):
+    """
+    Creates a mask from the number counts of objects on a base
+    pixelization and the counts of flagged objects on the
+    pixelization of the mask (see `createMask`).
+    :param mpr: number counts map on `flatsky_base`.
+    :param mpflag: counts of flagged objects on `fsg`.
+    :param flatsky_base: FlatMapInfo for the base mask.
+    :param fsg: FlatMapInfo for the final mask.
+    :return: mask
+    """
     fsg0 = flatsky_base
 
     # Create mask based on object positions
-    mpr = createCountsMap(ra, dec, fsg0)
     mskr = np.zeros(fsg0.get_size())
     mskr[mpr > 0] = 1
 
@@ -221,44 +351,57 @@ def createMask(ra, dec, flags, flatsky_base, reso_mask):
                       'be too high %.1lf' %
                       (np.sum(mpr*mskr)/np.sum(mskr)))
 
-    if np.fabs(reso_mask) > np.fabs(fsg0.dx):
-        fsg, mpn = fsg0.d_grade(mpr,
-                                int(np.fabs(reso_mask/fsg0.dx)+0.5))
+    # Pixels of the final mask containing objects
+    if np.fabs(fsg.dx) > np.fabs(fsg0.dx):
+        _, mpn = fsg0.d_grade(mskr, int(np.fabs(fsg.dx/fsg0.dx)+0.5),
+                              reducer='max')
     else:
-        fsg, mpn = fsg0.u_grade(mpr,
-                                int(np.fabs(fsg0.dx/reso_mask)+0.5))
+        _, mpn = fsg0.u_grade(mskr, int(np.fabs(fsg0.dx/fsg.dx)+0.5))
 
-    mskn = np.zeros(fsg.get_size())
-    mskn[mpn > 0] = 1
-    ipix = fsg.pos2pix(ra, dec)
-    for flag in flags:
-        ipixmask = ipix[flag]
-        p = np.unique(ipixmask)
-        mskn[p] = 0
-
-    # Classify all connected regions
-    msk2d = mskn.astype(int).reshape([fsg.ny, fsg.nx])
-    labeled_array, num_features = label(msk2d)
-    # Identify largest connected region (0 is background)
-    i0 = np.argmax(np.histogram(labeled_array,
-                                bins=num_features+1,
-                                range=[-0.5, num_features+0.5])[0][1:])+1
-    # Remove all other regions
-    mask_clean = labeled_array.copy().flatten()
-    mask_clean[mask_clean != i0] = 0
-    msk_out = mask_clean.astype(float)
+    mskn = mpn
+    mskn[mpflag > 0] = 0
+
+    # Keep only the largest connected region
+    msk_out = clean_mask(mskn, fsg.nx, fsg.ny).astype(float)
+
+    return msk_out
+
+
+def createMask(ra, dec, flags, flatsky_base, reso_mask):
+    """
+    Creates a mask based on the position of random objects and a set
+    of flags.
+    :param ra: right ascension for each object.
+    :param dec: declination for each object.
+    :param flags: list of arrays containing the flags used to mask
+        areas of the sky. pixels containing objects with any
+        flags=True will be masked. Pass [] if you just want to
+        define a mask based on object positions.
+    :param flatsky_base: FlatMapInfo for the base mask, defined by
+        the presence of not of object in pixels defined by this
+        FlatMapInfo
+    :param reso_mask: resolution of the final mask (dx or dy)
+    :return: mask and associated FlatMapInfo
+    """
+    fsg = getMaskInfo(flatsky_base, reso_mask)
+    mpr = createCountsMap(ra, dec, flatsky_base)
+    mpflag = createFlagsMap(ra, dec, flags, fsg)
+    msk_out = maskFromCounts(mpr, mpflag, flatsky_base, fsg)
 
     return msk_out, fsg
 
 
-def removeDisconnected(mp, fsk):
-    from scipy.ndimage import label
-    labeled_array, num_features = label(mp.reshape([fsk.ny, fsk.nx]))
-    i0 = np.argmax(np.histogram(labeled_array,
-                                bins=num_features+1,
-                                range=[-0.5, num_features+0.5])[0][1:])+1
-    mask_clean = labeled_array.copy().flatten()
+def removeDisconnected(mp, fsk, top_k=1, min_size=None):
+    """
+    Sets to zero all pixels of a map outside its largest connected
+    region of non-zero pixels (see `mask_cleanup.clean_mask`).
+    :param mp: input map.
+    :param fsk: FlatMapInfo describing the map geometry.
+    :param top_k: number of regions to keep.
+    :param min_size: minimum number of pixels of the regions kept.
+    """
+    keep = clean_mask(mp, fsk.nx, fsk.ny, top_k=top_k, min_size=min_size)
     mpo = mp.copy()
-    mpo[mask_clean != i0] = 0
+    mpo[~keep] = 0
 
     return mpo
@@ -0,0 +1,139 @@
+import numpy as np
+from scipy.ndimage import label
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from .bitmask import BitMask
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _get_tile_rows(tile_rows, ny):
+    # Tiles start at multiples of 8 rows, so that they start on a byte
+    # boundary of a packed mask.
+    if tile_rows is None:
+        return ny
+    return max(8*((int(tile_rows)+7)//8), 8)
+
+
+def _read_tile(mask, nx, iy0, iy1):
+    if isinstance(mask, BitMask):
+        p0 = iy0*nx
+        p1 = iy1*nx
+        tile = np.unpackbits(mask.bits[p0//8:(p1+7)//8],
+                             count=p1-p0).view(bool)
+    else:
+        tile = mask[iy0*nx:iy1*nx] != 0
+    return tile.reshape([iy1-iy0, nx])
+
+
+def _iter_tiles(mask, nx, ny, tile_rows):
+    nrows = _get_tile_rows(tile_rows, ny)
+    for iy0 in range(0, ny, nrows):
+        iy1 = min(iy0+nrows, ny)
+        yield iy0, iy1, _read_tile(mask, nx, iy0, iy1)
+
+
+def get_regions(mask, nx, ny, tile_rows=1024):
+    """
+    Finds the connected regions of a mask (using the same
+    4-connectivity as `scipy.ndimage.label`). The mask is labelled
+    in tiles of `tile_rows` rows, and regions crossing tile boundaries
+    are joined afterwards, so that no full-size label array is ever
+    created.
+    :param mask: BitMask or flattened map (non-zero pixels belong to
+        the mask) with `nx*ny` pixels.
+    :param nx, ny: map dimensions.
+    :param tile_rows: number of rows in each tile (rounded up to a
+        multiple of 8). If `None`, the whole mask is labelled at once.
+    :return: array with the region index of each tile label (in
+        tile order), and array with the number of pixels of each
+        region. Regions are sorted by their first pixel.
+    """
+    sizes = []
+    links = []
+    offset = 0
+    last_row = None
+    for iy0, iy1, tile in _iter_tiles(mask, nx, ny, tile_rows):
+        lab, nlab = label(tile)
+        sizes.append(np.bincount(lab.ravel(), minlength=nlab+1)[1:])
+        # Labels touching across the tile boundary
+        if last_row is not None:
+            first_row = lab[0]
+            joint = (last_row > 0) & (first_row > 0)
+            links.append(np.array([last_row[joint]-1,
+                                   first_row[joint]+offset-1]))
+        last_row = np.where(lab[-1] > 0, lab[-1]+offset, 0)
+        offset += nlab
+    sizes = np.concatenate(sizes)
+
+    if len(links) > 0:
+        links = np.concatenate(links, axis=1)
+    else:
+        links = np.zeros([2, 0], dtype=int)
+    graph = coo_matrix((np.ones(links.shape[1]), (links[0], links[1])),
+                       shape=(offset, offset))
+    _, regions = connected_components(graph, directed=False)
+    region_sizes = np.bincount(regions, weights=sizes).astype(int)
+    return regions, region_sizes
+
+
+def select_regions(region_sizes, top_k=1, min_size=None):
+    """
+    Selects regions by size.
+    :param region_sizes: number of pixels in each region.
+    :param top_k: number of regions to keep, starting from the largest
+        one (ties are broken in favour of the first region). If `None`,
+        all regions are kept.
+    :param min_size: minimum number of pixels of the regions kept.
+    :return: boolean array, True for the regions to keep.
+    """
+    keep = np.ones(len(region_sizes), dtype=bool)
+    if top_k is not None:
+        order = np.argsort(-region_sizes, kind='stable')
+        keep[:] = False
+        keep[order[:top_k]] = True
+    if min_size is not None:
+        keep &= region_sizes >= min_size
+    return keep
+
+
+def clean_mask(mask, nx, ny, top_k=1, min_size=None, tile_rows=1024):
+    """
+    Removes small disconnected regions from a mask.
+    :param mask: BitMask or flattened map (non-zero pixels belong to
+        the mask) with `nx*ny` pixels. BitMasks are modified in place.
+    :param nx, ny: map dimensions.
+    :param top_k: number of regions to keep, starting from the largest
+        one. If `None`, all regions are kept (subject to `min_size`).
+    :param min_size: minimum number of pixels of the regions kept.
+    :param tile_rows: number of rows processed at once (see
+        `get_regions`).
+    :return: the cleaned BitMask if `mask` is a BitMask. Otherwise,
+        a boolean array that is True for the pixels kept.
+    """
+    regions, region_sizes = get_regions(mask, nx, ny, tile_rows=tile_rows)
+    keep_region = select_regions(region_sizes, top_k=top_k,
+                                 min_size=min_size)
+    logger.debug("Keeping %d out of %d regions" %
+                 (np.sum(keep_region), len(region_sizes)))
+    # Whether to keep each tile label (index 0 is the background)
+    keep_label = np.append(False, keep_region[regions])
+
+    if isinstance(mask, BitMask):
+        out = mask
+    else:
+        out = np.zeros(nx*ny, dtype=bool)
+    # Second pass: label tiles again and keep the selected regions
+    offset = 0
+    for iy0, iy1, tile in _iter_tiles(mask, nx, ny, tile_rows):
+        lab, nlab = label(tile)
+        keep_tile = keep_label[np.where(lab > 0, lab+offset, 0)].ravel()
+        if isinstance(mask, BitMask):
+            p0 = iy0*nx
+            out.bits[p0//8:(iy1*nx+7)//8] = np.packbits(keep_tile)
+        else:
+            out[iy0*nx:iy1*nx] = keep_tile
+        offset += nlab
+    return out
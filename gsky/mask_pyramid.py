@@ -0,0 +1,134 @@
+import numpy as np
+import os
+from astropy.io import fits
+from .flatmaps import read_flat_map
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def pyramid_filename(filename):
+    """
+    Returns the path of the pyramid file stored beside a map file.
+    :param filename: path to the map file.
+    """
+    root, ext = os.path.splitext(filename)
+    return root + '_pyramid' + ext
+
+
+class MaskPyramid(object):
+    def __init__(self, fsk, mp, weights=None):
+        """
+        Multi-resolution version of a mask or masked-fraction map.
+        All coarser levels are computed from the finest one by
+        averaging blocks of pixels (see `FlatMapInfo.d_grade`), so that
+        each level holds the fraction of its pixels covered by the
+        finest mask. Levels are computed once and cached.
+        :param fsk: FlatMapInfo describing the finest level.
+        :param mp: map at the finest level.
+        :param weights: optional weights for the block averages
+            (e.g. the footprint of a masked-fraction map).
+        """
+        self.fsk = fsk
+        self.mp = mp
+        self.weights = weights
+        self.levels = {1: (fsk, mp)}
+
+    def get_factor(self, res, exact=False):
+        """
+        Returns the down-grading factor of the level closest to
+        resolution `res`.
+        :param res: pixel size (dx or dy) in degrees.
+        :param exact: if True, raise an error if `res` is not an
+            integer multiple of the finest resolution. Otherwise, a
+            warning is issued.
+        """
+        ratio = np.fabs(res/self.fsk.dx)
+        fac = int(ratio+0.5)
+        if fac < 1:
+            raise ValueError("Resolution %lf is finer than the base "
+                             "level of the pyramid" % res)
+        if np.fabs(fac-ratio) > 1E-3*ratio:
+            msg = ("Resolution %lf is not a multiple of the base "
+                   "resolution %lf. Closest level has resolution %lf" %
+                   (np.fabs(res), np.fabs(self.fsk.dx),
+                    fac*np.fabs(self.fsk.dx)))
+            if exact:
+                raise ValueError(msg)
+            logger.warning(msg)
+        return fac
+
+    def get_level(self, factor):
+        """
+        Returns the FlatMapInfo and map of a given level.
+        :param factor: down-grading factor with respect to the
+            finest level.
+        """
+        factor = int(factor)
+        if factor not in self.levels:
+            logger.debug("Computing mask level %d" % factor)
+            self.levels[factor] = self.fsk.d_grade(self.mp, factor,
+                                                   weights=self.weights)
+        return self.levels[factor]
+
+    def get_level_res(self, res):
+        """
+        Returns the FlatMapInfo and map of the level with resolution
+        `res` (in degrees), which must be an integer multiple of the
+        finest resolution.
+        """
+        return self.get_level(self.get_factor(res, exact=True))
+
+    def write(self, filename, factors=None):
+        """
+        Saves the pyramid to a FITS file. The first HDU contains the
+        finest level (so the file can also be read with
+        `flatmaps.read_flat_map`) and each extension contains a coarser
+        level, identified by its 'DGFAC' keyword.
+        :param factors: levels to save (computing them if needed). If
+            `None`, all levels computed so far are saved.
+        """
+        if factors is None:
+            factors = sorted(self.levels.keys())
+        factors = [1] + sorted(set(int(f) for f in factors) - set([1]))
+        hdus = []
+        for fac in factors:
+            fsl, mpl = self.get_level(fac)
+            head = fsl.wcs.to_header()
+            head['DGFAC'] = (fac, 'Down-grading factor')
+            data = mpl.reshape([fsl.ny, fsl.nx])
+            if fac == 1:
+                hdus.append(fits.PrimaryHDU(data=data, header=head))
+            else:
+                hdus.append(fits.ImageHDU(data=data, header=head))
+        fits.HDUList(hdus).writeto(filename, overwrite=True)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Reads a pyramid written by `write`. A plain map file is read
+        as a single-level pyramid.
+        :param filename: path to the pyramid file.
+        """
+        with fits.open(filename) as hdul:
+            fsk, mp = read_flat_map(None, hdu=hdul[0])
+            pyr = cls(fsk, mp)
+            for h in hdul[1:]:
+                if 'DGFAC' not in h.header:
+                    continue
+                pyr.levels[h.header['DGFAC']] = read_flat_map(None, hdu=h)
+        return pyr
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Returns the pyramid of a map file, reading the pyramid saved
+        beside it if present (see `pyramid_filename`).
+        :param filename: path to the map file.
+        """
+        fname = pyramid_filename(filename)
+        if os.path.isfile(fname):
+            return cls.read(fname)
+        return cls(*read_flat_map(filename))
+
@@ -4,7 +4,8 @@ import numpy as np
 import os
 import sacc
 from .types import FitsFile, DummyFile
-from gsky.flatmaps import read_flat_map
+from gsky.map_cache import read_flat_map_cached
+from gsky.bitmask import BitMask
 from gsky.sims_gauss.MockSurvey import MockSurvey
 
 logging.basicConfig(level=logging.INFO)
@@ -57,20 +58,21 @@ class MockGen(PipelineStage) :
         logger.info('Generating galaxy_density mask.')
 
         # Depth-based mask
-        fsk, mp_depth = read_flat_map(self.get_input("depth_map"), i_map=0)
+        fsk, mp_depth = read_flat_map_cached(self.get_input("depth_map"),
+                                             i_map=0)
+        mp_depth = mp_depth.copy()
         mp_depth[np.isnan(mp_depth)] = 0
         mp_depth[mp_depth > 40] = 0
-        msk_depth = np.zeros_like(mp_depth)
-        msk_depth[mp_depth >= self.config['depth_cut']] = 1
+        msk_depth = BitMask.from_array(mp_depth >= self.config['depth_cut'])
 
-        _, mskfrac = read_flat_map(self.get_input("masked_fraction"), i_map=0)
+        _, mskfrac = read_flat_map_cached(self.get_input("masked_fraction"),
+                                          i_map=0)
 
         # Create binary mask (fraction>threshold and depth req.)
-        msk_bo = np.zeros_like(mskfrac)
-        msk_bo[mskfrac > self.config['mask_thr']] = 1
-        msk_bi = msk_bo * msk_depth
+        msk_bo = BitMask.from_array(mskfrac > self.config['mask_thr'])
+        msk_bi = msk_bo & msk_depth
 
-        weight = mskfrac * msk_bi
+        weight = msk_bi.apply(mskfrac)
 
         return fsk, weight, msk_bi, mskfrac
 
@@ -123,19 +125,19 @@ class MockGen(PipelineStage) :
                 if 'weightmask' in self.config.keys():
                     if self.config['weightmask'] == 1:
                         logger.info('Using weightmask.')
-                        fsk_temp, mask_temp = read_flat_map(self.get_input('gamma_maps'), i_map=6*i_bin+2)
+                        fsk_temp, mask_temp = read_flat_map_cached(self.get_input('gamma_maps'), i_map=6*i_bin+2)
                     else:
                         logger.info('Using binary mask.')
-                        fsk_temp, mask_temp = read_flat_map(self.get_input('gamma_maps'), i_map=6*i_bin+3)
+                        fsk_temp, mask_temp = read_flat_map_cached(self.get_input('gamma_maps'), i_map=6*i_bin+3)
                 else:
                     logger.info('weightmask keyword not provided. Using default weightmask.')
-                    fsk_temp, mask_temp = read_flat_map(self.get_input('gamma_maps'), i_map=6 * i_bin + 2)
+                    fsk_temp, mask_temp = read_flat_map_cached(self.get_input('gamma_maps'), i_map=6 * i_bin + 2)
             elif probe == 'galaxy_density':
                 fsk_temp, mask_temp, _, _ = self.get_galaxy_mask()
             elif probe == 'cmb_tSZ':
-                fsk_temp, mask_temp = read_flat_map(self.get_input('act_maps'), i_map=1)
+                fsk_temp, mask_temp = read_flat_map_cached(self.get_input('act_maps'), i_map=1)
             elif probe == 'cmb_convergence':
-                fsk_temp, mask_temp = read_flat_map(self.get_input('act_maps'), i_map=3)
+                fsk_temp, mask_temp = read_flat_map_cached(self.get_input('act_maps'), i_map=3)
             else:
                 raise NotImplementedError('Only tracer types galaxy_density, galaxy_shear, cmb_tSZ and cmb_convergence'\
                                           ' supported.')
@@ -154,7 +156,7 @@ class MockGen(PipelineStage) :
         if 'galaxy_density' in self.config['probes']:
             _, mask, msk_bi, mskfrac = self.get_galaxy_mask()
             noiseparams['galaxy_density_mask'] = mask
-            noiseparams['galaxy_density_msk_bi'] = msk_bi
+            noiseparams['galaxy_density_msk_bi'] = msk_bi.to_float()
             noiseparams['galaxy_density_mskfrac'] = mskfrac
 
         if self.config['theory_sacc'] != 'NONE':
@@ -0,0 +1,202 @@
+import numpy as np
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from scipy.sparse import csr_matrix
+from .pdf_store import PDFStore
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_interp_matrix(x, x_new):
+    """
+    Returns the sparse matrix M such that M.dot(y) linearly interpolates
+    the function sampled at `x` onto `x_new`, with zeros outside the
+    range of `x` (as `scipy.interpolate.interp1d` with
+    `bounds_error=False` and `fill_value=0`).
+    :param x: increasing sampling points.
+    :param x_new: interpolation points.
+    """
+    x = np.asarray(x, dtype=float)
+    x_new = np.asarray(x_new, dtype=float)
+    inside = np.where((x_new >= x[0]) & (x_new <= x[-1]))[0]
+    i0 = np.clip(np.searchsorted(x, x_new[inside], side='left')-1,
+                 0, len(x)-2)
+    t = (x_new[inside]-x[i0])/(x[i0+1]-x[i0])
+    rows = np.concatenate([inside, inside])
+    cols = np.concatenate([i0, i0+1])
+    return csr_matrix((np.concatenate([1-t, t]), (rows, cols)),
+                      shape=(len(x_new), len(x)))
+
+
+def _get_grouping_key(stamp, labels, nlabels, weights):
+    h = hashlib.sha1()
+    h.update(('%s %d' % (stamp, nlabels)).encode())
+    h.update(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    if weights is not None:
+        h.update(np.ascontiguousarray(weights, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def stacks_filename(filename):
+    """
+    Returns the path of the stack cache stored beside a pdf store.
+    :param filename: path to the pdf store.
+    """
+    root, _ = os.path.splitext(filename)
+    return root + '_nz_stacks.npz'
+
+
+class NzStacker(object):
+    def __init__(self, z_edges):
+        """
+        Computes redshift distributions by stacking the pdfs of groups
+        of objects. Any number of groupings (e.g. tomographic bins with
+        different weighting schemes) can be registered with
+        `add_grouping`, and all of them are computed in a single pass
+        over each pdf store. The stacks are then interpolated onto the
+        output redshift grid with a precomputed sparse matrix.
+        :param z_edges: edges of the output redshift bins.
+        """
+        self.z_edges = np.asarray(z_edges, dtype=float)
+        self.groupings = OrderedDict()
+        self._interp = {}
+
+    def add_grouping(self, name, labels, nlabels, weights=None):
+        """
+        Registers a grouping of the rows of the pdf stores.
+        :param name: name of the grouping.
+        :param labels: group of each row (rows with labels outside
+            [0, nlabels) are ignored).
+        :param nlabels: number of groups.
+        :param weights: weight of each row (optional).
+        """
+        self.groupings[name] = (np.asarray(labels), nlabels, weights)
+
+    def get_interp_matrix(self, z):
+        key = np.asarray(z, dtype=float).tobytes()
+        if key not in self._interp:
+            zm = 0.5*(self.z_edges[:-1]+self.z_edges[1:])
+            self._interp[key] = get_interp_matrix(z, zm)
+        return self._interp[key]
+
+    def get_sums(self, filename, cache=True):
+        """
+        Returns the raw pdf sums (on the native redshift sampling of the
+        store) of each grouping for the pdf store in `filename`.
+        :param cache: if True, sums are saved to and read from a file
+            stored beside the pdf store (see `stacks_filename`), so that
+            they can be reused by other stages. Cached sums are keyed by
+            the store's size and modification time and by the grouping's
+            labels and weights.
+        :return: redshift sampling, and ordered dictionary of arrays with
+            shape [nlabels, nz] for each grouping.
+        """
+        st = os.stat(filename)
+        stamp = '%d %d' % (st.st_size, st.st_mtime_ns)
+        keys = {name: _get_grouping_key(stamp, *g)
+                for name, g in self.groupings.items()}
+
+        fname = stacks_filename(filename)
+        cached = {}
+        if cache and os.path.isfile(fname):
+            try:
+                with np.load(fname) as d:
+                    cached = {k[4:]: (str(d[k]), d['sums_'+k[4:]])
+                              for k in d.files if k.startswith('key_')}
+            except Exception:
+                # Unreadable caches (e.g. truncated files) are recomputed
+                logger.warning("Couldn't read pdf stacks from " + fname)
+                cached = {}
+
+        sums = OrderedDict()
+        todo = []
+        for name in self.groupings:
+            if (name in cached) and (cached[name][0] == keys[name]):
+                sums[name] = cached[name][1]
+            else:
+                todo.append(name)
+
+        store = PDFStore.read(filename)
+        if len(todo) > 0:
+            logger.info("Stacking pdfs from " + filename)
+            new = store.sum_by_labels([self.groupings[n] for n in todo])
+            for name, s in zip(todo, new):
+                sums[name] = s
+            if cache:
+                for name in todo:
+                    cached[name] = (keys[name], sums[name])
+                tosave = {}
+                for name, (k, s) in cached.items():
+                    tosave['key_'+name] = k
+                    tosave['sums_'+name] = s
+                # Unique temporary file, so that concurrent stages
+                # don't overwrite each other's output.
+                tmp = None
+                try:
+                    with tempfile.NamedTemporaryFile(
+                            dir=os.path.dirname(os.path.abspath(fname)),
+                            suffix='.tmp.npz', delete=False) as f:
+                        tmp = f.name
+                        np.savez(f, **tosave)
+                    os.replace(tmp, fname)
+                except OSError:
+                    logger.warning("Couldn't save pdf stacks to " + fname)
+                    if (tmp is not None) and os.path.isfile(tmp):
+                        os.remove(tmp)
+        sums = OrderedDict((n, sums[n]) for n in self.groupings)
+        return np.array(store.bins), sums
+
+    def get_stacks(self, filename, cache=True):
+        """
+        Returns the normalized redshift distributions of each grouping
+        for the pdf store in `filename` (see `get_sums`).
+        :return: ordered dictionary of arrays with shape [nlabels, 3, nz]
+            for each grouping, containing the lower and upper edges of
+            the output redshift bins and the distribution of each group.
+        """
+        z, sums = self.get_sums(filename, cache=cache)
+        mat = self.get_interp_matrix(z)
+        z0 = self.z_edges[:-1]
+        z1 = self.z_edges[1:]
+        stacks = OrderedDict()
+        for name, s in sums.items():
+            hz = s/np.sum(s, axis=1)[:, None]
+            hzm = mat.dot(hz.T).T
+            hzm /= np.sum(hzm, axis=1)[:, None]
+            stacks[name] = np.array([[z0, z1, h] for h in hzm])
+        return stacks
+
+
+def get_tomo_stacker(cat, msk, nbins, z_edges):
+    """
+    Returns a stacker for the tomographic redshift distributions used by
+    the mapper stages. It contains the groupings:
+    - 'galaxies': all objects, unweighted.
+    - 'shear': objects in the shear sample, weighted by their shape
+      weights (if the catalog contains shape measurements).
+    :param cat: catalog of objects used, with a 'tomo_bin' column.
+    :param msk: boolean array selecting the rows of the pdf stores
+        corresponding to `cat`.
+    :param nbins: number of tomographic bins.
+    :param z_edges: edges of the output redshift bins.
+    """
+    stacker = NzStacker(z_edges)
+    rows = np.where(msk)[0]
+    labels = np.full(len(msk), -1)
+    labels[rows] = cat['tomo_bin']
+    stacker.add_grouping('galaxies', labels, nbins)
+
+    names = cat.dtype.names
+    w_name = 'ishape_hsm_regauss_derived_shape_weight'
+    if ('shear_cat' in names) and (w_name in names):
+        good = cat['shear_cat'].astype(bool)
+        labels = np.full(len(msk), -1)
+        labels[rows[good]] = cat['tomo_bin'][good]
+        weights = np.zeros(len(msk))
+        weights[rows] = cat[w_name]
+        stacker.add_grouping('shear', labels, nbins, weights=weights)
+    return stacker
@@ -1,67 +1,272 @@
 import numpy as np
+from collections import OrderedDict
+
+# Registered statistics: name -> (function, description)
+_STATISTICS = OrderedDict()
+
+
+def register_statistic(name, description):
+    """
+    Decorator registering a new per-pixel statistic. The decorated
+    function takes a completed `ObsCond` and returns an array with
+    shape [nquantities, npix]. Pixels with no data are set to -9999
+    by `ObsCond.collapse_maps`.
+    :param name: name used to request the statistic.
+    :param description: text used in the map descriptions.
+    """
+    def wrap(func):
+        _STATISTICS[name] = (func, description)
+        return func
+    return wrap
+
+
+def get_statistic(name):
+    """
+    Returns the function computing a statistic and its description.
+    Besides the registered statistics, percentiles can be requested
+    as 'pNN' (e.g. 'p10'), or 'wpNN' for weighted percentiles.
+    """
+    if name in _STATISTICS:
+        return _STATISTICS[name]
+    for prefix, weighted, desc in [('wp', True, 'weighted %sth percentile'),
+                                   ('p', False, '%sth percentile')]:
+        if name.startswith(prefix):
+            try:
+                pc = float(name[len(prefix):])
+            except ValueError:
+                break
+            if (pc < 0) or (pc > 100):
+                break
+            return (lambda oc: oc.get_quantile(0.01*pc, weighted=weighted),
+                    desc % name[len(prefix):])
+    raise KeyError("Unknown statistic " + name)
+
+
+@register_statistic('mean', 'mean')
+def _stat_mean(oc):
+    return oc.get_mean()
+
+
+@register_statistic('std', 'std')
+def _stat_std(oc):
+    return oc.get_mean(power=2)-oc.get_mean()**2
+
+
+@register_statistic('median', 'median')
+def _stat_median(oc):
+    return oc.get_quantile(0.5)
+
+
+@register_statistic('wmedian', 'weighted median')
+def _stat_wmedian(oc):
+    return oc.get_quantile(0.5, weighted=True)
+
+
+@register_statistic('min', 'min')
+def _stat_min(oc):
+    return oc.get_quantile(0.)
+
+
+@register_statistic('max', 'max')
+def _stat_max(oc):
+    return oc.get_quantile(1.)
+
+
+@register_statistic('expmean', 'exposure-weighted mean')
+def _stat_expmean(oc):
+    return oc.get_mean(exposure=True)
 
 
 class ObsCond(object):
-    def __init__(self, name, nx, ny, cutoff=-9999.):
+    def __init__(self, names, nx, ny, cutoff=-9999.):
         """
-        Observing condition object.
-        :param name: name of the OC.
-        :param data: list of OC values
+        Observing condition object. Stores, for a set of quantities,
+        the values and weights contributed by all frames to each pixel
+        as flat arrays, which are sorted by pixel in CSR form by
+        `complete_map`. All the requested statistics (see
+        `register_statistic`) are then computed with vectorized
+        operations on these arrays.
+        :param names: name of the OC, or list of names.
         :param nx, ny: dimensionality of the output map
         :param cutoff: remove all data below the cutoff.
         """
-        self.name = name
+        if isinstance(names, str):
+            names = [names]
+        self.names = list(names)
+        self.nq = len(self.names)
         self.cutoff = cutoff
         self.npix = nx*ny
 
-        # Extra space at the end
-        self.vmap = [[] for i in range(nx*ny)]
-        self.wmap = [[] for i in range(nx*ny)]
+        # Chunks of (pixel, values, weight, exposure) added so far
+        self.chunks = []
         self.completed = False
 
-    def add_frame(self, ipixs, val, weights):
+    def add_frame(self, ipixs, vals, weights, exposure=1.):
+        """
+        Adds the contribution of a single frame.
+        :param ipixs: indices of the pixels overlapping with the frame.
+        :param vals: value of each quantity for this frame.
+        :param weights: weight of the frame in each pixel.
+        :param exposure: exposure time of the frame.
+        """
+        ipixs = np.asarray(ipixs)
+        vals = np.atleast_1d(vals)
+        self.add_frames(ipixs, np.repeat(vals[:, None], len(ipixs), axis=1),
+                        weights, np.full(len(ipixs), exposure))
+
+    def add_frames(self, ipixs, vals, weights, exposure=None):
+        """
+        Adds the contributions of a set of frames.
+        :param ipixs: pixel index of each contribution.
+        :param vals: values of each contribution, with shape
+            [nquantities, ncontributions].
+        :param weights: weight of each contribution.
+        :param exposure: exposure time of each contribution (used by
+            exposure-weighted statistics).
+        """
         if self.completed:
             raise ValueError("I thought I was done!")
 
-        if val > self.cutoff:
-            for ip, w in zip(ipixs, weights):
-                self.vmap[ip].append(val)
-                self.wmap[ip].append(w)
+        vals = np.asarray(vals, dtype=float).reshape([self.nq, -1])
+        if exposure is None:
+            exposure = np.ones(vals.shape[1])
+        self.chunks.append((np.asarray(ipixs, dtype=np.int64),
+                            vals,
+                            np.asarray(weights, dtype=float),
+                            np.asarray(exposure, dtype=float)))
 
     def complete_map(self):
-        for ip, (v, w) in enumerate(zip(self.vmap, self.wmap)):
-            self.vmap[ip] = np.array(v)
-            self.wmap[ip] = np.array(w)
+        """
+        Sorts all contributions by pixel.
+        """
+        if len(self.chunks) > 0:
+            ipix = np.concatenate([c[0] for c in self.chunks])
+            vals = np.concatenate([c[1] for c in self.chunks], axis=1)
+            weights = np.concatenate([c[2] for c in self.chunks])
+            exposure = np.concatenate([c[3] for c in self.chunks])
+        else:
+            ipix = np.zeros(0, dtype=np.int64)
+            vals = np.zeros([self.nq, 0])
+            weights = np.zeros(0)
+            exposure = np.zeros(0)
+        self.chunks = []
 
-    def collapse_map_mean(self):
-        map_out = np.zeros(self.npix)
+        order = np.argsort(ipix, kind='stable')
+        self.ipix = ipix[order]
+        self.vals = vals[:, order]
+        self.weights = weights[order]
+        self.exposure = exposure[order]
+        # Values below the cutoff are ignored
+        self.valid = self.vals > self.cutoff
+        counts = np.bincount(self.ipix, minlength=self.npix)
+        self.indptr = np.zeros(self.npix+1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(counts)
+        self.wmap = np.array([np.bincount(self.ipix,
+                                          weights=self.weights*v,
+                                          minlength=self.npix)
+                              for v in self.valid]).reshape([self.nq,
+                                                              self.npix])
+        self._sorted = [None]*self.nq
+        self.completed = True
+
+    def _sum(self, w):
+        return np.bincount(self.ipix, weights=w, minlength=self.npix)
 
-        for ip, (v, w) in enumerate(zip(self.vmap, self.wmap)):
-            wt = np.sum(w)
-            if wt > 0:
-                map_out[ip] = np.sum(v*w)/wt
+    def get_mean(self, power=1, exposure=False):
+        """
+        Returns the weighted mean of the quantities (raised to `power`)
+        in each pixel.
+        :param exposure: if True, weights are multiplied by the
+            exposure time.
+        """
+        mean = np.zeros([self.nq, self.npix])
+        for iq in range(self.nq):
+            w = self.weights*self.valid[iq]
+            if exposure:
+                w = w*self.exposure
+                wt = self._sum(w)
             else:
-                map_out[ip] = -9999.
-        return map_out
+                wt = self.wmap[iq]
+            good = wt > 0
+            # Invalid values (e.g. NaNs) are zeroed, since 0*NaN = NaN
+            v = np.where(self.valid[iq], self.vals[iq], 0.)
+            vw = self._sum(v**power*w)
+            mean[iq, good] = vw[good]/wt[good]
+        return mean
 
-    def collapse_map_std(self):
-        map_out = np.zeros(self.npix)
+    def _get_sorted(self, iq):
+        # Values of quantity iq sorted within each pixel, with the
+        # invalid ones at the end of each pixel's segment.
+        if self._sorted[iq] is None:
+            valid = self.valid[iq]
+            vals = np.where(valid, self.vals[iq], 0.)
+            order = np.lexsort((vals, ~valid, self.ipix))
+            nvalid = np.bincount(self.ipix, weights=valid,
+                                 minlength=self.npix).astype(np.int64)
+            self._sorted[iq] = (vals[order],
+                                np.where(valid, self.weights, 0.)[order],
+                                nvalid)
+        return self._sorted[iq]
 
-        for ip, (v, w) in enumerate(zip(self.vmap, self.wmap)):
-            wt = np.sum(w)
-            if wt > 0:
-                map_out[ip] = np.sum(v**2*w)/wt-(np.sum(v*w)/wt)**2
+    def get_quantile(self, q, weighted=False):
+        """
+        Returns the q-th quantile (0 <= q <= 1) of the valid values in
+        each pixel.
+        :param weighted: if True, return the weighted quantile (the
+            lowest value for which the cumulative weight reaches a
+            fraction `q` of the total). Otherwise, all contributions
+            count equally, and the quantile is interpolated linearly
+            (as in `np.percentile`).
+        """
+        out = np.zeros([self.nq, self.npix])
+        for iq in range(self.nq):
+            vals, weights, nvalid = self._get_sorted(iq)
+            good = nvalid > 0
+            start = self.indptr[:-1][good]
+            nv = nvalid[good]
+            if weighted:
+                cumw = np.cumsum(weights)
+                cumw_start = np.append(0., cumw)[start]
+                i_q = np.searchsorted(cumw, cumw_start+q*self.wmap[iq][good])
+                out[iq, good] = vals[np.clip(i_q, start, start+nv-1)]
             else:
-                map_out[ip] = -9999.
-        return map_out
+                pos = q*(nv-1)
+                lo = np.floor(pos).astype(np.int64)
+                hi = np.minimum(lo+1, nv-1)
+                f = pos-lo
+                out[iq, good] = ((1-f)*vals[start+lo] +
+                                 f*vals[start+hi])
+        return out
 
-    def collapse_map_median(self):
-        map_out = np.zeros(self.npix)
+    def collapse_maps(self, stats):
+        """
+        Computes a set of statistics for all quantities.
+        :param stats: list of statistic names (see `get_statistic`).
+        :return: ordered dictionary of arrays with shape
+            [nquantities, npix] for each statistic. Pixels with no data
+            are set to -9999.
+        """
+        empty = self.wmap <= 0
+        maps = OrderedDict()
+        for s in stats:
+            func, _ = get_statistic(s)
+            mp = func(self)
+            mp[empty] = -9999.
+            maps[s] = mp
+        return maps
 
-        for ip, (v, w) in enumerate(zip(self.vmap, self.wmap)):
-            wt = np.sum(w)
-            if wt > 0:
-                map_out[ip] = np.median(v)
-            else:
-                map_out[ip] = -9999.
-        return map_out
+    def _collapse_single(self, stat):
+        # Maps for a single quantity are returned with shape [npix]
+        mp = self.collapse_maps([stat])[stat]
+        if self.nq == 1:
+            return mp[0]
+        return mp
+
+    def collapse_map_mean(self):
+        return self._collapse_single('mean')
+
+    def collapse_map_std(self):
+        return self._collapse_single('std')
+
+    def collapse_map_median(self):
+        return self._collapse_single('median')
@@ -1,22 +1,94 @@
 from ceci import PipelineStage
 from .types import FitsFile, ASCIIFile
-from astropy.table import Table
 import numpy as np
 from astropy.io import fits
 import os
-import pandas as pd
+import multiprocessing
+from .id_index import IdIndex
+from .pdf_store import PDFStore, compress_pdfs
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class PDFMatcher(object):
+    def __init__(self, index, pdf_dir, prefix_out):
+        """
+        Matches the objects of a catalog with their photo-z pdfs for a
+        given photo-z code, and saves them in the catalog order. Objects
+        of this class are picklable, so that different codes can be
+        processed by a pool of workers.
+        :param index: IdIndex of the catalog.
+        :param pdf_dir: directory containing one sub-directory of
+            patch files per photo-z code.
+        :param prefix_out: prefix of the output files.
+        """
+        self.index = index
+        self.pdf_dir = pdf_dir
+        self.prefix_out = prefix_out
+
+    def get_filename(self, alg):
+        return self.prefix_out+"_"+alg+".fits"
+
+    def __call__(self, alg):
+        """
+        Matches and saves the pdfs of photo-z code `alg`.
+        :return: output file name.
+        """
+        filename = self.get_filename(alg)
+        pdfs_path = self.pdf_dir+'/'+alg
+        ncat = len(self.index)
+
+        fname_bins = pdfs_path + "/pz_pdf_bins.fits"
+        hdul = fits.open(fname_bins)
+        bins = np.array(hdul[1].data)
+        hdul.close()
+
+        matched = np.zeros(ncat, dtype=bool)
+        n_dup = 0
+        chunks = []
+
+        patch_files = [f for f in os.listdir(pdfs_path) if f.__contains__(alg+'.fits')]
+        for i, file in enumerate(patch_files):
+            logger.info("Reading %s/%s" % (pdfs_path, file))
+            with fits.open('%s/%s' % (pdfs_path, file), memmap=True) as hdul:
+                data_pdf = hdul[1].data  # pdfs
+                i_g, i_p = self.index.match(data_pdf['object_id'])
+                pdfs = data_pdf['P(z)'][i_p]
+                if np.shape(pdfs)[1] != len(bins):
+                    raise ValueError('Somethings wrong. ')
+                # Objects with more than one pdf keep the last one
+                n_unique = len(np.unique(i_g))
+                if n_unique != len(i_g):
+                    logger.warning("%s: %d duplicated object ids" %
+                                   (file, len(i_g)-n_unique))
+                n_dup += np.sum(matched[i_g])
+                matched[i_g] = True
+                chunks.append((i_g,) + compress_pdfs(pdfs))
+
+        logger.info("%d galaxies matched with pdfs out of %d" %
+                    (np.sum(matched), len(matched)))
+        if n_dup > 0:
+            logger.warning("%d galaxies matched in more than one file" %
+                           n_dup)
+
+        # Compressed pdfs in the catalog order (see pdf_store.PDFStore)
+        store = PDFStore.from_chunks(ncat, chunks,
+                                     np.array(bins, dtype=float),
+                                     object_id=self.index.get_ids())
+        logger.info("Writing to file "+filename)
+        store.write(filename)
+        logger.info('Saved %s' % filename)
+        return filename
+
+
 class PDFMatch(PipelineStage):
     name = "PDFMatch"
     inputs = [('clean_catalog', FitsFile),
               ('pdf_dir', None)]
     outputs = [('pdf_matched', ASCIIFile)]
-    config_options = {}
+    config_options = {'nprocs': 1}
 
     def run(self):
         """
@@ -24,80 +96,43 @@ class PDFMatch(PipelineStage):
         This stage matches each object in the reduced catalog
         with its photo-z pdf for different photo-z codes. Then
         stores the matched pdfs with the same ordering as the
-        reduced catalog into a separate FITS file.
+        reduced catalog into a separate compressed pdf store (see
+        pdf_store.PDFStore), one per photo-z code.
+        Objects are matched through a sorted index of the catalog
+        ids, which is stored beside the catalog (see id_index.IdIndex).
+        If `nprocs` > 1, the photo-z codes are processed in parallel.
+        Each worker keeps the compressed pdfs of its code, and the
+        dense pdfs of one patch file at a time.
         """
         file_out = self.get_output('pdf_matched')
         prefix_out = self.get_output('pdf_matched', final_name=True)[:-4]
         pz_algs = ['demp', 'ephor', 'ephor_ab', 'frankenz', 'nnpz']
 
-        str_out = ""
-
-        # Read catalog
-        cat = Table.read(self.get_input('clean_catalog'), format='fits')
-        gal_ids = cat['object_id']
+        # Read catalog ids
+        index = IdIndex.from_catalog(self.get_input('clean_catalog'))
+        matcher = PDFMatcher(index, self.get_input('pdf_dir'), prefix_out)
 
         # Read pdfs from frames
+        str_out = ""
+        algs_run = []
         for alg in pz_algs:
-            filename = prefix_out+"_"+alg+".fits"
+            filename = matcher.get_filename(alg)
             str_out += alg+" "+filename+"\n"
             if os.path.isfile(filename):
                 logger.info(alg+" found")
                 continue
-
-            pdfs_path = self.get_input('pdf_dir')+'/'+alg
-
-            fname_bins = pdfs_path + "/pz_pdf_bins.fits"
-            hdul = fits.open(fname_bins)
-            bins = hdul[1].data
-            hdul.close()
-
-            matched = np.zeros(len(cat), dtype=bool)
-            pdfs = np.zeros([len(cat), len(bins)])-1
-
-            patch_files = [f for f in os.listdir(pdfs_path) if f.__contains__(alg+'.fits')]
-            for i, file in enumerate(patch_files):
-                logger.info("Reading %s/%s" % (pdfs_path, file))
-                hdul = fits.open('%s/%s' % (pdfs_path, file))
-                data_pdf = np.array(hdul[1].data)  # pdfs
-                pdf_ids = data_pdf['object_id']
-                ids, i_g, i_p = np.intersect1d(gal_ids, pdf_ids,
-                                               assume_unique=True,
-                                               return_indices=True)
-                matched[i_g] = True
-                pdfs[i_g, :] = data_pdf['P(z)'][i_p]
-
-            logger.info("%d galaxies matched with pdfs out of %d" %
-                        (np.sum(matched), len(matched)))
-            df = pd.DataFrame(pdfs)
-            matched_pdfs = df.values
-            if np.shape(matched_pdfs)[1] != len(bins):
-                raise ValueError('Somethings wrong. ')
-
-            # set up the header
-            hdr = fits.Header()
-            primary_hdu = fits.PrimaryHDU(header=hdr)
-
-            # data to save
-            # one table for pdfs and object ids
-            col1 = fits.Column(name='object_id', format='K',
-                               array=np.array(gal_ids, dtype=int))
-            col2 = fits.Column(name='pdf', format='%iE' % len(bins),
-                               array=matched_pdfs)
-            cols = fits.ColDefs([col1, col2])
-            pdf_hdu = fits.BinTableHDU.from_columns(cols)
-
-            # a separate table for bins
-            bincol = fits.Column(name='bins', format='E',
-                                 array=np.array(bins, dtype=float))
-            bincols = fits.ColDefs([bincol])
-            bin_hdu = fits.BinTableHDU.from_columns(bincols)
-
-            # save it
-            hdul = fits.HDUList([primary_hdu, pdf_hdu, bin_hdu])
-            filename = prefix_out+"_"+alg+".fits"
-            logger.info("Writing to file "+filename)
-            hdul.writeto(filename, overwrite=True)
-            logger.info('Saved %s' % filename)
+            algs_run.append(alg)
+
+        nprocs = min(self.config['nprocs'], len(algs_run))
+        if nprocs > 1:
+            logger.info("Matching pdfs on %d processes" % nprocs)
+            pool = multiprocessing.Pool(processes=nprocs)
+            list(pool.imap(matcher, algs_run))
+            pool.close()
+            pool.join()
+        else:
+            for alg in algs_run:
+                matcher(alg)
 
         logger.info("Printing summary file")
         f = open(file_out, "w")
@@ -0,0 +1,266 @@
+import numpy as np
+import os
+from astropy.io import fits
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Quantization level of the stored pdf values
+QMAX = 32767
+
+
+def compress_pdfs(pdfs):
+    """
+    Quantizes a set of pdfs and trims them to their non-zero support.
+    Each pdf is stored as 16-bit integers relative to its maximum, so
+    values below 1/(2*QMAX) of the maximum are dropped. Negative values
+    (used as padding for objects without a pdf) are treated as zero.
+    :param pdfs: array with shape [npdfs, nbins].
+    :return: first bin, number of bins and scale (maximum) of each pdf,
+        and the concatenated quantized values.
+    """
+    p = np.atleast_2d(np.asarray(pdfs, dtype=float)).clip(min=0)
+    npdf, nbins = p.shape
+    scale = np.amax(p, axis=1) if nbins > 0 else np.zeros(npdf)
+    good = scale > 0
+    q = np.zeros([npdf, nbins], dtype=np.int16)
+    q[good] = np.rint(QMAX*p[good]/scale[good, None]).astype(np.int16)
+
+    # Support: from the first to the last non-zero bin
+    nz = q > 0
+    has = np.any(nz, axis=1)
+    start = np.where(has, np.argmax(nz, axis=1), 0)
+    end = np.where(has, nbins-np.argmax(nz[:, ::-1], axis=1), 0)
+    ibin = np.arange(nbins)[None, :]
+    support = (ibin >= start[:, None]) & (ibin < end[:, None])
+    return (start.astype(np.int32), (end-start).astype(np.int64),
+            np.where(has, scale, 0).astype(np.float32), q[support])
+
+
+class PDFStore(object):
+    def __init__(self, indptr, start, scale, values, bins, object_id=None):
+        """
+        Compact store of photo-z pdfs. Only the non-zero support of each
+        pdf is kept, quantized to 16 bits (see `compress_pdfs`), in CSR
+        form: the values of pdf i are stored in elements indptr[i] to
+        indptr[i+1] of `values`, and correspond to bins start[i]
+        onwards. The store is saved as a FITS file with one image HDU
+        per array, so it can be memory-mapped.
+        :param indptr: row offsets.
+        :param start: first bin of each pdf.
+        :param scale: maximum of each pdf.
+        :param values: quantized values.
+        :param bins: redshift bins.
+        :param object_id: object ids (optional).
+        """
+        self.indptr = indptr
+        self.start = start
+        self.scale = scale
+        self.values = values
+        self.bins = bins
+        self.object_id = object_id
+
+    def __len__(self):
+        return len(self.indptr)-1
+
+    @property
+    def nbins(self):
+        return len(self.bins)
+
+    @property
+    def nbytes(self):
+        return (self.indptr.nbytes + self.start.nbytes +
+                self.scale.nbytes + self.values.nbytes)
+
+    @classmethod
+    def from_dense(cls, pdfs, bins, object_id=None):
+        """
+        Builds a store from a dense array of pdfs with shape
+        [npdfs, nbins].
+        """
+        start, counts, scale, values = compress_pdfs(pdfs)
+        indptr = np.zeros(len(start)+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        return cls(indptr, start, scale, values, np.asarray(bins),
+                   object_id=object_id)
+
+    @classmethod
+    def from_chunks(cls, nrows, chunks, bins, object_id=None):
+        """
+        Builds a store from sets of compressed pdfs (see
+        `compress_pdfs`) assigned to arbitrary rows. Rows not assigned
+        are left empty, and later assignments take precedence.
+        :param nrows: number of rows of the store.
+        :param chunks: list of (rows, start, counts, scale, values).
+        :param bins: redshift bins.
+        """
+        start = np.zeros(nrows, dtype=np.int32)
+        counts = np.zeros(nrows, dtype=np.int64)
+        scale = np.zeros(nrows, dtype=np.float32)
+        # Offset of each row in the concatenated chunk values
+        src = np.zeros(nrows, dtype=np.int64)
+        offset = 0
+        for rows, st, cn, sc, vals in chunks:
+            start[rows] = st
+            counts[rows] = cn
+            scale[rows] = sc
+            src[rows] = offset+np.cumsum(cn)-cn
+            offset += len(vals)
+        if len(chunks) > 0:
+            all_values = np.concatenate([c[4] for c in chunks])
+        else:
+            all_values = np.zeros(0, dtype=np.int16)
+
+        indptr = np.zeros(nrows+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        irow = np.repeat(np.arange(nrows), counts)
+        idx = np.arange(indptr[-1])-indptr[irow]+src[irow]
+        return cls(indptr, start, scale, all_values[idx], np.asarray(bins),
+                   object_id=object_id)
+
+    def get_row(self, i):
+        """
+        Returns the pdf in row `i` as a dense array.
+        """
+        p = np.zeros(self.nbins)
+        i0, i1 = self.indptr[i], self.indptr[i+1]
+        s = self.start[i]
+        p[s:s+i1-i0] = self.values[i0:i1]*(self.scale[i]/QMAX)
+        return p
+
+    def get_rows(self, rows):
+        """
+        Returns the pdfs in a set of rows as a dense array with shape
+        [len(rows), nbins].
+        """
+        rows = np.asarray(rows)
+        irow, ibin, vals = self._get_elements(rows)
+        p = np.zeros([len(rows), self.nbins])
+        p[irow, ibin] = vals
+        return p
+
+    def _get_elements(self, rows):
+        # Row (into `rows`), bin and value of every stored element of
+        # a set of rows.
+        starts = self.indptr[rows]
+        counts = self.indptr[rows+1]-starts
+        irow = np.repeat(np.arange(len(rows)), counts)
+        k = np.arange(len(irow))-np.repeat(np.cumsum(counts)-counts, counts)
+        idx = starts[irow]+k
+        vals = self.values[idx]*(self.scale[rows][irow]/QMAX)
+        return irow, self.start[rows][irow]+k, vals
+
+    def get_sums(self):
+        """
+        Returns the sum of each pdf.
+        """
+        cumv = np.zeros(len(self.values)+1)
+        cumv[1:] = np.cumsum(self.values, dtype=np.int64)
+        return ((cumv[self.indptr[1:]]-cumv[self.indptr[:-1]]) *
+                (self.scale/QMAX))
+
+    def sum_by_label(self, labels, nlabels, weights=None, chunk=100000):
+        """
+        Sums the pdfs of all rows sharing the same label.
+        :param labels: label of each row. Rows with labels outside
+            [0, nlabels) are ignored.
+        :param nlabels: number of labels.
+        :param weights: weight of each row (optional).
+        :param chunk: number of rows processed at once.
+        :return: array with shape [nlabels, nbins].
+        """
+        return self.sum_by_labels([(labels, nlabels, weights)],
+                                  chunk=chunk)[0]
+
+    def sum_by_labels(self, groupings, chunk=100000):
+        """
+        Computes several sets of grouped sums (see `sum_by_label`) in a
+        single pass over the store.
+        :param groupings: list of (labels, nlabels, weights) tuples.
+            `weights` may be `None`.
+        :param chunk: number of rows processed at once.
+        :return: list of arrays with shape [nlabels, nbins].
+        """
+        nb = self.nbins
+        groupings = [(np.asarray(lab), nlab, w) for lab, nlab, w in groupings]
+        for lab, _, _ in groupings:
+            if len(lab) != len(self):
+                raise ValueError("Need one label per row")
+        outs = [np.zeros(nlab*nb) for _, nlab, _ in groupings]
+        for r0 in range(0, len(self), chunk):
+            r1 = min(r0+chunk, len(self))
+            # Rows used by at least one grouping
+            used = [(lab[r0:r1] >= 0) & (lab[r0:r1] < nlab)
+                    for lab, nlab, _ in groupings]
+            rows = r0+np.where(np.any(used, axis=0))[0]
+            if len(rows) == 0:
+                continue
+            irow, ibin, vals = self._get_elements(rows)
+            for (lab, nlab, w), u, out in zip(groupings, used, outs):
+                good = u[rows-r0][irow]
+                v = vals[good]
+                if w is not None:
+                    v = v*w[rows][irow[good]]
+                out += np.bincount(lab[rows][irow[good]]*nb+ibin[good],
+                                   weights=v, minlength=nlab*nb)
+        return [out.reshape([nlab, nb])
+                for out, (_, nlab, _) in zip(outs, groupings)]
+
+    def write(self, filename):
+        """
+        Saves the store to a FITS file.
+        """
+        hdr = fits.Header()
+        hdr['PDFSTORE'] = (True, 'Compressed pdf store')
+        hdr['QMAX'] = (QMAX, 'Quantization level')
+        hdus = [fits.PrimaryHDU(header=hdr),
+                fits.ImageHDU(data=np.asarray(self.indptr, dtype=np.int64),
+                              name='INDPTR'),
+                fits.ImageHDU(data=np.asarray(self.start, dtype=np.int32),
+                              name='START'),
+                fits.ImageHDU(data=np.asarray(self.scale, dtype=np.float32),
+                              name='SCALE'),
+                fits.ImageHDU(data=np.asarray(self.values, dtype=np.int16),
+                              name='VALUES'),
+                fits.ImageHDU(data=np.asarray(self.bins, dtype=float),
+                              name='BINS')]
+        if self.object_id is not None:
+            hdus.append(fits.ImageHDU(data=np.asarray(self.object_id,
+                                                      dtype=np.int64),
+                                      name='OBJECT_ID'))
+        tmp = filename+'.tmp'
+        fits.HDUList(hdus).writeto(tmp, overwrite=True)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Reads a store saved with `write`. The arrays are memory-mapped.
+        Files containing a dense table of pdfs (with a `pdf` column in
+        the first extension and the bins in the second one) are also
+        accepted, and compressed on the fly.
+        """
+        hdul = fits.open(filename, memmap=True)
+        if not hdul[0].header.get('PDFSTORE', False):
+            logger.info("Compressing dense pdfs from " + filename)
+            ids = None
+            if 'object_id' in hdul[1].columns.names:
+                ids = np.array(hdul[1].data['object_id'])
+            pdfs = hdul[1].data['pdf']
+            chunk = 100000
+            chunks = [(np.arange(i0, min(i0+chunk, len(pdfs))),) +
+                      compress_pdfs(pdfs[i0:i0+chunk])
+                      for i0 in range(0, len(pdfs), chunk)]
+            store = cls.from_chunks(len(pdfs), chunks,
+                                    np.array(hdul[2].data['bins']),
+                                    object_id=ids)
+            hdul.close()
+            return store
+
+        object_id = None
+        if 'OBJECT_ID' in hdul:
+            object_id = hdul['OBJECT_ID'].data
+        return cls(hdul['INDPTR'].data, hdul['START'].data,
+                   hdul['SCALE'].data, hdul['VALUES'].data,
+                   hdul['BINS'].data, object_id=object_id)
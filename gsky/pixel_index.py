@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class PixelIndex(object):
+    def __init__(self, fsk, ra=None, dec=None, ipix=None):
+        """
+        Pixel assignment of a set of objects on a given pixelization.
+        Sky coordinates are projected once, and the result can be
+        passed to all the map builders in `map_utils` (through their
+        `pixidx` argument) and sub-selected cheaply.
+        :param fsk: a flatmaps.FlatMapInfo object describing the
+            pixelization.
+        :param ra: right ascension for each object.
+        :param dec: declination for each object.
+        :param ipix: pixel indices for each object (-1 for objects
+            outside the map). If provided, `ra` and `dec` are ignored.
+        """
+        self.fsk = fsk
+        if ipix is None:
+            if (ra is None) or (dec is None):
+                raise ValueError("Must provide either ipix or ra and dec")
+            ipix = fsk.pos2pix(ra, dec)
+        self.ipix = np.atleast_1d(np.asarray(ipix))
+
+    def __len__(self):
+        return len(self.ipix)
+
+    def select(self, sel):
+        """
+        Returns the pixel index of a subset of the objects.
+        :param sel: boolean mask or array of indices.
+        """
+        return PixelIndex(self.fsk, ipix=self.ipix[sel])
+
+    def is_compatible(self, fsk):
+        """
+        Checks whether this index was computed on a pixelization
+        equivalent to `fsk`.
+        :param fsk: a flatmaps.FlatMapInfo object.
+        """
+        if fsk is self.fsk:
+            return True
+        return ((fsk.nx == self.fsk.nx) and (fsk.ny == self.fsk.ny) and
+                np.all(fsk.wcs.wcs.crval == self.fsk.wcs.wcs.crval) and
+                np.all(fsk.wcs.wcs.crpix == self.fsk.wcs.wcs.crpix) and
+                np.all(fsk.wcs.wcs.cdelt == self.fsk.wcs.wcs.cdelt))
+
+    def get_pixels(self, fsk=None):
+        """
+        Returns the pixel indices.
+        :param fsk: if not `None`, check that the index is compatible
+            with this pixelization.
+        """
+        if (fsk is not None) and (not self.is_compatible(fsk)):
+            raise ValueError("Pixel index was computed on a "
+                             "different pixelization")
+        return self.ipix
@@ -0,0 +1,294 @@
+import numpy as np
+import hashlib
+import os
+import multiprocessing
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _clip_half_plane(px, py, n, coord, bound, sign):
+    """
+    Clips a batch of convex polygons against the half-planes
+    sign*(coord-bound) >= 0 (one step of the Sutherland-Hodgman
+    algorithm).
+    :param px, py: vertex coordinates, with shape [npoly, nvert].
+        Only the first `n` vertices of each polygon are used.
+    :param n: number of vertices of each polygon.
+    :param coord: 0 to clip in x, 1 to clip in y.
+    :param bound: position of the boundary for each polygon.
+    :param sign: +1 to keep coord >= bound, -1 to keep coord <= bound.
+    :return: clipped vertex coordinates (with one more column) and
+        number of vertices.
+    """
+    npoly, nvert = px.shape
+    rows = np.arange(npoly)
+    ox = np.zeros([npoly, nvert+1])
+    oy = np.zeros([npoly, nvert+1])
+    on = np.zeros(npoly, dtype=int)
+    dist = sign*((px if coord == 0 else py)-bound[:, None])
+
+    def emit(sel, x, y):
+        r = rows[sel]
+        ox[r, on[sel]] = x
+        oy[r, on[sel]] = y
+        on[sel] += 1
+
+    for i in range(nvert):
+        valid = i < n
+        # Previous vertex (wrapping around each polygon)
+        ip = np.where(i == 0, n-1, i-1).clip(min=0)
+        d_cur = dist[:, i]
+        d_prev = dist[rows, ip]
+        in_cur = d_cur >= 0
+        in_prev = d_prev >= 0
+
+        # Edge crossing the boundary: add the intersection
+        cross = valid & (in_cur != in_prev)
+        if np.any(cross):
+            t = d_prev[cross]/(d_prev[cross]-d_cur[cross])
+            xp = px[rows[cross], ip[cross]]
+            yp = py[rows[cross], ip[cross]]
+            emit(cross,
+                 xp+t*(px[cross, i]-xp),
+                 yp+t*(py[cross, i]-yp))
+        # Current vertex inside: keep it
+        keep = valid & in_cur
+        emit(keep, px[keep, i], py[keep, i])
+    return ox, oy, on
+
+
+def polygon_areas(px, py, n):
+    """
+    Returns the areas of a batch of polygons (shoelace formula).
+    :param px, py: vertex coordinates, with shape [npoly, nvert].
+    :param n: number of vertices of each polygon.
+    """
+    # Pad each polygon with its first vertex, so that the unused
+    # vertices don't contribute.
+    unused = np.arange(px.shape[1])[None, :] >= n[:, None]
+    px = np.where(unused, px[:, :1], px)
+    py = np.where(unused, py[:, :1], py)
+    px1 = np.roll(px, -1, axis=1)
+    py1 = np.roll(py, -1, axis=1)
+    return 0.5*np.fabs(np.sum(px*py1-px1*py, axis=1))
+
+
+def quad_pixel_overlaps(x, y, nx, ny):
+    """
+    Computes the exact area of a set of convex quadrilaterals that
+    falls in each pixel of a map. Pixel (ix, iy) covers the square
+    [ix, ix+1] x [iy, iy+1] in pixel coordinates. All pixels in the
+    bounding box of every quadrilateral are clipped at once with the
+    Sutherland-Hodgman algorithm.
+    :param x, y: vertex coordinates (in pixel units) with shape
+        [nquad, 4], with the vertices of each quadrilateral given
+        in order (clockwise or anticlockwise).
+    :param nx, ny: map dimensions.
+    :return: index of the quadrilateral, flattened pixel index and
+        overlap area for every overlapping pair, sorted by
+        quadrilateral and pixel index.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    nquad = len(x)
+
+    # Bounding box of each quadrilateral within the map
+    ixmin = np.clip(np.floor(np.amin(x, axis=1)), 0, nx).astype(int)
+    ixmax = np.clip(np.floor(np.amax(x, axis=1))+1, 0, nx).astype(int)
+    iymin = np.clip(np.floor(np.amin(y, axis=1)), 0, ny).astype(int)
+    iymax = np.clip(np.floor(np.amax(y, axis=1))+1, 0, ny).astype(int)
+    nbx = ixmax-ixmin
+    nby = np.where(nbx > 0, iymax-iymin, 0).clip(min=0)
+    ncells = nbx*nby
+
+    # One row per (quadrilateral, pixel) pair
+    iquad = np.repeat(np.arange(nquad), ncells)
+    k = np.arange(len(iquad))-np.repeat(np.cumsum(ncells)-ncells, ncells)
+    ix = ixmin[iquad]+k % nbx[iquad]
+    iy = iymin[iquad]+k // nbx[iquad]
+
+    px = x[iquad]
+    py = y[iquad]
+    n = np.full(len(iquad), 4)
+    for coord, bound, sign in [(0, ix, 1.), (0, ix+1, -1.),
+                               (1, iy, 1.), (1, iy+1, -1.)]:
+        px, py, n = _clip_half_plane(px, py, n, coord,
+                                     bound.astype(float), sign)
+    areas = polygon_areas(px, py, n)
+
+    good = areas > 0
+    return iquad[good], (iy*nx+ix)[good], areas[good]
+
+
+class QuadOverlapper(object):
+    def __init__(self, nx, ny):
+        """
+        Picklable wrapper around `quad_pixel_overlaps`, so that batches
+        of quadrilaterals can be processed by a pool of workers.
+        :param nx, ny: map dimensions.
+        """
+        self.nx = nx
+        self.ny = ny
+
+    def __call__(self, quads):
+        x, y = quads
+        return quad_pixel_overlaps(x, y, self.nx, self.ny)
+
+
+def get_frames_near(fsk, ra, dec, margin=1.):
+    """
+    Cheap bounding-box test selecting the frames that may lie close to
+    a map, before projecting their corners.
+    :param fsk: FlatMapInfo describing the map.
+    :param ra, dec: corner coordinates (in degrees) with shape
+        [nframes, ncorners].
+    :param margin: fraction of the map size by which the map region
+        is extended on each side (see `FlatMapInfo.get_sky_bounds`).
+    :return: boolean array, True for frames whose bounding box overlaps
+        with the extended map region.
+    """
+    ra_c, dra_min, dra_max, dec_min, dec_max = fsk.get_sky_bounds(margin)
+    # Tolerance of one pixel
+    tol = max(np.fabs(fsk.dx), np.fabs(fsk.dy))
+    dra = np.mod(np.asarray(ra)-ra_c+180., 360.)-180.
+    dec = np.asarray(dec)
+    return ((np.amax(dra, axis=1) >= dra_min-tol) &
+            (np.amin(dra, axis=1) <= dra_max+tol) &
+            (np.amax(dec, axis=1) >= dec_min-tol) &
+            (np.amin(dec, axis=1) <= dec_max+tol))
+
+
+def get_overlap_key(filename, fsk):
+    """
+    Returns a hash identifying the frame-pixel overlaps of a frames
+    file on a given pixelization.
+    :param filename: path to the frames file.
+    :param fsk: FlatMapInfo describing the pixelization.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**24), b''):
+            h.update(block)
+    h.update(fsk.wcs.to_header_string().encode())
+    h.update(('%d %d' % (fsk.nx, fsk.ny)).encode())
+    return h.hexdigest()
+
+
+class OverlapTable(object):
+    def __init__(self, indptr, ipix, areas, valid=None):
+        """
+        Frame-pixel overlaps stored in CSR form: the overlaps of
+        frame i are stored in elements indptr[i] to indptr[i+1] of
+        `ipix` (pixel indices) and `areas` (overlap areas in pixel
+        units).
+        :param valid: boolean array flagging the frames that were
+            considered when computing the overlaps (all by default).
+        """
+        self.indptr = indptr
+        self.ipix = ipix
+        self.areas = areas
+        if valid is None:
+            valid = np.ones(len(indptr)-1, dtype=bool)
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.indptr)-1
+
+    @classmethod
+    def from_quads(cls, x, y, nx, ny, valid=None, batch=1024, nprocs=1):
+        """
+        Computes the overlaps of a set of quadrilateral frames (see
+        `quad_pixel_overlaps`), in batches of `batch` frames. If
+        `nprocs` > 1, batches are distributed over a pool of processes
+        and merged in order, so the result does not depend on `nprocs`.
+        :param x, y: corner coordinates with shape [nframes, 4].
+        :param nx, ny: map dimensions.
+        :param valid: boolean array. Frames where it is False are
+            given no overlaps.
+        """
+        nframes = len(x)
+        if valid is None:
+            valid = np.ones(nframes, dtype=bool)
+        i_valid = np.where(valid)[0]
+        batches = [i_valid[i0:i0+batch]
+                   for i0 in range(0, len(i_valid), batch)]
+
+        if nprocs > 1:
+            logger.info("Computing overlaps on %d processes" % nprocs)
+            pool = multiprocessing.Pool(processes=nprocs)
+            mapper = pool.imap
+        else:
+            pool = None
+            mapper = map
+        results = mapper(QuadOverlapper(nx, ny),
+                         ((x[ifr], y[ifr]) for ifr in batches))
+
+        frames = []
+        ipix = []
+        areas = []
+        percent_next = 0
+        for ib, (ifr, (iq, ip, ar)) in enumerate(zip(batches, results)):
+            percent_done = int(100*(ib+0.)/len(batches))
+            if percent_done >= percent_next:
+                logger.info("%d%% done" % percent_done)
+                percent_next = 10*(percent_done//10+1)
+            frames.append(ifr[iq])
+            ipix.append(ip)
+            areas.append(ar)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if len(frames) > 0:
+            frames = np.concatenate(frames)
+            ipix = np.concatenate(ipix)
+            areas = np.concatenate(areas)
+        else:
+            frames = np.zeros(0, dtype=int)
+            ipix = np.zeros(0, dtype=int)
+            areas = np.zeros(0)
+        indptr = np.zeros(nframes+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(frames, minlength=nframes))
+        return cls(indptr, ipix.astype(np.int64), areas, valid=valid)
+
+    def get_frames(self, frames):
+        """
+        Returns the overlaps of a subset of frames as flat arrays.
+        :param frames: indices of the frames.
+        :return: index (into `frames`) of the frame, pixel index and
+            area for each overlap.
+        """
+        frames = np.asarray(frames)
+        starts = self.indptr[frames]
+        counts = self.indptr[frames+1]-starts
+        iframe = np.repeat(np.arange(len(frames)), counts)
+        idx = (np.arange(len(iframe)) -
+               np.repeat(np.cumsum(counts)-counts, counts) +
+               starts[iframe])
+        return iframe, self.ipix[idx], self.areas[idx]
+
+    def write(self, filename, key=''):
+        """
+        Saves the table to a .npz file, tagged with `key` (see
+        `get_overlap_key`).
+        """
+        # np.savez appends the suffix to the filename if missing
+        tmp = filename+'.tmp.npz'
+        np.savez(tmp, key=key, indptr=self.indptr,
+                 ipix=self.ipix, areas=self.areas, valid=self.valid)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def read(cls, filename, key=None):
+        """
+        Reads a table saved with `write`.
+        :param key: if not `None`, return `None` if the table was
+            saved with a different key.
+        """
+        with np.load(filename) as d:
+            if (key is not None) and (str(d['key']) != key):
+                return None
+            return cls(d['indptr'], d['ipix'], d['areas'],
+                       valid=d['valid'])
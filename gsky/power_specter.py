@@ -1,10 +1,11 @@
 from ceci import PipelineStage
 from .types import FitsFile,ASCIIFile,BinaryFile,NpzFile,SACCFile,DummyFile
 import numpy as np
-from .flatmaps import read_flat_map,compare_infos
-from astropy.io import fits
+from .flatmaps import compare_infos,MapStack
+from .map_cache import read_flat_map_cached,open_fits_cached
 import pymaster as nmt
 from .tracer import Tracer
+from .bitmask import BitMask
 import os
 import sacc
 from scipy.interpolate import interp1d
@@ -37,25 +38,41 @@ class PowerSpecter(PipelineStage) :
                     'output_run_dir': 'NONE','sys_collapse_type':'average',
                     'subsamp_winds': False}
 
+    def get_map_stack(self,fname) :
+        """
+        Returns a lazy MapStack for a map file, opening it only once.
+        :param fname: file name
+        """
+        if not hasattr(self,'map_stacks') :
+            self.map_stacks={}
+        if fname not in self.map_stacks :
+            stack=MapStack(fname)
+            compare_infos(self.fsk,stack.fsk)
+            self.map_stacks[fname]=stack
+        return self.map_stacks[fname]
+
+    def close_map_stacks(self) :
+        """
+        Closes all map stacks opened with `get_map_stack`.
+        """
+        for stack in getattr(self,'map_stacks',{}).values() :
+            stack.close()
+        self.map_stacks={}
+
     def read_map_bands(self,fname,read_bands,bandname,offset=0) :
         """
         Reads maps from file.
+        Maps are read-only views of the memory-mapped file.
         :param fname: file name
         :param read_bands: if True, read map in all bands
         :param bandname: if `read_bands==False`, then read only the map for this band.
         """
+        stack=self.get_map_stack(fname)
         if read_bands :
-            temp=[]
-            for i in range(5):
-                i_map=i+5*offset
-                fskb,t=read_flat_map(fname,i_map=i_map)
-                compare_infos(self.fsk,fskb)
-                temp.append(t)
+            temp=[stack[i+5*offset] for i in range(5)]
         else :
             i_map=['g','r','i','z','y'].index(bandname)+5*offset
-            fskb,temp=read_flat_map(fname,i_map=i_map)
-            compare_infos(self.fsk,fskb)
-            temp=[temp]
+            temp=[stack[i_map]]
 
         return temp
 
@@ -291,7 +308,7 @@ class PowerSpecter(PipelineStage) :
             randomized_nmap=np.bincount(ipix,minlength=nx*ny)
 
             randomized_deltamap=np.zeros_like(randomized_nmap,dtype='float')
-            ndens=np.sum(randomized_nmap*tracer.mask_binary)/np.sum(tracer.weight)
+            ndens=np.sum(randomized_nmap[tracer.goodpix])/np.sum(tracer.weight)
             randomized_deltamap[tracer.goodpix]=randomized_nmap[tracer.goodpix]/(ndens*tracer.masked_fraction[tracer.goodpix])-1
             randomized_deltamap=randomized_deltamap.reshape(maskshape)
 
@@ -648,18 +665,20 @@ class PowerSpecter(PipelineStage) :
     def get_masks(self) :
         """
         Read or compute all binary masks and the masked fraction map.
+        The binary mask is returned as a BitMask.
         """
         #Depth-based mask
-        self.fsk,mp_depth=read_flat_map(self.get_input("depth_map"),i_map=0)
+        self.fsk,mp_depth=read_flat_map_cached(self.get_input("depth_map"),i_map=0)
+        mp_depth=mp_depth.copy()
         mp_depth[np.isnan(mp_depth)]=0; mp_depth[mp_depth>40]=0
-        msk_depth=np.zeros_like(mp_depth); msk_depth[mp_depth>=self.config['depth_cut']]=1
+        msk_depth=BitMask.from_array(mp_depth>=self.config['depth_cut'])
 
-        fskb,mskfrac=read_flat_map(self.get_input("masked_fraction"),i_map=0)
+        fskb,mskfrac=read_flat_map_cached(self.get_input("masked_fraction"),i_map=0)
         compare_infos(self.fsk,fskb)
         
         #Create binary mask (fraction>threshold and depth req.)
-        msk_bo=np.zeros_like(mskfrac); msk_bo[mskfrac>self.config['mask_thr']]=1
-        msk_bi=msk_bo*msk_depth
+        msk_bo=BitMask.from_array(mskfrac>self.config['mask_thr'])
+        msk_bi=msk_bo&msk_depth
 
         if self.config['mask_systematics'] :
             #Mask systematics
@@ -678,23 +697,23 @@ class PowerSpecter(PipelineStage) :
                     raise KeyError("Unknown systematic name "+d['name'])
     
                 #Divide by mean
-                sysmean=np.sum(msk_bi*mskfrac*sysmap)/np.sum(msk_bi*mskfrac)
-                sysmap/=sysmean
+                weight=msk_bi.apply(mskfrac)
+                sysmean=np.sum(weight*sysmap)/np.sum(weight)
+                sysmap=sysmap/sysmean
 
                 #Apply threshold
-                msk_sys_this=msk_bi.copy(); fsky_pre=np.sum(msk_syst)
+                fsky_pre=msk_syst.count()
                 if d['gl']=='<' :
-                    msk_sys_this[sysmap<d['thr']]=0
+                    msk_syst&=~BitMask.from_array(sysmap<d['thr'])
                 else :
-                    msk_sys_this[sysmap>d['thr']]=0
-                msk_syst*=msk_sys_this
-                fsky_post=np.sum(msk_syst)
+                    msk_syst&=~BitMask.from_array(sysmap>d['thr'])
+                fsky_post=msk_syst.count()
                 print(' '+d['name']+d['gl']+'%.3lf'%(d['thr'])+
                       ' removes ~%.2lf per-cent of the available sky'%((1-fsky_post/fsky_pre)*100))
-            print(' All systematics remove %.2lf per-cent of the sky'%((1-np.sum(msk_syst)/np.sum(msk_bi))*100))
-            self.fsk.write_flat_map(self.get_output_fname("mask_syst",ext="fits"),msk_syst)
+            print(' All systematics remove %.2lf per-cent of the sky'%((1-msk_syst.count()/msk_bi.count())*100))
+            self.fsk.write_flat_map(self.get_output_fname("mask_syst",ext="fits"),msk_syst.to_float())
 
-            msk_bi*=msk_syst
+            msk_bi&=msk_syst
 
         return msk_bi,mskfrac,mp_depth
 
@@ -704,9 +723,9 @@ class PowerSpecter(PipelineStage) :
         :param temps: list of contaminant tracers
         """
         if map_type != 'Compton_y_maps' and map_type != 'kappa_maps':
-            hdul=fits.open(self.get_input(map_type))
+            hdul=open_fits_cached(self.get_input(map_type))
         else:
-            hdul = fits.open(self.get_input('act_maps'))
+            hdul = open_fits_cached(self.get_input('act_maps'))
 
         if map_type == 'ngal_maps':
             logger.info('Creating number counts tracers.')
@@ -750,8 +769,6 @@ class PowerSpecter(PipelineStage) :
         else:
             raise NotImplementedError()
 
-        hdul.close()
-
         return tracers_nocont,tracers_wcont
 
     def get_all_tracers(self, temps):
@@ -819,9 +836,7 @@ class PowerSpecter(PipelineStage) :
         for t in self.read_map_bands(self.get_input('dust_map'),False,self.config['band']) :
             temps.append(t)
         #Stars
-        fskb,t=read_flat_map(self.get_input('star_map'),i_map=0)
-        compare_infos(self.fsk,fskb)
-        temps.append(t)
+        temps.append(self.get_map_stack(self.get_input('star_map'))[0])
         #Observing conditions
         for oc in self.config['oc_dpj_list'] :
             for t in self.read_map_bands(self.get_input(oc+'_maps'),
@@ -830,8 +845,9 @@ class PowerSpecter(PipelineStage) :
                 temps.append(t)
         temps=np.array(temps)
         #Remove mean
+        weight=self.msk_bi.apply(self.mskfrac)
         for i_t,t in enumerate(temps) :
-            temps[i_t]-=np.sum(self.msk_bi*self.mskfrac*t)/np.sum(self.msk_bi*self.mskfrac)
+            temps[i_t]-=np.sum(weight*t)/np.sum(weight)
 
         return temps
 
@@ -1423,7 +1439,7 @@ class PowerSpecter(PipelineStage) :
 
         logger.info("Computing area.")
         self.area_pix=np.radians(self.fsk.dx)*np.radians(self.fsk.dy)
-        self.area_patch=np.sum(self.msk_bi*self.mskfrac)*self.area_pix
+        self.area_patch=np.sum(self.msk_bi.apply(self.mskfrac))*self.area_pix
         self.lmax=int(180.*np.sqrt(1./self.fsk.dx**2+1./self.fsk.dy**2))
 
         logger.info("Reading contaminants.")
@@ -1484,6 +1500,7 @@ class PowerSpecter(PipelineStage) :
         self.write_vector_to_sacc(self.get_output_fname('power_spectra_wdpj',ext='sacc'), tracers_sacc,
                                   cls_wdpj, ell_eff, windows)
         logger.info('Written deprojected power spectra.')
+        self.close_map_stacks()
 
         # Permissions on NERSC
         os.system('find /global/cscratch1/sd/damonge/GSKY/ -type d -exec chmod -f 777 {} \;')
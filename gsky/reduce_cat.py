@@ -1,18 +1,20 @@
 from ceci import PipelineStage
 from .types import FitsFile
-from astropy.table import Table, vstack
+from astropy.table import vstack
 import numpy as np
 import os
+import multiprocessing
 from .flatmaps import FlatMapInfo
-from .map_utils import (createCountsMap,
-                        createMeanStdMaps,
-                        createMask,
-                        removeDisconnected,
-                        createSpin2Map)
-from .estDepth import get_depth
+from .map_utils import (meanStdFromSums,
+                        spin2FromSums,
+                        getMaskInfo,
+                        maskFromCounts,
+                        removeDisconnected)
+from .estDepth import get_depth_from_sums
+from .cat_reducer import CatalogReducer, merge_sums
+from .mask_pyramid import MaskPyramid, pyramid_filename
 from .plot_utils import plot_histo, plot_map
 from astropy.io import fits
-import copy
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -39,13 +41,17 @@ class ReduceCat(PipelineStage):
                       'shearrot': 'noflip', 'mask_type': 'sirius',
                       'ra':  'ra', 'dec':  'dec',
                       'pz_code': 'ephor_ab', 'pz_mark': 'best',
-                      'pz_bins': [0.3, 0.6, 0.9, 1.2, 1.5]}
+                      'pz_bins': [0.3, 0.6, 0.9, 1.2, 1.5],
+                      'chunk_size': 0, 'nprocs': 1,
+                      'project_columns': False, 'extra_columns': [],
+                      'sample_cuts': None, 'sparse_maps': False,
+                      'mask_pyramid_res': []}
     bands = ['g', 'r', 'i', 'z', 'y']
 
-    def make_dust_map(self, cat, fsk):
+    def make_dust_map(self, sums, fsk):
         """
         Produces a dust absorption map for each band.
-        :param cat: input catalog
+        :param sums: dictionary of map sums (see CatalogReducer)
         :param fsk: FlatMapInfo object describing the geometry
             of the output map
         """
@@ -53,164 +59,115 @@ class ReduceCat(PipelineStage):
         dustmaps = []
         dustdesc = []
         for b in self.bands:
-            m, s = createMeanStdMaps(cat[self.config['ra']],
-                                     cat[self.config['dec']],
-                                     cat['a_'+b], fsk)
+            m, s = meanStdFromSums(sums['dust_'+b])
             dustmaps.append(m)
             dustdesc.append('Dust, '+b+'-band')
         return dustmaps, dustdesc
 
-    def make_star_map(self, cat, fsk, sel):
+    def make_star_map(self, sums, fsk):
         """
         Produces a star density map
-        :param cat: input catalog
+        :param sums: dictionary of map sums (see CatalogReducer)
         :param fsk: FlatMapInfo object describing the geometry
             of the output map
-        :param sel: mask used to select the stars to be used.
         """
         logger.info("Creating star map")
-        mstar = createCountsMap(cat[self.config['ra']][sel],
-                                cat[self.config['dec']][sel],
-                                fsk)+0.
+        mstar = sums['star']
         descstar = ('Stars, '+self.config['band'] +
                     '<%.2lf' % (self.config['depth_cut']))
         return mstar, descstar
 
-    def make_bo_mask(self, cat, fsk, mask_fulldepth=False):
+    def make_bo_mask(self, sums, fsk, fsg):
         """
         Produces a bright object mask
-        :param cat: input catalog
+        :param sums: dictionary of map sums (see CatalogReducer)
         :param fsk: FlatMapInfo object describing the
-            geometry of the output map
+            geometry of the base map
+        :param fsg: FlatMapInfo object describing the
+            geometry of the output mask
         """
         logger.info("Generating bright-object mask")
-        if self.config['mask_type'] == 'arcturus':
-            flags_mask = [~cat['mask_Arcturus'].astype(bool)]
-        elif self.config['mask_type'] == 'sirius':
-            flags_mask = [cat['iflags_pixel_bright_object_center'],
-                          cat['iflags_pixel_bright_object_any']]
-        else:
-            raise ValueError('Mask type '+self.config['mask_type'] +
-                             ' not supported')
-        if mask_fulldepth:
-            flags_mask.append(~cat['wl_fulldepth_fullcolor'].astype(bool))
-        mask_bo, fsg = createMask(cat[self.config['ra']],
-                                  cat[self.config['dec']],
-                                  flags_mask, fsk,
-                                  self.mpp['res_bo'])
-        return mask_bo, fsg
-
-    def make_masked_fraction(self, cat, fsk, mask_fulldepth=False):
+        mask_bo = maskFromCounts(sums['bo_counts'], sums['bo_flags'],
+                                 fsk, fsg)
+        return mask_bo
+
+    def make_masked_fraction(self, sums, fsk):
         """
         Produces a masked fraction map
-        :param cat: input catalog
+        :param sums: dictionary of map sums (see CatalogReducer)
         :param fsk: FlatMapInfo object describing the
             geometry of the output map
         """
         logger.info("Generating masked fraction map")
-        masked = np.ones(len(cat))
-        if mask_fulldepth:
-            masked *= cat['wl_fulldepth_fullcolor']
-        if self.config['mask_type'] == 'arcturus':
-            masked *= cat['mask_Arcturus']
-        elif self.config['mask_type'] == 'sirius':
-            masked *= np.logical_not(cat['iflags_pixel_bright_object_center'])
-            masked *= np.logical_not(cat['iflags_pixel_bright_object_any'])
-        else:
-            raise ValueError('Mask type '+self.config['mask_type'] +
-                             ' not supported')
-        masked_fraction, _ = createMeanStdMaps(cat[self.config['ra']],
-                                               cat[self.config['dec']],
-                                               masked, fsk)
+        masked_fraction, _ = meanStdFromSums(sums['masked'])
         masked_fraction_cont = removeDisconnected(masked_fraction, fsk)
         return masked_fraction_cont
 
-    def make_depth_map(self, cat, fsk):
+    def write_mask_pyramids(self, fsk, fsg, mask_bo, masked_fraction):
+        """
+        Saves the bright-object mask and masked fraction at the
+        resolutions listed in `mask_pyramid_res` beside the
+        corresponding outputs (see `mask_pyramid.MaskPyramid`). The
+        bright-object mask pyramid also contains its level at the
+        resolution of the base maps. An error is raised if any of the
+        resolutions is not an integer multiple of the corresponding
+        base resolution, as it could not be read back (see
+        `MaskPyramid.get_level_res`).
+        :param fsk: FlatMapInfo object describing the base maps
+        :param fsg: FlatMapInfo object describing the
+            bright-object mask
+        :param mask_bo: bright-object mask
+        :param masked_fraction: masked fraction map
+        """
+        logger.info("Generating mask pyramids")
+        res = self.config['mask_pyramid_res']
+        pyr_bo = MaskPyramid(fsg, mask_bo)
+        facs_bo = [pyr_bo.get_factor(r, exact=True) for r in res + [fsk.dx]]
+        pyr_mf = MaskPyramid(fsk, masked_fraction)
+        facs_mf = [pyr_mf.get_factor(r, exact=True) for r in res
+                   if np.fabs(r) >= np.fabs(fsk.dx)]
+        pyr_bo.write(pyramid_filename(self.get_output('bo_mask')), facs_bo)
+        pyr_mf.write(pyramid_filename(self.get_output('masked_fraction')),
+                     facs_mf)
+
+    def make_depth_map(self, sums, fsk):
         """
         Produces a depth map
-        :param cat: input catalog
+        :param sums: dictionary of map sums (see CatalogReducer)
         :param fsk: FlatMapInfo object describing the
             geometry of the output map
         """
         logger.info("Creating depth maps")
         method = self.config['depth_method']
         band = self.config['band']
-        snrs = cat['%scmodel_flux' % band]/cat['%scmodel_flux_err' % band]
-        if method == 'fluxerr':
-            arr1 = cat['%scmodel_flux_err' % band]
-            arr2 = None
-        else:
-            arr1 = cat['%scmodel_mag' % band]
-            arr2 = snrs
-        depth, _ = get_depth(method, cat[self.config['ra']],
-                             cat[self.config['dec']],
-                             arr1=arr1, arr2=arr2,
-                             fsk=fsk, snrthreshold=self.config['min_snr'],
-                             interpolate=True, count_threshold=4)
+        depth, _ = get_depth_from_sums(method, sums['depth'], fsk,
+                                       interpolate=True, count_threshold=4)
         desc = '%d-s depth, ' % (self.config['min_snr'])+band+' '+method+' mean'
 
         return depth, desc
 
-    def make_PSF_maps(self, cat, fsk, sel):
+    def make_PSF_maps(self, sums, fsk):
         """
-        Get e_PSF, 1, e_PSF, 2 maps from catalog.
-        Here we go from weighted moments to ellipticities following
-        Hirata & Seljak, 2003, arXiv:0301054
-        :param cat:
+        Get e_PSF, 1, e_PSF, 2 maps from the star sample.
+        :param sums: dictionary of map sums (see CatalogReducer)
         :return:
         """
-
-        # PSF of stars
-        star_cat = copy.deepcopy(cat)[sel]
-        Mxx = star_cat['ishape_hsm_psfmoments_11']
-        Myy = star_cat['ishape_hsm_psfmoments_22']
-        Mxy = star_cat['ishape_hsm_psfmoments_12']
-        T_I = Mxx + Myy
-        e_plus_I = (Mxx - Myy)/T_I
-        e_cross_I = 2*Mxy/T_I
-        ePSFmaps, ePSFmasks = createSpin2Map(star_cat[self.config['ra']],
-                                             star_cat[self.config['dec']],
-                                             e_plus_I, e_cross_I, fsk,
-                                             weights=star_cat['ishape_hsm_regauss_derived_shape_weight'],
-                                             shearrot=self.config['shearrot'])
+        ePSFmaps, ePSFmasks = spin2FromSums(sums['psf'], weighted=True,
+                                            shearrot=self.config['shearrot'])
 
         maps = [ePSFmaps, ePSFmasks]
 
         return maps
 
-    def make_PSF_res_maps(self, cat, fsk, sel):
+    def make_PSF_res_maps(self, sums, fsk):
         """
-        Get e_PSF, 1, e_PSF, 2 residual maps from catalog.
-        Here we go from weighted moments to ellipticities following
-        Hirata & Seljak, 2003, arXiv:0301054
-        :param cat:
+        Get e_PSF, 1, e_PSF, 2 residual maps from the star sample.
+        :param sums: dictionary of map sums (see CatalogReducer)
         :return:
         """
-
-        # PSF of stars
-        star_cat = copy.deepcopy(cat)[sel]
-        Mxx = star_cat['ishape_hsm_psfmoments_11']
-        Myy = star_cat['ishape_hsm_psfmoments_22']
-        Mxy = star_cat['ishape_hsm_psfmoments_12']
-        T_I = Mxx + Myy
-        e_plus_PSF = (Mxx - Myy)/T_I
-        e_cross_PSF = 2*Mxy/T_I
-
-        Mxx = star_cat['ishape_hsm_moments_11']
-        Myy = star_cat['ishape_hsm_moments_22']
-        Mxy = star_cat['ishape_hsm_moments_12']
-        T_I = Mxx + Myy
-        e_plus_I = (Mxx - Myy)/T_I
-        e_cross_I = 2*Mxy/T_I
-
-        delta_e_plus = e_plus_PSF - e_plus_I
-        delta_e_cross = e_cross_PSF - e_cross_I
-
-        ePSFresmaps, ePSFresmasks = createSpin2Map(star_cat[self.config['ra']],
-                                                   star_cat[self.config['dec']],
-                                                   delta_e_plus, delta_e_cross, fsk,
-                                                   weights=star_cat['ishape_hsm_regauss_derived_shape_weight'],
-                                                   shearrot=self.config['shearrot'])
+        ePSFresmaps, ePSFresmasks = spin2FromSums(sums['psfres'],
+                                                  weighted=True,
+                                                  shearrot=self.config['shearrot'])
 
         maps = [ePSFresmaps, ePSFresmasks]
 
@@ -311,132 +268,132 @@ class ReduceCat(PipelineStage):
         - Reduces the raw catalog by imposing quality cuts, a cut
           on i-band magnitude and a star-galaxy separation cat.
         - Produces mask maps, dust maps, depth maps and star density maps.
+        If `chunk_size` > 0, the raw files are streamed in chunks of
+        `chunk_size` rows, so that the full raw catalog never needs to
+        fit in memory. If `nprocs` > 1, the raw files are reduced in
+        parallel by a pool of `nprocs` processes. If `project_columns`
+        is True, only the columns needed by the pipeline (plus any in
+        `extra_columns`) are read from the raw files.
+        The sample cuts can be given as a list in `sample_cuts` (see
+        selection.Selection). By default, selection.default_cuts is used.
+        If `sparse_maps` is True, the maps are stored only on the pixels
+        where they are non-zero (see flatmaps.SparseFlatMap).
+        If `mask_pyramid_res` is a non-empty list of resolutions, the
+        masks are also saved at those resolutions (see
+        `write_mask_pyramids`).
         """
         band = self.config['band']
         self.mpp = self.config['mapping']
+        if band not in self.bands:
+            raise ValueError("Band "+band+" not available")
 
         # Read list of files
         f = open(self.get_input('raw_data'))
         files = [s.strip() for s in f.readlines()]
         f.close()
 
-        # Read catalog
-        cat = Table.read(files[0])
-        if len(cat) > 1:
-            for fname in files[1:]:
-                c = Table.read(fname)
-                cat = vstack([cat, c], join_type='exact')
-
-        if band not in self.bands:
-            raise ValueError("Band "+band+" not available")
-
-        logger.info('Initial catalog size: %d' % (len(cat)))
-
-        # Clean nulls and nans
-        logger.info("Basic cleanup")
-        sel = np.ones(len(cat), dtype=bool)
-        isnull_names = []
-        for key in cat.keys():
-            if key.__contains__('isnull'):
-                if not key.startswith('ishape'):
-                    sel[cat[key]] = 0
-                isnull_names.append(key)
+        reducer = CatalogReducer(dict(self.config), self.bands,
+                                 chunk_size=self.config['chunk_size'])
+        sums = {}
+        nprocs = self.config['nprocs']
+        if (self.config['chunk_size'] > 0) or (nprocs > 1):
+            # Per-file mode: a first pass over all files finds the
+            # extent of the survey area, and a second pass cleans
+            # each file (in chunks if `chunk_size` > 0) and accumulates
+            # all maps. Files may be processed in parallel, in which
+            # case partial maps and catalogs are merged in file order.
+            if nprocs > 1:
+                logger.info("Reducing files on %d processes" % nprocs)
+                pool = multiprocessing.Pool(processes=nprocs)
+                mapper = pool.imap
             else:
-                # Keep photo-zs and shapes even if they're NaNs
-                if (not key.startswith("pz_")) and (not key.startswith('ishape')):
-                    sel[np.isnan(cat[key])] = 0
-        logger.info("Will drop %d rows" % (len(sel)-np.sum(sel)))
-        cat.remove_columns(isnull_names)
-        cat.remove_rows(~sel)
-
-        # Collect sample cuts
-        sel_area = cat['wl_fulldepth_fullcolor']
-        sel_clean = sel_area & cat['clean_photometry']
-        sel_maglim = np.ones(len(cat), dtype=bool)
-        sel_maglim[cat['%scmodel_mag' % band] -
-                   cat['a_%s' % band] > self.config['depth_cut']] = 0
-        # Blending
-        sel_blended = np.ones(len(cat), dtype=bool)
-        # abs_flux<10^-0.375
-        sel_blended[cat['iblendedness_abs_flux'] >= 0.42169650342] = 0
-        # S/N in i
-        sel_fluxcut_i = np.ones(len(cat), dtype=bool)
-        sel_fluxcut_i[cat['icmodel_flux'] < 10*cat['icmodel_flux_err']] = 0
-        # S/N in g
-        sel_fluxcut_g = np.ones(len(cat), dtype=int)
-        sel_fluxcut_g[cat['gcmodel_flux'] < 5*cat['gcmodel_flux_err']] = 0
-        # S/N in r
-        sel_fluxcut_r = np.ones(len(cat), dtype=int)
-        sel_fluxcut_r[cat['rcmodel_flux'] < 5*cat['rcmodel_flux_err']] = 0
-        # S/N in z
-        sel_fluxcut_z = np.ones(len(cat), dtype=int)
-        sel_fluxcut_z[cat['zcmodel_flux'] < 5*cat['zcmodel_flux_err']] = 0
-        # S/N in y
-        sel_fluxcut_y = np.ones(len(cat), dtype=int)
-        sel_fluxcut_y[cat['ycmodel_flux'] < 5*cat['ycmodel_flux_err']] = 0
-        # S/N in grzy (at least 2 pass)
-        sel_fluxcut_grzy = (sel_fluxcut_g+sel_fluxcut_r +
-                            sel_fluxcut_z+sel_fluxcut_y >= 2)
-        # Overall S/N
-        sel_fluxcut = sel_fluxcut_i*sel_fluxcut_grzy
-        # Stars
-        sel_stars = np.ones(len(cat), dtype=bool)
-        sel_stars[cat['iclassification_extendedness'] > 0.99] = 0
-        # Galaxies
-        sel_gals = np.ones(len(cat), dtype=bool)
-        sel_gals[cat['iclassification_extendedness'] < 0.99] = 0
-
-        ####
-        # Generate sky projection
-        fsk = FlatMapInfo.from_coords(cat[sel_area][self.config['ra']],
-                                      cat[sel_area][self.config['dec']],
-                                      self.mpp)
+                pool = None
+                mapper = map
+
+            try:
+                logger.info("Finding map geometry")
+                coords = list(mapper(reducer.get_coords, files))
+                fsk = FlatMapInfo.from_coords(np.concatenate([c[0] for c in coords]),
+                                              np.concatenate([c[1] for c in coords]),
+                                              self.mpp)
+                del coords
+                fsg = getMaskInfo(fsk, self.mpp['res_bo'])
+                # The geometry is pickled exactly (see
+                # FlatMapInfo.__getstate__), so all processes assign
+                # objects to the same pixels.
+                reducer.set_geometry(fsk, fsg)
+
+                cats = []
+                for sums_file, cats_file in mapper(reducer, files):
+                    merge_sums(sums, sums_file)
+                    cats += cats_file
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            cat = vstack(cats, join_type='exact')
+            del cats
+        else:
+            # Read catalog and clean nulls and nans
+            cats = []
+            n_initial = 0
+            for fname in files:
+                for c, null_mask in reducer.read_chunks(fname):
+                    n_initial += len(c)
+                    cats.append(reducer.clean(c, null_mask))
+            cat = vstack(cats, join_type='exact')
+            del cats
+            logger.info('Initial catalog size: %d' % (n_initial))
+            logger.info("Dropped %d rows in basic cleanup" %
+                        (n_initial-len(cat)))
+
+            # Collect sample cuts
+            cuts = reducer.get_cuts(cat)
+
+            ####
+            # Generate sky projection
+            fsk = FlatMapInfo.from_coords(cat[cuts['area']][self.config['ra']],
+                                          cat[cuts['area']][self.config['dec']],
+                                          self.mpp)
+            fsg = getMaskInfo(fsk, self.mpp['res_bo'])
+            reducer.set_geometry(fsk, fsg)
+
+            ####
+            # Accumulate systematics maps and implement final cuts
+            n_initial = len(cat)
+            cat = reducer.reduce_chunk(cat, cuts, sums)
+            logger.info("Lost %d objects to depth, S/N and stars" %
+                        (n_initial-len(cat)))
 
         ####
         # Generate systematics maps
+        sparse = self.config['sparse_maps']
         # 1- Dust
-        dustmaps, dustdesc = self.make_dust_map(cat, fsk)
+        dustmaps, dustdesc = self.make_dust_map(sums, fsk)
         fsk.write_flat_map(self.get_output('dust_map'), np.array(dustmaps),
-                           descript=dustdesc)
+                           descript=dustdesc, sparse=sparse)
 
         # 2- Nstar
-        #    This needs to be done for stars passing the same cuts as the
-        #    sample (except for the s/g separator)
-        # Above magnitude limit
-        mstar, descstar = self.make_star_map(cat, fsk,
-                                             sel_clean *
-                                             sel_maglim *
-                                             sel_stars *
-                                             sel_fluxcut *
-                                             sel_blended)
+        mstar, descstar = self.make_star_map(sums, fsk)
         fsk.write_flat_map(self.get_output('star_map'), mstar,
-                           descript=descstar)
+                           descript=descstar, sparse=sparse)
 
         # 3- e_PSF
         # TODO: do these stars need to have the same cuts as our sample?
         logger.info('Creating e_PSF map.')
-        mPSFstar = self.make_PSF_maps(cat, fsk,
-                                      sel_clean *
-                                      sel_maglim *
-                                      sel_stars *
-                                      sel_fluxcut *
-                                      sel_blended)
+        mPSFstar = self.make_PSF_maps(sums, fsk)
         fsk.write_flat_map(self.get_output('ePSF_map'),
                            np.array([mPSFstar[0][0], mPSFstar[0][1],
                                      mPSFstar[1][0], mPSFstar[1][1],
                                      mPSFstar[1][2]]),
                            descript=['e_PSF1', 'e_PSF2',
                                      'e_PSF weight mask', 'e_PSF binary mask',
-                                     'counts map (PSF star sample)'])
+                                     'counts map (PSF star sample)'],
+                           sparse=sparse)
 
         # 4- delta_e_PSF
         logger.info('Creating e_PSF residual map.')
-        mPSFresstar = self.make_PSF_res_maps(cat, fsk,
-                                             sel_clean *
-                                             sel_maglim *
-                                             sel_stars *
-                                             sel_fluxcut *
-                                             sel_blended)
+        mPSFresstar = self.make_PSF_res_maps(sums, fsk)
         fsk.write_flat_map(self.get_output('ePSFres_map'),
                            np.array([mPSFresstar[0][0], mPSFresstar[0][1],
                                      mPSFresstar[1][0], mPSFresstar[1][1],
@@ -444,36 +401,29 @@ class ReduceCat(PipelineStage):
                            descript=['e_PSFres1', 'e_PSFres2',
                                      'e_PSFres weight mask',
                                      'e_PSFres binary mask',
-                                     'counts map (PSF star sample)'])
+                                     'counts map (PSF star sample)'],
+                           sparse=sparse)
 
         # 5- Binary BO mask
-        mask_bo, fsg = self.make_bo_mask(cat[sel_area], fsk,
-                                         mask_fulldepth=True)
+        mask_bo = self.make_bo_mask(sums, fsk, fsg)
         fsg.write_flat_map(self.get_output('bo_mask'), mask_bo,
-                           descript='Bright-object mask')
+                           descript='Bright-object mask', sparse=sparse)
 
         # 6- Masked fraction
-        masked_fraction_cont = self.make_masked_fraction(cat, fsk,
-                                                         mask_fulldepth=True)
+        masked_fraction_cont = self.make_masked_fraction(sums, fsk)
         fsk.write_flat_map(self.get_output('masked_fraction'),
                            masked_fraction_cont,
-                           descript='Masked fraction')
+                           descript='Masked fraction', sparse=sparse)
+
+        # 6b- Mask pyramids
+        if self.config['mask_pyramid_res']:
+            self.write_mask_pyramids(fsk, fsg, mask_bo, masked_fraction_cont)
 
         # 7- Compute depth map
-        depth, desc = self.make_depth_map(cat[sel_stars], fsk)
+        depth, desc = self.make_depth_map(sums, fsk)
         fsk.write_flat_map(self.get_output('depth_map'),
-                           depth, descript=desc)
-
-        ####
-        # Implement final cuts
-        # - Mag. limit
-        # - S/N cut
-        # - Star-galaxy separator
-        # - Blending
-        sel = ~(sel_clean*sel_maglim*sel_gals*sel_fluxcut*sel_blended)
-        logger.info("Will lose %d objects to depth, S/N and stars" %
-                    (np.sum(sel)))
-        cat.remove_rows(sel)
+                           depth, descript=desc, sparse=sparse)
+        del sums
 
         ####
         # Define shear catalog
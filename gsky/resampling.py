@@ -0,0 +1,85 @@
+import numpy as np
+
+_REDUCERS = ['sum', 'mean', 'min', 'max']
+
+
+def upgrade(mp2d, y_fac, x_fac, copy=True):
+    """
+    Up-grades the resolution of a 2D map by repeating each pixel
+    into a block of y_fac x x_fac pixels.
+    :param mp2d: input map with shape [ny, nx].
+    :param y_fac, x_fac: integer up-grading factors.
+    :param copy: if False, return a read-only broadcast view with shape
+        [ny, y_fac, nx, x_fac] instead of a new [ny*y_fac, nx*x_fac]
+        array. No memory is allocated in this case, and element
+        [iy, jy, ix, jx] of the view is pixel [iy*y_fac+jy, ix*x_fac+jx]
+        of the up-graded map.
+    """
+    ny, nx = mp2d.shape
+    view = np.broadcast_to(mp2d[:, None, :, None],
+                           (ny, y_fac, nx, x_fac))
+    if copy:
+        return view.reshape([ny*y_fac, nx*x_fac])
+    return view
+
+
+def downgrade(mp2d, y_fac, x_fac, reducer='mean', weights=None,
+              fill_value=0.):
+    """
+    Down-grades the resolution of a 2D map by combining blocks of
+    y_fac x x_fac pixels. If the map size is not a multiple of the
+    block size, the last row/column of blocks only contains the
+    remaining pixels.
+    :param mp2d: input map with shape [ny, nx].
+    :param y_fac, x_fac: integer down-grading factors.
+    :param reducer: one of 'sum', 'mean', 'min' or 'max'.
+    :param weights: map of pixel weights with the same shape as `mp2d`
+        (e.g. a mask), or `None`. For 'mean', the weighted mean in each
+        block is returned; for 'sum', the weighted sum. For 'min' and
+        'max', pixels with zero weight are ignored.
+    :param fill_value: value of blocks with no (non-zero weight) pixels
+        for the 'mean', 'min' and 'max' reducers.
+    :return: down-graded map with shape
+        [ceil(ny/y_fac), ceil(nx/x_fac)].
+    """
+    if reducer not in _REDUCERS:
+        raise ValueError("Unknown reducer " + reducer)
+    ny, nx = mp2d.shape
+    iy = np.arange(0, ny, y_fac)
+    ix = np.arange(0, nx, x_fac)
+
+    if reducer in ['sum', 'mean']:
+        if weights is None:
+            mp = mp2d
+        else:
+            mp = mp2d*weights
+        mp_dg = np.add.reduceat(np.add.reduceat(mp, iy, axis=0),
+                                ix, axis=1)
+        if reducer == 'sum':
+            return mp_dg
+
+        if weights is None:
+            # Number of pixels in each (possibly truncated) block
+            wy = np.diff(np.append(iy, ny))
+            wx = np.diff(np.append(ix, nx))
+            w_dg = np.outer(wy, wx).astype(float)
+        else:
+            w_dg = np.add.reduceat(np.add.reduceat(weights, iy, axis=0),
+                                   ix, axis=1)
+        good = w_dg != 0
+        out = np.full(mp_dg.shape, fill_value, dtype=float)
+        out[good] = mp_dg[good]/w_dg[good]
+        return out
+
+    if reducer == 'min':
+        ufunc = np.minimum
+        empty = np.inf
+    else:
+        ufunc = np.maximum
+        empty = -np.inf
+    mp = np.asarray(mp2d, dtype=float)
+    if weights is not None:
+        mp = np.where(weights != 0, mp, empty)
+    mp_dg = ufunc.reduceat(ufunc.reduceat(mp, iy, axis=0), ix, axis=1)
+    mp_dg[mp_dg == empty] = fill_value
+    return mp_dg
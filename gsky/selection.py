@@ -0,0 +1,151 @@
+import numpy as np
+
+# Conditions under which an object is *removed* by a column cut.
+# Objects with NaN values are never removed, as in the original cuts.
+_DROP_OPS = {'<': np.greater_equal,
+             '<=': np.greater,
+             '>': np.less_equal,
+             '>=': np.less}
+
+
+def default_cuts(band='i', depth_cut=24.5, area=True):
+    """
+    Returns the standard HSC sample cuts in the format understood by
+    `Selection`:
+    - Full-depth full-colour area and clean photometry (if `area`).
+    - Magnitude limit (extinction-corrected) in `band`.
+    - Blending.
+    - S/N > 10 in i.
+    - S/N > 5 in at least 2 of grzy.
+    :param band: band used for the magnitude limit.
+    :param depth_cut: magnitude limit.
+    :param area: if True, include the area and clean photometry cuts.
+    """
+    cuts = []
+    if area:
+        cuts += [{'type': 'flag', 'column': 'wl_fulldepth_fullcolor'},
+                 {'type': 'flag', 'column': 'clean_photometry'}]
+    cuts += [{'type': 'maglim', 'band': band, 'max': depth_cut},
+             # abs_flux<10^-0.375
+             {'type': 'column', 'column': 'iblendedness_abs_flux',
+              'op': '<', 'value': 0.42169650342},
+             {'type': 'snr', 'band': 'i', 'min': 10.},
+             {'type': 'snr_count', 'bands': ['g', 'r', 'z', 'y'],
+              'min': 5., 'n_min': 2}]
+    return cuts
+
+
+# Star-galaxy separator
+star_cuts = [{'type': 'column', 'column': 'iclassification_extendedness',
+              'op': '<=', 'value': 0.99}]
+galaxy_cuts = [{'type': 'column', 'column': 'iclassification_extendedness',
+                'op': '>=', 'value': 0.99}]
+
+
+class Selection(object):
+    def __init__(self, cuts, chunk_size=65536):
+        """
+        Catalog selection defined by a list of cuts, e.g. as read from
+        a YAML configuration file. All cuts are evaluated together in a
+        single pass over the catalog, in chunks of `chunk_size` rows, so
+        that only chunk-sized temporaries are ever allocated. The result
+        is a packed boolean mask (see `unpack`). Each cut is a dictionary
+        with a `type` key and the following parameters:
+        - 'flag': keep objects with `column` True.
+        - 'column': keep objects satisfying `column` `op` `value`,
+          where `op` is one of <, <=, > or >=.
+        - 'maglim': keep objects with `band` cmodel magnitude, corrected
+          for extinction, <= `max`.
+        - 'snr': keep objects with `band` cmodel S/N >= `min`.
+        - 'snr_count': keep objects with cmodel S/N >= `min` in at
+          least `n_min` of `bands`.
+        :param cuts: list of cuts.
+        :param chunk_size: number of rows processed at once.
+        """
+        if chunk_size % 8 != 0:
+            raise ValueError("chunk_size must be a multiple of 8")
+        self.cuts = cuts
+        self.chunk_size = chunk_size
+        self.columns = []
+        for c in cuts:
+            for col in self._get_cut_columns(c):
+                if col not in self.columns:
+                    self.columns.append(col)
+
+    def _get_cut_columns(self, cut):
+        t = cut['type']
+        if t == 'flag':
+            return [cut['column']]
+        elif t == 'column':
+            if cut['op'] not in _DROP_OPS:
+                raise ValueError("Unknown operator "+cut['op'])
+            return [cut['column']]
+        elif t == 'maglim':
+            return ['%scmodel_mag' % cut['band'], 'a_%s' % cut['band']]
+        elif t == 'snr':
+            return ['%scmodel_flux' % cut['band'],
+                    '%scmodel_flux_err' % cut['band']]
+        elif t == 'snr_count':
+            cols = []
+            for b in cut['bands']:
+                cols += ['%scmodel_flux' % b, '%scmodel_flux_err' % b]
+            return cols
+        else:
+            raise ValueError("Unknown cut type "+t)
+
+    def _apply_cut(self, cut, get, keep):
+        t = cut['type']
+        if t == 'flag':
+            keep &= get(cut['column']).astype(bool)
+        elif t == 'column':
+            keep &= ~_DROP_OPS[cut['op']](get(cut['column']), cut['value'])
+        elif t == 'maglim':
+            b = cut['band']
+            keep &= ~(get('%scmodel_mag' % b) - get('a_%s' % b) > cut['max'])
+        elif t == 'snr':
+            b = cut['band']
+            keep &= ~(get('%scmodel_flux' % b) <
+                      cut['min'] * get('%scmodel_flux_err' % b))
+        elif t == 'snr_count':
+            npass = np.zeros(len(keep), dtype=int)
+            for b in cut['bands']:
+                npass += ~(get('%scmodel_flux' % b) <
+                           cut['min'] * get('%scmodel_flux_err' % b))
+            keep &= npass >= cut['n_min']
+
+    def get_columns(self):
+        """
+        Returns the list of catalog columns needed by this selection.
+        """
+        return list(self.columns)
+
+    def __call__(self, cat):
+        """
+        Evaluates the selection on a catalog.
+        :param cat: catalog (astropy Table, FITS_rec or structured
+            array) containing all the columns returned by `get_columns`.
+        :return: packed boolean mask (see `unpack`).
+        """
+        cols = {c: np.asarray(cat[c]) for c in self.columns}
+        nrows = len(cat)
+        mask = np.zeros((nrows+7)//8, dtype=np.uint8)
+        for i0 in range(0, nrows, self.chunk_size):
+            i1 = min(i0+self.chunk_size, nrows)
+
+            def get(name):
+                return cols[name][i0:i1]
+
+            keep = np.ones(i1-i0, dtype=bool)
+            for cut in self.cuts:
+                self._apply_cut(cut, get, keep)
+            mask[i0//8:(i1+7)//8] = np.packbits(keep)
+        return mask
+
+    @staticmethod
+    def unpack(mask, nrows):
+        """
+        Turns a packed mask into a boolean array.
+        :param mask: packed mask.
+        :param nrows: number of rows in the catalog.
+        """
+        return np.unpackbits(mask, count=nrows).astype(bool)
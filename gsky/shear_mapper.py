@@ -3,6 +3,8 @@ from .types import FitsFile, ASCIIFile
 import numpy as np
 from .flatmaps import read_flat_map
 from .map_utils import createSpin2Map, createW2QU2Map
+from .pixel_index import PixelIndex
+from .nz_stack import get_tomo_stacker
 from astropy.io import fits
 import os
 from .plot_utils import plot_map, plot_curves
@@ -27,10 +29,11 @@ class ShearMapper(PipelineStage):
                       'nz_bin_max': 3.0,
                       'shearrot': 'noflip'}
 
-    def get_gamma_maps(self, cat):
+    def get_gamma_maps(self, cat, pixidx=None):
         """
         Get gamma1, gamma2 maps and corresponding mask from catalog.
         :param cat:
+        :param pixidx: PixelIndex for the catalog (optional).
         :return:
         """
 
@@ -42,12 +45,14 @@ class ShearMapper(PipelineStage):
         for ibin in range(self.nbins):
             msk_bin = (cat['tomo_bin'] == ibin) & cat['shear_cat']
             subcat = cat[msk_bin]
+            pix_bin = None if pixidx is None else pixidx.select(msk_bin)
             gammamaps, gammamasks = createSpin2Map(subcat['ra'],
                                                    subcat['dec'],
                                                    subcat['ishape_hsm_regauss_e1_calib'],
                                                    subcat['ishape_hsm_regauss_e2_calib'], self.fsk,
                                                    weights=subcat['ishape_hsm_regauss_derived_shape_weight'],
-                                                   shearrot=self.config['shearrot'])
+                                                   shearrot=self.config['shearrot'],
+                                                   pixidx=pix_bin)
             maps_combined = [gammamaps, gammamasks]
             maps.append(maps_combined)
 
@@ -78,11 +83,12 @@ class ShearMapper(PipelineStage):
 
         return np.array(e2rms_arr)
 
-    def get_w2e2(self, cat):
+    def get_w2e2(self, cat, pixidx=None):
         """
         Compute the weighted mean squared ellipticity in a pixel, averaged over the whole map (used for analytic shape
         noise estimation).
         :param cat:
+        :param pixidx: PixelIndex for the catalog (optional).
         :return:
         """
 
@@ -94,11 +100,13 @@ class ShearMapper(PipelineStage):
         for ibin in range(self.nbins):
             msk_bin = (cat['tomo_bin'] == ibin) & cat['shear_cat']
             subcat = cat[msk_bin]
+            pix_bin = None if pixidx is None else pixidx.select(msk_bin)
             w2e2maps = createW2QU2Map(subcat['ra'],
                                                    subcat['dec'],
                                                    subcat['ishape_hsm_regauss_e1_calib'],
                                                    subcat['ishape_hsm_regauss_e2_calib'], self.fsk,
-                                                   weights=subcat['ishape_hsm_regauss_derived_shape_weight'])
+                                                   weights=subcat['ishape_hsm_regauss_derived_shape_weight'],
+                                                   pixidx=pix_bin)
 
             w2e2_curr = 0.5*(np.mean(w2e2maps[0]) + np.mean(w2e2maps[1]))
             w2e2.append(w2e2_curr)
@@ -149,42 +157,20 @@ class ShearMapper(PipelineStage):
             pzs.append([bz[:-1], bz[1:], (hz+0.)/np.sum(hz+0.), ehz])
         return np.array(pzs)
 
-    def get_nz_stack(self, cat, codename):
+    def get_nz_stacks(self, cat):
         """
-        Get N(z) from pdf stacks.
+        Get N(z)s from pdf stacks for all photoz codes. The stacks
+        needed by the GalMapper and ShearMapper stages are computed in
+        a single pass over each pdf store and cached beside it (see
+        nz_stack.NzStacker).
         :param cat: object catalog
-        :param codename: photoz code name (demp, ephor,
-            ephor_ab, frankenz or nnpz).
+        :return: dictionary of N(z) arrays for each photoz code.
         """
-        from scipy.interpolate import interp1d
-
-        f = fits.open(self.pdf_files[codename])
-        p = f[1].data['pdf'][self.msk]
-        z = f[2].data['bins']
-        sumpdf = np.sum(p, axis=1)
-        pdfgood = sumpdf > 0
-
-        weights = cat['ishape_hsm_regauss_derived_shape_weight']
-        z_all = np.linspace(0., self.config['nz_bin_max'],
-                            self.config['nz_bin_num'] + 1)
-        z0 = z_all[:-1]
-        z1 = z_all[1:]
-        zm = 0.5*(z0+z1)
-        pzs = []
-        for i in range(self.nbins):
-            msk_good = ((cat['tomo_bin'] == i) &
-                        pdfgood &
-                        cat['shear_cat'])
-            hz_orig = np.sum(weights[msk_good][:, None] * p[msk_good],
-                             axis=0)
-            hz_orig /= np.sum(hz_orig)
-            hzf = interp1d(z, hz_orig, bounds_error=False,
-                           fill_value=0.)
-            hzm = hzf(zm)
-
-            pzs.append([z0, z1, hzm / np.sum(hzm)])
-        f.close()
-        return np.array(pzs)
+        z_edges = np.linspace(0., self.config['nz_bin_max'],
+                              self.config['nz_bin_num']+1)
+        stacker = get_tomo_stacker(cat, self.msk, self.nbins, z_edges)
+        return {n: stacker.get_stacks(fn)['shear']
+                for n, fn in self.pdf_files.items()}
 
     def run(self):
         """
@@ -229,18 +215,19 @@ class ShearMapper(PipelineStage):
         pzs_cosmos = self.get_nz_cosmos()
 
         logger.info("Getting pdf stacks")
-        pzs_stack = {}
-        for n in self.pdf_files.keys():
-            pzs_stack[n] = self.get_nz_stack(cat, n)
+        pzs_stack = self.get_nz_stacks(cat)
 
         logger.info("Computing e2rms.")
         e2rms = self.get_e2rms(cat)
 
+        # Pixel assignment shared by all maps
+        pixidx = PixelIndex(self.fsk, cat['ra'], cat['dec'])
+
         logger.info("Computing w2e2.")
-        w2e2 = self.get_w2e2(cat)
+        w2e2 = self.get_w2e2(cat, pixidx=pixidx)
 
         logger.info("Creating shear maps and corresponding masks.")
-        gammamaps = self.get_gamma_maps(cat)
+        gammamaps = self.get_gamma_maps(cat, pixidx=pixidx)
 
         logger.info("Writing output to {}.".format(self.get_output('gamma_maps')))
         header = self.fsk.wcs.to_header()
@@ -1,12 +1,11 @@
 from ceci import PipelineStage
 from .types import FitsFile
 import numpy as np
-from .flatmaps import FlatMapInfo, read_flat_map
-from .obscond import ObsCond
+from .flatmaps import FlatMapInfo, SparseFlatMap, read_flat_map
+from .obscond import ObsCond, get_statistic
 from astropy.io import fits
 import os
-from shapely.geometry.polygon import Polygon
-from shapely.prepared import prep
+from .pixel_overlap import OverlapTable, get_overlap_key, get_frames_near
 from .plot_utils import plot_map
 
 import logging
@@ -19,9 +18,68 @@ class SystMapper(PipelineStage) :
     outputs=[('ccdtemp_maps',FitsFile),('airmass_maps',FitsFile),('exptime_maps',FitsFile),
              ('skylevel_maps',FitsFile),('sigma_sky_maps',FitsFile),('seeing_maps',FitsFile),
              ('ellipt_maps',FitsFile),('nvisit_maps',FitsFile)]
-    config_options={'ccd_drop':[9], 'plots_dir': None}
+    config_options={'ccd_drop':[9], 'plots_dir': None, 'sparse_maps': False,
+                    'overlap_dir': None, 'nprocs': 1,
+                    'oc_stats': ['mean', 'std', 'median']}
+    #Number of frames whose pixel overlaps are computed at once
+    frame_batch=1024
+
+    def get_overlaps(self, fsk, data) :
+        """
+        Returns the overlaps between all frames and all pixels (see
+        pixel_overlap.OverlapTable). The table is saved in
+        `overlap_dir` (by default, the output directory), keyed by a
+        hash of the frames file and the map geometry, and is reused by
+        later runs. Frames far from the field are discarded with a
+        cheap bounding-box test, and the overlaps are computed on
+        `nprocs` processes.
+        :param fsk: FlatMapInfo describing the map geometry.
+        :param data: frames data.
+        """
+        overlap_dir=self.config['overlap_dir']
+        if overlap_dir is None :
+            overlap_dir=os.path.dirname(os.path.abspath(self.get_output('nvisit_maps')))
+        key=get_overlap_key(self.get_input('frames_data'),fsk)
+        fname=os.path.join(overlap_dir,'frame_overlaps_'+key[:16]+'.npz')
+        if os.path.isfile(fname) :
+            overlaps=OverlapTable.read(fname,key=key)
+            if overlaps is not None :
+                logger.info("Reading pixel intersects and areas from "+fname)
+                return overlaps
+
+        #Discard frames far from the field
+        corners=['ll','ul','ur','lr']
+        near=get_frames_near(fsk,np.array([data[c+'cra'] for c in corners]).T,
+                             np.array([data[c+'cdecl'] for c in corners]).T)
+        logger.info("%d out of %d frames are close to the field"%(np.sum(near),len(data)))
+        data_near=data[near]
+
+        logger.info("Computing frame coords")
+        ix_ll,iy_ll,in_ll=fsk.pos2pix2d(data_near['llcra'],data_near['llcdecl'])
+        ix_ul,iy_ul,in_ul=fsk.pos2pix2d(data_near['ulcra'],data_near['ulcdecl'])
+        ix_ur,iy_ur,in_ur=fsk.pos2pix2d(data_near['urcra'],data_near['urcdecl'])
+        ix_lr,iy_lr,in_lr=fsk.pos2pix2d(data_near['lrcra'],data_near['lrcdecl'])
+        #Keep only frames that fit inside the field
+        is_in=np.logical_or(in_ll,np.logical_or(in_ul,np.logical_or(in_ur,in_lr)))
+
+        logger.info("Getting pixel intersects and areas")
+        #Frame corners in pixel coordinates
+        x_frame=np.zeros([len(data),4]); x_frame[near]=np.array([ix_ll,ix_ul,ix_ur,ix_lr]).T
+        y_frame=np.zeros([len(data),4]); y_frame[near]=np.array([iy_ll,iy_ul,iy_ur,iy_lr]).T
+        valid=np.zeros(len(data),dtype=bool); valid[near]=is_in
+        overlaps=OverlapTable.from_quads(x_frame,y_frame,fsk.nx,fsk.ny,
+                                         valid=valid,batch=self.frame_batch,
+                                         nprocs=self.config['nprocs'])
+        os.makedirs(overlap_dir,exist_ok=True)
+        overlaps.write(fname,key=key)
+        return overlaps
 
     def run(self) :
+        """
+        Main function. For each observing condition and band, the maps
+        listed in `oc_stats` (see obscond.get_statistic) are saved in
+        that order.
+        """
         quants=['ccdtemp','airmass','exptime','skylevel','sigma_sky','seeing','ellipt']
 
         logger.info("Reading sample map")
@@ -29,112 +87,67 @@ class SystMapper(PipelineStage) :
 
         logger.info("Reading metadata")
         data=fits.open(self.get_input('frames_data'))[1].data
+        overlaps=self.get_overlaps(fsk,data)
+
+        #Keep only frames that fit inside the field
+        frames=np.where(overlaps.valid)[0]
         #Drop CCDs if needed
         for ccd_id in self.config['ccd_drop']:
-            msk=data['ccd_id']!=ccd_id
+            msk=data['ccd_id'][frames]!=ccd_id
             logger.info('will drop %d frames from bad CCDs'%(np.sum(~msk)))
-            data=data[msk]
+            frames=frames[msk]
+        data=data[frames]
         bands=np.unique(data['filter'])
-
-        logger.info("Computing frame coords")
-        ix_ll,iy_ll,in_ll=fsk.pos2pix2d(data['llcra'],data['llcdecl'])
-        ix_ul,iy_ul,in_ul=fsk.pos2pix2d(data['ulcra'],data['ulcdecl'])
-        ix_ur,iy_ur,in_ur=fsk.pos2pix2d(data['urcra'],data['urcdecl'])
-        ix_lr,iy_lr,in_lr=fsk.pos2pix2d(data['lrcra'],data['lrcdecl'])
-        #Keep only frames that fit inside the field
-        is_in=np.logical_or(in_ll,np.logical_or(in_ul,np.logical_or(in_ur,in_lr)))
-        data=data[is_in]
         coadd_weights=1./data['skylevel']
-        nframes=len(data)
-        ix_ll=ix_ll[is_in]; iy_ll=iy_ll[is_in]; 
-        ix_ul=ix_ul[is_in]; iy_ul=iy_ul[is_in]; 
-        ix_ur=ix_ur[is_in]; iy_ur=iy_ur[is_in]; 
-        ix_lr=ix_lr[is_in]; iy_lr=iy_lr[is_in];
-        
-        logger.info("Building poliygons")
-        polyfield=Polygon([(0,0),(0,fsk.ny),(fsk.nx,fsk.ny),(fsk.nx,0)])
-        polyframe=np.array([Polygon([(ix_ll[i],iy_ll[i]),
-                                     (ix_ul[i],iy_ul[i]),
-                                     (ix_ur[i],iy_ur[i]),
-                                     (ix_lr[i],iy_lr[i])]) for i in np.arange(len(data))])
-        polypix=np.array([[Polygon([(ix,iy),(ix,iy+1),(ix+1,iy+1),(ix+1,iy)]) 
-                           for ix in np.arange(fsk.nx)] 
-                          for iy in np.arange(fsk.ny)])
-        indpix=np.arange(fsk.nx*fsk.ny).reshape([fsk.ny,fsk.nx])
 
-        logger.info("Getting pixel intersects and areas")
-        pix_indices=[]
-        pix_areas=[]
-        percent_next=0
-        for ip,pfr in enumerate(polyframe) :
-            percent_done=int(100*(ip+0.)/nframes)
-            if percent_done==percent_next :
-                logger.info("%d%% done"%percent_done)
-                percent_next+=10
-            c=np.array(pfr.exterior.coords)
-            
-            #Pick only pixels in range
-            ixmin=max(int(np.amin(c[:,0]))-1,0)
-            iymin=max(int(np.amin(c[:,1]))-1,0)
-            ixmax=min(int(np.amax(c[:,0]))+1,fsk.nx)
-            iymax=min(int(np.amax(c[:,1]))+1,fsk.ny)
-            pix_in_range=(polypix[iymin:iymax,:][:,ixmin:ixmax]).flatten()
-            ipix_in_range=(indpix[iymin:iymax,:][:,ixmin:ixmax]).flatten()
-
-            #Estimate which ones actually have been touched
-            pprep=prep(pfr)
-            touched=list(map(pprep.intersects,pix_in_range))
-            indices=ipix_in_range[touched]
-            pix_indices.append(indices)
-
-            #Estimate intersection area
-            def get_intersect_area(px) :
-                return pfr.intersection(px).area
-            areas=np.array(list(map(get_intersect_area,pix_in_range[touched])))
-            pix_areas.append(areas)
+        #Flat list of all (frame, pixel, area) overlaps
+        pix_frames,pix_indices,pix_areas=overlaps.get_frames(frames)
 
         logger.info("Computing systematics maps")
         #Initialize maps
         nvisits={b:np.zeros_like(mp) for b in bands}
-        oc_maps={}
-        for q in quants :
-            oc_maps[q]={b:ObsCond(q,fsk.nx,fsk.ny) for b in bands}
+        oc_maps={b:ObsCond(quants,fsk.nx,fsk.ny) for b in bands}
         #Fill maps
-        for ip,pfr in enumerate(polyframe) :
-            band=data['filter'][ip]
-            indices=pix_indices[ip]
-            areas=pix_areas[ip]
-            weight=coadd_weights[ip]
-            nvisits[band][indices]+=areas
-            for quant in quants :
-                oc_maps[quant][band].add_frame(indices,data[quant][ip],areas*weight)
+        pix_bands=data['filter'][pix_frames]
+        for b in bands :
+            in_band=pix_bands==b
+            ifr=pix_frames[in_band]
+            indices=pix_indices[in_band]
+            areas=pix_areas[in_band]
+            nvisits[b]+=np.bincount(indices,weights=areas,minlength=len(mp))
+            oc_maps[b].add_frames(indices,np.array([data[q][ifr] for q in quants]),
+                                  areas*coadd_weights[ifr],
+                                  exposure=np.clip(data['exptime'][ifr],0,None))
 
         #Close maps
-        for q in quants:
-            for b in bands:
-                oc_maps[q][b].complete_map()
+        stats=self.config['oc_stats']
+        oc_stats={}
+        for b in bands:
+            oc_maps[b].complete_map()
+            oc_stats[b]=oc_maps[b].collapse_maps(stats)
 
         logger.info("Saving maps")
         #Nvisits
         maps_save=np.array([nvisits[b] for b in bands])
         descripts=np.array(['Nvisits-'+b for b in bands])
-        fsk.write_flat_map(self.get_output('nvisit_maps'),maps_save,descripts)
+        fsk.write_flat_map(self.get_output('nvisit_maps'),maps_save,descripts,
+                           sparse=self.config['sparse_maps'])
         #Observing conditions
-        for q in quants :
-            maps_save=np.array([oc_maps[q][b].collapse_map_mean() for b in bands] +
-                               [oc_maps[q][b].collapse_map_std() for b in bands] +
-                               [oc_maps[q][b].collapse_map_median() for b in bands])
-            descripts=np.array(['mean '+q+'-'+b for b in bands] +
-                               ['std '+q+'-'+b for b in bands] +
-                               ['median '+q+'-'+b for b in bands])
+        for iq,q in enumerate(quants) :
+            maps_save=np.array([oc_stats[b][s][iq] for s in stats for b in bands])
+            descripts=np.array([get_statistic(s)[1]+' '+q+'-'+b
+                                for s in stats for b in bands])
+            if self.config['sparse_maps'] :
+                #Empty pixels are set to -9999
+                maps_save=SparseFlatMap.from_dense(fsk,maps_save,fill_value=-9999.)
             fsk.write_flat_map(self.get_output(q+'_maps'),maps_save,descripts)
 
         # Plots
         for b in bands:
             plot_map(self.config, fsk, nvisits[b], 'nvisit_%s' % b)
-            for q in quants:
-                mp = oc_maps[q][b].collapse_map_mean()
-                plot_map(self.config, fsk, mp, '%s_%s' % (q, b))
+            mean=oc_maps[b].collapse_maps(['mean'])['mean']
+            for iq,q in enumerate(quants):
+                plot_map(self.config, fsk, mean[iq], '%s_%s' % (q, b))
 
         # Permissions on NERSC
         os.system('find /global/cscratch1/sd/damonge/GSKY/ -type d -exec chmod -f 777 {} \;')
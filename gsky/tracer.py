@@ -1,6 +1,7 @@
 import pymaster as nmt
 import numpy as np
 from .flatmaps import compare_infos, read_flat_map
+from .bitmask import BitMask
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -14,7 +15,7 @@ class Tracer(object) :
         :param hdu_list: list of FITS HDUs containing the number density maps.
         :param i_bin: which redshift bin to consider.
         :param fsk: flatmaps.FlatSkyInfo object defining the geometry of the maps.
-        :param mask_binary: binary mask (which pixels to consider and which not to).
+        :param mask_binary: binary mask (which pixels to consider and which not to), as a BitMask or as a map.
         :param masked_fraction: masked fraction map.
         :param contaminants: list of possible contaminant maps to deproject.
         
@@ -33,6 +34,8 @@ class Tracer(object) :
             self.nz_data=hdu_list[2*i_bin+1].data.copy()
 
             #Make sure other maps are compatible
+            if not isinstance(mask_binary, BitMask) :
+                mask_binary=BitMask.from_array(mask_binary, threshold=0.1)
             if not self.fsk.is_map_compatible(mask_binary) :
                 raise ValueError("Mask size is incompatible")
             if not self.fsk.is_map_compatible(masked_fraction) :
@@ -44,12 +47,12 @@ class Tracer(object) :
 
             #Translate into delta map
             self.masked_fraction=masked_fraction
-            self.weight=masked_fraction*mask_binary
-            goodpix=np.where(mask_binary>0.1)[0]
+            self.weight=mask_binary.apply(masked_fraction)
+            goodpix=mask_binary.get_pixels()
             self.goodpix=goodpix
             self.mask_binary=mask_binary
-            self.Ngal = np.sum(nmap*mask_binary)
-            ndens=np.sum(nmap*mask_binary)/np.sum(self.weight)
+            self.Ngal = np.sum(nmap[goodpix])
+            ndens=self.Ngal/np.sum(self.weight)
             self.ndens_perad=ndens/(np.radians(self.fsk.dx)*np.radians(self.fsk.dy))
             self.delta=np.zeros_like(self.weight)
             self.delta[goodpix]=nmap[goodpix]/(ndens*masked_fraction[goodpix])-1
@@ -89,7 +92,7 @@ class Tracer(object) :
                         raise ValueError("%d-th contaminant template is incompatible."%ic)
 
             self.weight = masks[0]
-            mask_binary = masks[1]
+            mask_binary = BitMask.from_array(masks[1], threshold=0.1)
             nmap = masks[2]
 
             # Reshape contaminants
@@ -97,7 +100,7 @@ class Tracer(object) :
             if contaminants is not None:
                 conts = [[c.reshape([self.fsk.ny, self.fsk.nx])] for c in contaminants]
 
-            ndens = np.sum(nmap * mask_binary) / np.sum(self.weight)
+            ndens = np.sum(nmap[mask_binary.get_pixels()]) / np.sum(self.weight)
             self.ndens_perad = ndens / (np.radians(self.fsk.dx) * np.radians(self.fsk.dy))
             self.e1_2rms_pix = np.average(gammamaps[0]**2, weights=self.weight)
             self.e2_2rms_pix = np.average(gammamaps[1] ** 2, weights=self.weight)
@@ -118,7 +121,7 @@ class Tracer(object) :
             else:
                 logger.info('Using binary mask.')
                 self.field = nmt.NmtFieldFlat(np.radians(self.fsk.lx), np.radians(self.fsk.ly),
-                            mask_binary.reshape([self.fsk.ny,self.fsk.nx]),
+                            mask_binary.to_float().reshape([self.fsk.ny,self.fsk.nx]),
                             [gammamaps[0].reshape([self.fsk.ny,self.fsk.nx]), gammamaps[1].reshape([self.fsk.ny,self.fsk.nx])],
                             templates=conts)
 